@@ -5,9 +5,27 @@ Account resource.
 
 import string
 import pprint
+import json
+import csv
+import StringIO
 
 from .base import *
-from .database import Account
+from .database import Account, check_account_row
+
+
+def check_account_name(name):
+    "Raise ValueError if the account name is not acceptable."
+    if len(name) <= 3:
+        raise ValueError('account name is too short')
+    allowed = string.letters + string.digits + '-_.'
+    if set(name).difference(allowed):
+        raise ValueError('disallowed characters in account name')
+
+def check_password(password):
+    "Raise ValueError if the password is not acceptable."
+    if len(password) < configuration.MIN_PASSWORD_LENGTH:
+        raise ValueError("password must be at least %s characters"
+                         % configuration.MIN_PASSWORD_LENGTH)
 
 
 class AccountsHtmlRepresentation(HtmlRepresentation):
@@ -19,12 +37,14 @@ class AccountsHtmlRepresentation(HtmlRepresentation):
                    TH('Teams'))]
         for account in self.data['accounts']:
             teams = []
-            for team in account['teams']:
+            for team in account.get('teams', []):
                 name = team['name']
                 if team['is_admin']:
                     name += ' (admin)'
                 teams.append(str(A(name, href=team['href'])))
-            rows.append(TR(TD(A(account['name'], href=account['href'])),
+            # The name is not included if excluded by the 'fields' value.
+            name = account.get('name') or account['href']
+            rows.append(TR(TD(A(name, href=account['href'])),
                            TD(account.get('email') or ''),
                            TD(', '.join(teams))))
         return TABLE(klass='list', *rows)
@@ -37,35 +57,55 @@ class GET_Accounts(MethodMixin, GET):
                 TextRepresentation,
                 AccountsHtmlRepresentation]
 
+    fields = (StringField('fields', title='Fields',
+                          descr='Names of the items to include,'
+                          ' comma-separated. Default: all.'),)
+
     def is_accessible(self):
         return self.is_login_admin()
 
     def get_data_resource(self, request):
+        values = self.parse_fields(request)
+        fields = self.get_selected_fields(values, ACCOUNT_FIELDS)
         data = dict(title='Accounts')
         data['accounts'] = []
         for account in self.db.get_accounts():
-            accountdata = account.get_data()
+            accountdata = account.get_data(fields=fields)
             accountdata['href'] = request.application.get_url('account',
                                                               account)
-            accountdata['teams'] = []
-            for team in account.get_teams():
-                teamdata = dict(name=str(team),
-                                href=request.application.get_url('team', team),
-                                is_admin=team.is_admin(account))
-                accountdata['teams'].append(teamdata)
+            if 'teams' in accountdata:
+                admin = account.get_admin_flags()
+                teams = []
+                for name in accountdata['teams']:
+                    teams.append(dict(name=name,
+                                      href=request.application.get_url('team',
+                                                                       name),
+                                      is_admin=admin.get(name, False)))
+                accountdata['teams'] = teams
             data['accounts'].append(accountdata)
         data['operations'] = [dict(title='Create account',
                                    href=request.application.get_url('account'))]
         return data
 
 
+class GET_AccountOptions(OptionsMixin, MethodMixin, GET):
+    "The names of the accounts starting with a prefix, for typeahead input."
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_options(self, prefix, limit):
+        "Return the sorted list of account names starting with the prefix."
+        return self.db.get_account_names(prefix, limit)
+
+
 class AccountHtmlRepresentation(HtmlRepresentation):
     "HTML representation of the account data."
 
     def get_content(self):
         account = self.data['account']
         teams = []
-        for team in account['teams']:
+        for team in account.get('teams', []):
             name = team['name']
             if team['is_admin']:
                 name += ' (admin)'
@@ -92,13 +132,13 @@ class AccountMixin(object):
         be confused for a FORMAT specification.
         """
         try:
-            self.account = Account(self.db, request.variables['account'])
+            self.account = self.db.get_account(request.variables['account'])
         except KeyError:
             if not request.variables.get('FORMAT'):
                 raise HTTP_NOT_FOUND
             name = request.variables['account'] + request.variables['FORMAT']
             try:
-                self.account = Account(self.db, name)
+                self.account = self.db.get_account(name)
             except KeyError:
                 raise HTTP_NOT_FOUND
             request.undo_format_specifier('account')
@@ -115,6 +155,10 @@ class GET_Account(AccountMixin, MethodMixin, GET):
                 TextRepresentation,
                 AccountHtmlRepresentation]
 
+    fields = (StringField('fields', title='Fields',
+                          descr='Names of the items to include,'
+                          ' comma-separated. Default: all.'),)
+
     def is_accessible(self):
         return self.is_login_admin() or self.is_login_account()
 
@@ -124,15 +168,19 @@ class GET_Account(AccountMixin, MethodMixin, GET):
         return [dict(title='Edit account', href=url)]
 
     def get_data_resource(self, request):
+        values = self.parse_fields(request)
+        fields = self.get_selected_fields(values, ACCOUNT_FIELDS)
         data = dict(title="Account %s" % self.account,
-                    account=self.account.get_data())
-        teams = []
-        for name in data['account'].pop('teams'):
-            is_admin = self.db.get_team(name).is_admin(self.account)
-            teams.append(dict(name=name,
-                              href=request.application.get_url('team', name),
-                              is_admin=is_admin))
-        data['account']['teams'] = teams
+                    account=self.account.get_data(fields=fields))
+        if 'teams' in data['account']:
+            admin = self.account.get_admin_flags()
+            teams = []
+            for name in data['account'].pop('teams'):
+                teams.append(dict(name=name,
+                                  href=request.application.get_url('team',
+                                                                   name),
+                                  is_admin=admin.get(name, False)))
+            data['account']['teams'] = teams
         return data
 
 
@@ -162,6 +210,9 @@ class GET_AccountEdit(AccountMixin, MethodMixin, GET):
                                check=False,
                                descr='Indicate team memberships'
                                ' for the account.'),
+              StringField('add_teams', title='Add teams', length=30,
+                          descr='Names of further teams for the account,'
+                          ' separated by blanks or commas.'),
               HiddenField('url', descr='Referring URL.'))
 
     def is_accessible(self):
@@ -174,12 +225,12 @@ class GET_AccountEdit(AccountMixin, MethodMixin, GET):
                       description=self.account.description)
         if self.is_login_admin():
             skip = set(['password'])
-            override = dict(teams=dict(options=[str(t) for t
-                                                in self.db.get_teams()],
-                                       default=[str(t) for t
-                                                in self.account.get_teams()]))
+            teams = self.account.get_team_names()
+            options_href = request.application.get_url('teams', 'options')
+            override = dict(teams=dict(options=teams, default=teams),
+                            add_teams=dict(options_href=options_href))
         else:
-            skip = set()
+            skip = set(['add_teams'])
             override = dict()
         url = request.headers['Referer'] or \
               request.application.get_url('account', self.account)
@@ -210,6 +261,8 @@ class POST_AccountEdit(AccountMixin, MethodMixin, RedirectMixin, POST):
         else:
             skip = set()
         values = self.parse_fields(request, skip=skip)
+        # Modify an instance read anew, not the one shared in the cache.
+        self.account = Account(self.db, name=self.account.name)
         current = values.pop('password', '')
         if current:
             try:
@@ -219,17 +272,23 @@ class POST_AccountEdit(AccountMixin, MethodMixin, RedirectMixin, POST):
         new = values.pop('new_password')
         confirm = values.pop('confirm_new_password', None)
         if new:
-            if len(new) < configuration.MIN_PASSWORD_LENGTH:
-                raise HTTP_BAD_REQUEST("password must be at least %s characters"
-                                       % configuration.MIN_PASSWORD_LENGTH)
+            try:
+                check_password(new)
+            except ValueError, msg:
+                raise HTTP_BAD_REQUEST(str(msg))
             if new != confirm:
                 raise HTTP_BAD_REQUEST('password confirmation failed')
             self.account.password = new
         self.account.email = values.get('email', None)
         self.account.description = values.get('description', None)
-        self.account.save()
+        try:
+            self.account.save()
+        except ValueError, msg:
+            raise HTTP_BAD_REQUEST(str(msg))
         if self.is_login_admin():
-            self.account.set_teams(values.get('teams', []))
+            teams = values.get('teams') or []
+            teams.extend(self.split_names(values.get('add_teams')))
+            self.account.set_teams(teams)
         try:
             url = values['url']
         except KeyError:
@@ -261,16 +320,20 @@ class GET_AccountCreate(MethodMixin, GET):
               MultiSelectField('teams', title='Teams',
                                check=False,
                                descr='Indicate team memberships'
-                               ' for the account.'))
+                               ' for the account.'),
+              StringField('add_teams', title='Teams', length=30,
+                          descr='Names of the teams for the account,'
+                          ' separated by blanks or commas.'))
 
     def is_accessible(self):
         return self.is_login_admin()
 
     def get_data_resource(self, request):
         data = dict(title='Create account')
-        override = dict(teams=dict(options=[str(t) for t
-                                            in self.db.get_teams()]))
-        data['form'] = dict(fields=self.get_data_fields(override=override),
+        options_href = request.application.get_url('teams', 'options')
+        override = dict(add_teams=dict(options_href=options_href))
+        data['form'] = dict(fields=self.get_data_fields(skip=set(['teams']),
+                                                        override=override),
                             title='Enter data for new account',
                             label='Create',
                             href=request.get_url(),
@@ -290,11 +353,10 @@ class POST_AccountCreate(MethodMixin, RedirectMixin, POST):
         "Handle the request; perform actions according to the request."
         values = self.parse_fields(request)
         values['name'] = values['name'].strip()
-        if len(values['name']) <= 3:
-            raise HTTP_BAD_REQUEST('account name is too short')
-        allowed = string.letters + string.digits + '-_.'
-        if set(values['name']).difference(allowed):
-            raise HTTP_BAD_REQUEST('disallowed characters in account name')
+        try:
+            check_account_name(values['name'])
+        except ValueError, msg:
+            raise HTTP_BAD_REQUEST(str(msg))
         try:
             self.db.get_account(values['name'])
         except KeyError:
@@ -305,14 +367,105 @@ class POST_AccountCreate(MethodMixin, RedirectMixin, POST):
         self.account = Account(self.db)
         self.account.name= values['name']
         password = values['password']
-        if len(password) < configuration.MIN_PASSWORD_LENGTH:
-            raise HTTP_BAD_REQUEST("password must be at least  %s characters"
-                                   % configuration.MIN_PASSWORD_LENGTH)
+        try:
+            check_password(password)
+        except ValueError, msg:
+            raise HTTP_BAD_REQUEST(str(msg))
         if password != values.pop('confirm_password'):
                 raise HTTP_BAD_REQUEST('password confirmation failed')
         self.account.password = password
         self.account.email = values.get('email', None)
         self.account.description = values.get('description', None)
-        self.account.save()
-        self.account.set_teams(values.get('teams', []))
+        try:
+            self.account.save()
+        except ValueError, msg:
+            raise HTTP_BAD_REQUEST(str(msg))
+        teams = values.get('teams') or []
+        teams.extend(self.split_names(values.get('add_teams')))
+        self.account.set_teams(teams)
         self.set_redirect(request.application.get_url('account', self.account))
+
+
+class GET_AccountsCreate(MethodMixin, GET):
+    "The form to create many accounts in one request."
+
+    outreprs = [JsonRepresentation,
+                TextRepresentation,
+                FormHtmlRepresentation]
+
+    fields = (TextField('accounts', title='Accounts',
+                        required=True,
+                        descr='Either a JSON list of objects, or CSV'
+                        ' with a header row. The items, or columns, are:'
+                        ' name, password, email, description and teams.'
+                        ' In CSV, the team names are separated by blanks.'),)
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        data = dict(title='Create accounts')
+        data['form'] = dict(fields=self.get_data_fields(),
+                            title='Enter data for new accounts',
+                            label='Create',
+                            href=request.get_url(),
+                            cancel=request.application.get_url('accounts'))
+        return data
+
+
+class POST_AccountsCreate(MethodMixin, POST):
+    """Create many accounts in one transaction. Rows with errors are
+    reported, and do not prevent the other rows from being created.
+    Return the result for each row."""
+
+    outreprs = [JsonRepresentation,
+                TextRepresentation]
+
+    fields = GET_AccountsCreate.fields
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def process(self, request):
+        "Handle the request; perform actions according to the request."
+        values = self.parse_fields(request)
+        try:
+            rows = self.parse_rows(values['accounts'])
+        except (ValueError, csv.Error), msg:
+            raise HTTP_BAD_REQUEST("invalid accounts data: %s" % msg)
+        errors = dict()
+        for index, row in enumerate(rows):
+            try:
+                check_account_row(row)
+                name = row['name'].strip()
+                check_account_name(name)
+                row['name'] = str(name)
+                check_password(row['password'])
+            except ValueError, msg:
+                errors[index] = str(msg)
+        self.results = self.db.create_accounts(rows, errors=errors)
+
+    def parse_rows(self, content):
+        """Return the list of dictionaries for the accounts given in
+        the content as JSON or CSV. Raise ValueError if invalid.
+        """
+        content = content.strip()
+        if content.startswith('['):
+            rows = json.loads(content)
+            if not all([isinstance(r, dict) for r in rows]):
+                raise ValueError('not a list of objects')
+            for row in rows:
+                teams = row.get('teams') or []
+                if isinstance(teams, basestring):
+                    row['teams'] = self.split_names(teams)
+        else:
+            rows = list(csv.DictReader(StringIO.StringIO(content)))
+            for row in rows:
+                row['teams'] = self.split_names(row.get('teams'))
+        return rows
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        return dict(title='Account creation results',
+                    results=self.results)
@@ -0,0 +1,179 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Asynchronous counterparts of the functions in the 'interface' module,
+to be used by other web applications based on 'asyncio'.
+
+Each function returns an awaitable, whose result is the same as that
+of the corresponding function in the 'interface' module. The database
+work is done in a bounded pool of dedicated threads, each having its
+own connection to the shared database instance, so the event loop is
+never blocked.
+Each lookup is done by the function in the 'interface' module, so
+the snapshot file is read instead of the database if configured.
+Concurrent identical lookups are coalesced into a single query;
+each caller gets its own copy of the result.
+"""
+
+import copy
+import json
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from . import configuration
+from . import interface
+
+
+_executor = ThreadPoolExecutor(max_workers=configuration.ASYNC_WORKERS)
+_pending = dict()
+
+
+def submit(key, function, *args):
+    """Run the function with the arguments in the executor.
+    Return an awaitable for its result. A call having the same key
+    and arguments as one still pending shares its result, instead of
+    a new query. The arguments are compared as JSON, since they may
+    contain values that are not hashable.
+    """
+    loop = asyncio.get_event_loop()
+    key = (id(loop), key, json.dumps(args, sort_keys=True))
+    try:
+        shared = _pending[key]
+    except KeyError:
+        shared = loop.run_in_executor(_executor, function, *args)
+        _pending[key] = shared
+        shared.add_done_callback(lambda f: _pending.pop(key, None))
+    result = loop.create_future()
+    def done(shared):
+        if result.cancelled(): return
+        if shared.cancelled():
+            result.cancel()
+        elif shared.exception() is not None:
+            result.set_exception(shared.exception())
+        else:
+            result.set_result(copy.deepcopy(shared.result()))
+    # A caller cancelling its awaitable does not affect the other callers.
+    shared.add_done_callback(done)
+    return result
+
+def _get_account(name, password, effective, fields):
+    return interface.get_account(name, password=password,
+                                 effective=effective, fields=fields)
+
+def get_account(name, password=None, effective=False, fields=None):
+    """Get the account data dictionary; see 'interface.get_account'.
+    Raise KeyError if no such account.
+    Raise ValueError if incorrect password, or invalid field.
+    """
+    if fields is not None:
+        fields = tuple(sorted(fields))
+    return submit('get_account', _get_account,
+                  name, password, effective, fields)
+
+def _get_account_by_email(email, password, effective, fields):
+    return interface.get_account_by_email(email, password=password,
+                                          effective=effective, fields=fields)
+
+def get_account_by_email(email, password=None, effective=False,
+                         fields=None):
+    """Get the data dictionary for the account having the email address;
+    see 'interface.get_account_by_email'.
+    Raise KeyError if no such account.
+    Raise ValueError if several accounts have the email address,
+    incorrect password, or invalid field.
+    """
+    if fields is not None:
+        fields = tuple(sorted(fields))
+    return submit('get_account_by_email', _get_account_by_email,
+                  email, password, effective, fields)
+
+def _get_accounts(fields):
+    return interface.get_accounts(fields=fields)
+
+def get_accounts(fields=None):
+    """Return a list of all accounts as dictionaries;
+    see 'interface.get_accounts'.
+    """
+    if fields is not None:
+        fields = tuple(sorted(fields))
+    return submit('get_accounts', _get_accounts, fields)
+
+def _get_team(name, effective, fields):
+    return interface.get_team(name, effective=effective, fields=fields)
+
+def get_team(name, effective=False, fields=None):
+    """Get the team data dictionary; see 'interface.get_team'.
+    Raise KeyError if no such team.
+    Raise ValueError if invalid field.
+    """
+    if fields is not None:
+        fields = tuple(sorted(fields))
+    return submit('get_team', _get_team, name, effective, fields)
+
+def _get_team_summaries():
+    return interface.get_team_summaries()
+
+def get_team_summaries():
+    """Return a list of dictionaries for all teams, without the lists
+    of members; see 'interface.get_team_summaries'.
+    """
+    return submit('get_team_summaries', _get_team_summaries)
+
+def _is_member(accountname, teamname, effective):
+    return interface.is_member(accountname, teamname, effective=effective)
+
+def is_member(accountname, teamname, effective=False):
+    """Is the account a member of the team?
+    If effective is true, then membership via nested teams counts.
+    Raise KeyError if no such account or team.
+    """
+    return submit('is_member', _is_member, accountname, teamname, effective)
+
+def _check_membership(accountname, teamname, effective):
+    return interface.check_membership(accountname, teamname,
+                                      effective=effective)
+
+def check_membership(accountname, teamname, effective=False):
+    """Return a dictionary (member, admin) for the account in the team;
+    see 'interface.check_membership'.
+    Raise KeyError if no such account or team.
+    """
+    return submit('check_membership', _check_membership,
+                  accountname, teamname, effective)
+
+def _find_accounts(path, value):
+    return interface.find_accounts(path, value)
+
+def find_accounts(path, value):
+    """Return the sorted list of names of the accounts having the value
+    at the path in their properties; see 'interface.find_accounts'.
+    Raise ValueError if invalid path.
+    """
+    return submit('find_accounts', _find_accounts, path, value)
+
+def _search(terms, limit):
+    return interface.search(terms, limit=limit)
+
+def search(terms, limit=configuration.DEFAULT_LIMIT):
+    """Return a list of dictionaries (type, name) for the accounts
+    and teams matching the search terms, best match first.
+    """
+    return submit('search', _search, terms, limit)
+
+def _get_changes(since):
+    return interface.get_changes(since)
+
+def get_changes(since=0):
+    """Return the changes after the given sequence number;
+    see 'interface.get_changes'.
+    """
+    return submit('get_changes', _get_changes, since)
+
+def update_account_properties(name, applicationname, properties):
+    "Update the properties of the given account for the given application."
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(_executor,
+                                interface.update_account_properties,
+                                name,
+                                applicationname,
+                                properties)
@@ -11,7 +11,10 @@ from wrapid.json_representation import JsonRepresentation
 from wrapid.text_representation import TextRepresentation
 
 from . import configuration
-from .database import Database, Account, Team
+from .database import Database, Account, Team, get_shared_database
+from .database import ACCOUNT_FIELDS, TEAM_FIELDS, get_fields
+from .database import normalize_email
+from .throttle import login_throttle
 from .html_representation import *
 
 
@@ -19,9 +22,16 @@ class MethodMixin(LoginMixin):
     "Mixin class for Method subclasses; database connect and authentication."
 
     def prepare(self, request):
-        "Connect to the database and authenticate the user."
-        self.db = Database()
-        self.db.open()      # Database must be open before logging in.
+        """Connect to the database and authenticate the user.
+        The database instance is shared by all threads in the process.
+        """
+        self.db = get_shared_database()
+        self.db.rollback()  # In case a previous request did not finalize.
+        # All queries for a GET response see the same database state.
+        if isinstance(self, GET):
+            self.db.begin_read()
+        self.db.refresh()   # Database must be current before logging in.
+        self.address = request.environ.get('REMOTE_ADDR')
         self.set_login(request)
         self.set_current(request)
         self.check_access()
@@ -29,18 +39,57 @@ class MethodMixin(LoginMixin):
     def get_account(self, name, password=None):
         """Return a dictionary describing the account:
         name, description, email, teams and properties.
+        The name may also be the email address of the account.
         If password is provided, authenticate the account.
         Raise KeyError if there is no such account.
-        Raise ValueError if the password does not match.
+        Raise ValueError if the password does not match,
+        or if there have been too many failed logins recently.
+        """
+        if not password:
+            return self.lookup_account(name).get_data()
+        key = self.get_throttle_name(name)
+        login_throttle.admit(key, self.address)
+        try:
+            account = self.lookup_account(name, password)
+        except (KeyError, ValueError):
+            login_throttle.failure(key, self.address)
+            raise
+        login_throttle.success(key, self.address)
+        return account.get_data()
+
+    def get_throttle_name(self, name):
+        """Return the name to count failed logins by: the account name,
+        or the normalized email address, so that its variants count
+        together. The database is not read before the login is admitted.
         """
-        return self.db.get_account(name, password).get_data()
+        if '@' not in name: return name
+        return normalize_email(name)
+
+    def lookup_account(self, name, password=None):
+        """Return the Account instance for the name, or for the email
+        address if it contains '@', which account names cannot.
+        """
+        if '@' in name:
+            return self.db.get_account_by_email(name, password)
+        else:
+            return self.db.get_account(name, password)
 
     def get_account_anonymous(self):
         "Anonymous login is disallowed."
         raise KeyError
 
     def finalize(self):
-        self.db.close()
+        """End the read transaction, or discard any uncommitted changes.
+        Evict the current entities,
+        which may have been modified, if this method may change data.
+        The connection is kept open for the next request in the thread.
+        """
+        self.db.rollback()
+        if not isinstance(self, GET):
+            for item in [getattr(self, 'account', None),
+                         getattr(self, 'team', None)]:
+                if item is not None:
+                    self.db.evict(item)
 
     def set_current(self, request):
         "Set the current entities to operate on."
@@ -64,6 +113,32 @@ class MethodMixin(LoginMixin):
         else:
             return False
 
+    def get_limit(self, values):
+        """Return the 'limit' value from the parsed request values
+        as an integer, defaulting to and capped by the configured values.
+        """
+        try:
+            limit = int(values.get('limit') or configuration.DEFAULT_LIMIT)
+        except ValueError:
+            raise HTTP_BAD_REQUEST('invalid limit value')
+        return max(1, min(limit, configuration.MAX_LIMIT))
+
+    def split_names(self, value):
+        "Return the list of names in a comma- or blank-separated string."
+        return [n for n in (value or '').replace(',', ' ').split() if n]
+
+    def get_selected_fields(self, values, allowed):
+        """Return the list of item names in the 'fields' value from the
+        parsed request values, or None if not given, meaning all items.
+        """
+        fields = self.split_names(values.get('fields'))
+        if not fields: return None
+        try:
+            get_fields(fields, allowed, False)
+        except ValueError, msg:
+            raise HTTP_BAD_REQUEST(str(msg))
+        return fields
+
     def get_data_links(self, request):
         "Return the links response data."
         get_url = request.application.get_url
@@ -79,6 +154,9 @@ class MethodMixin(LoginMixin):
             links.append(dict(title='Teams',
                               resource='Team list',
                               href=get_url('teams')))
+            links.append(dict(title='Search',
+                              resource='Search',
+                              href=get_url('search')))
         return links
 
 
@@ -86,3 +164,38 @@ class MethodMixin(LoginMixin):
         get_url = request.application.get_url
         return [dict(title='API',
                      href=get_url('doc/api'))]
+
+
+class CacheControlMixin(object):
+    """Mixin class for a GET method whose response may be cached
+    by the client for the time given by 'max_age'."""
+
+    max_age = 0
+
+    def handle(self, request):
+        response = super(CacheControlMixin, self).handle(request)
+        response['Cache-Control'] = "private, max-age=%s" % self.max_age
+        return response
+
+
+class OptionsMixin(object):
+    """Mixin class for a lightweight list of the names starting with
+    a prefix; the option source for typeahead input in forms."""
+
+    outreprs = [JsonRepresentation]
+
+    fields = (StringField('prefix', title='Prefix',
+                          descr='Beginning of the names to return.'),
+              StringField('limit', title='Limit',
+                          descr='Maximum number of names to return.'))
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        values = self.parse_fields(request)
+        prefix = (values.get('prefix') or '').strip()
+        return dict(prefix=prefix,
+                    options=self.get_options(prefix, self.get_limit(values)))
+
+    def get_options(self, prefix, limit):
+        "Return the sorted list of names starting with the prefix."
+        raise NotImplementedError
@@ -0,0 +1,146 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Process-wide caches, shared by all threads.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from whoyou import configuration
+
+
+class NegativeCache(object):
+    """Bounded set of keys known to be missing, such as the names of
+    nonexistent accounts. An entry expires after the time-to-live,
+    since the item may be created by another process. The process
+    creating an item must discard its key.
+    """
+
+    def __init__(self,
+                 max_entries=configuration.NEGATIVE_CACHE_ENTRIES,
+                 ttl=configuration.NEGATIVE_CACHE_TTL,
+                 clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # Key -> expiry time
+        self.counters = dict(hits=0, misses=0, evictions=0)
+
+    def __contains__(self, key):
+        with self.lock:
+            try:
+                expiry = self.entries[key]
+            except KeyError:
+                self.counters['misses'] += 1
+                return False
+            if expiry < self.clock():
+                del self.entries[key]
+                self.counters['misses'] += 1
+                return False
+            self.counters['hits'] += 1
+            return True
+
+    def add(self, key):
+        "Record the key as missing."
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = self.clock() + self.ttl
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def discard(self, key):
+        "The item for the key has been created."
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        "Return a dictionary of the counters and current number of entries."
+        with self.lock:
+            result = self.counters.copy()
+            result['entries'] = len(self.entries)
+        return result
+
+
+class LruCache(object):
+    """Dictionary-like cache bounded by the number of entries and by
+    the approximate total size of the values, evicting the least
+    recently used entries. The size of a value is given by the
+    function 'sizeof'.
+    """
+
+    def __init__(self,
+                 max_entries=configuration.CACHE_ENTRIES,
+                 max_bytes=configuration.CACHE_BYTES,
+                 sizeof=lambda value: 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # Key -> (value, size)
+        self.bytes = 0
+        self.counters = dict(hits=0, misses=0, evictions=0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.counters['misses'] += 1
+                raise
+            self.entries[key] = entry   # Now the most recently used.
+            self.counters['hits'] += 1
+            return entry[0]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            try:
+                self.bytes -= self.entries.pop(key)[1]
+            except KeyError:
+                pass
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or
+                                    self.bytes > self.max_bytes):
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+                self.counters['evictions'] += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.bytes -= size
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def get_stats(self):
+        """Return a dictionary of the counters, the current number
+        of entries and their approximate total size."""
+        with self.lock:
+            result = self.counters.copy()
+            result['entries'] = len(self.entries)
+            result['bytes'] = self.bytes
+        return result
+
+
+missing_accounts = NegativeCache()
+missing_teams = NegativeCache()
@@ -0,0 +1,54 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Change log resource, for incremental synchronization of caches.
+"""
+
+from .base import *
+
+
+class ChangesHtmlRepresentation(HtmlRepresentation):
+    "HTML representation of the change log."
+
+    def get_content(self):
+        rows = [TR(TH('Seq'),
+                   TH('Time'),
+                   TH('Type'),
+                   TH('Name'),
+                   TH('Team'),
+                   TH('Action'))]
+        for change in self.data['changes']:
+            rows.append(TR(TD(str(change['seq'])),
+                           TD(change['timestamp']),
+                           TD(change['type']),
+                           TD(change['name']),
+                           TD(change['team'] or ''),
+                           TD(change['action'])))
+        return TABLE(klass='list', *rows)
+
+
+class GET_Changes(MethodMixin, GET):
+    """The changes to accounts, teams and memberships after a given
+    sequence number. Give the returned 'last' value as 'since' in the
+    next request. If 'resync' is true, the changes after 'since' are no
+    longer available; reload all data, then continue from 'last'."""
+
+    outreprs = [JsonRepresentation,
+                TextRepresentation,
+                ChangesHtmlRepresentation]
+
+    fields = (StringField('since', title='Since',
+                          descr='Sequence number of the last change seen.'),)
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        values = self.parse_fields(request)
+        try:
+            since = int(values.get('since') or 0)
+        except ValueError:
+            raise HTTP_BAD_REQUEST('invalid since value')
+        data = dict(title="Changes since %s" % since, since=since)
+        data.update(self.db.get_changes(since))
+        return data
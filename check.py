@@ -0,0 +1,47 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Membership check resource, for authorization in other applications.
+"""
+
+from .base import *
+
+
+class GET_Check(CacheControlMixin, MethodMixin, GET):
+    """Is the account a member of the team, and is it an admin of it?
+    Cheap enough to be used for every request of another application."""
+
+    outreprs = [JsonRepresentation]
+
+    fields = (StringField('account', title='Account',
+                          descr='Name of the account.'),
+              StringField('team', title='Team',
+                          descr='Name of the team.'),
+              StringField('effective', title='Effective',
+                          descr="If 'true', then membership via nested"
+                          ' teams counts.'))
+
+    max_age = configuration.CHECK_MAX_AGE
+
+    def set_current(self, request):
+        "Set the names of the account and team to check."
+        values = self.parse_fields(request)
+        self.accountname = values.get('account')
+        self.teamname = values.get('team')
+        if not (self.accountname and self.teamname):
+            raise HTTP_BAD_REQUEST('account and team must be given')
+        self.effective = values.get('effective') == 'true'
+
+    def is_accessible(self):
+        return self.login['name'] == self.accountname or self.is_login_admin()
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        try:
+            result = self.db.check_membership(self.accountname,
+                                              self.teamname,
+                                              effective=self.effective)
+        except KeyError:
+            raise HTTP_NOT_FOUND
+        result['account'] = self.accountname
+        result['team'] = self.teamname
+        return result
@@ -0,0 +1,127 @@
+""" WhoYou: Simple accounts database for web applications.
+
+WSGI middleware compressing responses, and caching the bodies of
+the responses for the large lists of accounts and teams.
+"""
+
+import zlib
+
+from whoyou import configuration
+from whoyou.cache import LruCache
+from whoyou.database import get_shared_database
+
+
+# Content types of responses worth compressing.
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript')
+
+
+def accepts_gzip(environ):
+    "Does the client accept a gzip-encoded response?"
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = [p.strip() for p in item.split(';')]
+        if parts[0].lower() not in ('gzip', '*'): continue
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    pass
+        if quality > 0.0: return True
+    return False
+
+def gzip(body, level=configuration.COMPRESSION_LEVEL):
+    "Return the body compressed in gzip format."
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+class CompressionMiddleware(object):
+    """Compress the response by gzip, if the client accepts it, and if
+    the response is large enough and of a compressible content type.
+
+    The responses for the paths to cache are kept in a cache, keyed by
+    the database, the request (path, query, accepted content type and
+    encoding), and the directory version, which is the last sequence
+    number in the change log. A response is served from the cache until
+    something in the directory has changed. Only anonymous requests are
+    cached, since a response from the cache bypasses the authentication
+    and login throttling done by the application.
+    """
+
+    def __init__(self, application,
+                 paths=configuration.RESPONSE_CACHE_PATHS,
+                 min_size=configuration.COMPRESSION_MIN_SIZE):
+        self.application = application
+        self.paths = set(paths)
+        self.min_size = min_size
+        self.cache = response_cache
+
+    def __call__(self, environ, start_response):
+        encode = accepts_gzip(environ)
+        key = self.get_key(environ, encode)
+        if key is not None:
+            try:
+                status, headers, body = self.cache[key]
+            except KeyError:
+                pass
+            else:
+                start_response(status, headers)
+                return [body]
+        captured = []
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return lambda data: captured.append(data)
+        result = self.application(environ, capture)
+        try:
+            body = b''.join(captured[3:]) + b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers, exc_info = captured[:3]
+        if self.is_compressible(headers, body):
+            headers = [h for h in headers if h[0].lower() != 'vary']
+            headers.append(('Vary', 'Accept-Encoding'))
+            if encode:
+                body = gzip(body)
+                headers = [h for h in headers
+                           if h[0].lower() != 'content-length']
+                headers.append(('Content-Encoding', 'gzip'))
+                headers.append(('Content-Length', str(len(body))))
+        if key is not None and status.startswith('200'):
+            self.cache[key] = (status, headers, body)
+        start_response(status, headers, exc_info)
+        return [body]
+
+    def get_key(self, environ, encode):
+        """Return the cache key for the request, or None if the response
+        is not to be cached.
+        """
+        if environ.get('REQUEST_METHOD') != 'GET': return None
+        path = environ.get('PATH_INFO', '')
+        if path.rsplit('.', 1)[0] not in self.paths: return None
+        if environ.get('HTTP_AUTHORIZATION') or environ.get('HTTP_COOKIE'):
+            return None
+        db = get_shared_database()
+        return (db.path,
+                path,
+                environ.get('QUERY_STRING', ''),
+                environ.get('HTTP_ACCEPT', ''),
+                encode,
+                db.get_last_change())
+
+    def is_compressible(self, headers, body):
+        "Is the response worth compressing?"
+        if len(body) < self.min_size: return False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding': return False
+            if name == 'content-type':
+                if value.startswith(COMPRESSIBLE): return True
+        return False
+
+
+# The cached responses: (status, headers, body) by request and version.
+response_cache = LruCache(max_entries=configuration.RESPONSE_CACHE_ENTRIES,
+                          max_bytes=configuration.RESPONSE_CACHE_BYTES,
+                          sizeof=lambda response: len(response[2]))
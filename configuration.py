@@ -17,10 +17,111 @@ HOST = dict(title='SciLifeLab tools',
 
 DATA_DIR = '/var/local/whoyou'
 
+# The master database: None for the file 'master.sql3' in DATA_DIR,
+# or 'memory:NAME' for a temporary database file in MEMORY_DIR, for tests
+# and benchmarks; see 'database.get_database_file'.
+MASTER_DB = None
+
+# Directory for the temporary database files of 'memory:NAME' paths;
+# a file system in memory (tmpfs), so that no disk I/O is done.
+MEMORY_DIR = '/dev/shm'
+
 SALT = 'default123'
 
 MIN_PASSWORD_LENGTH = 6
 
+# Throttling of failed logins: number of failures allowed in a burst
+# per account name and per client address, the rate (per second) at
+# which further attempts become allowed, the maximum backoff (seconds),
+# and the maximum number of accounts and addresses tracked.
+LOGIN_ACCOUNT_BURST = 5
+LOGIN_ADDRESS_BURST = 50
+LOGIN_FAILURE_RATE = 0.1
+LOGIN_MAX_BACKOFF = 300
+LOGIN_THROTTLE_ENTRIES = 10000
+
+# Caches of Account and Team instances in each Database instance:
+# maximum number of entries and approximate total size (bytes), each.
+CACHE_ENTRIES = 5000
+CACHE_BYTES = 5000000
+
+# Cache of the names of nonexistent accounts and teams: maximum number
+# of entries, and the time-to-live (seconds) of an entry. The names may
+# be created by another process during this time.
+NEGATIVE_CACHE_ENTRIES = 10000
+NEGATIVE_CACHE_TTL = 10
+
+# Default and maximum number of items returned by search-type requests.
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 200
+
+# Maximum number of changes returned by one change log request,
+# and number of most recent changes kept by compaction.
+CHANGES_LIMIT = 1000
+CHANGES_KEEP = 100000
+
+# Should the 'interface' module read the snapshot file, if it exists,
+# instead of the database? It is produced by running 'snapshot.py'.
+# The database is read while the snapshot is stale, i.e. when there
+# have been changes since it was exported; re-export it regularly.
+SNAPSHOT = False
+
+# Number of threads doing database work for the 'async_interface' module.
+ASYNC_WORKERS = 4
+
+# Should all writes to the database by the threads of a process be done
+# by a single writer thread? If so, the maximum number of pending writes
+# committed together in one transaction.
+WRITER = False
+WRITER_GROUP = 100
+
+# Should the WSGI application load accounts, teams and memberships into
+# the caches in a background thread when starting? If so, the maximum
+# approximate size (bytes) of the data loaded; see also CACHE_BYTES.
+PRELOAD = False
+PRELOAD_BYTES = 4000000
+
+# Time (seconds) a client may cache the response of a membership check.
+CHECK_MAX_AGE = 10
+
+# Should the WSGI application compress responses by gzip, when accepted
+# by the client? If so, the compression level (1-9) and the minimum
+# size (bytes) of a response to compress. The responses to anonymous
+# requests for the paths below are then also cached.
+COMPRESSION = False
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SIZE = 1000
+
+# The paths whose responses are cached, until the directory changes,
+# and the maximum number of entries and total size (bytes) of the cache.
+RESPONSE_CACHE_PATHS = ('/accounts', '/teams')
+RESPONSE_CACHE_ENTRIES = 200
+RESPONSE_CACHE_BYTES = 20000000
+
+# Maintenance tasks, see 'maintenance.py': the number of pages copied,
+# or freed, in each step of the backup, or the incremental vacuum, the
+# pause (seconds) between steps, and the approximate number of rows
+# of each index examined by ANALYZE.
+BACKUP_PAGES = 100
+BACKUP_PAUSE = 0.05
+VACUUM_PAGES = 100
+VACUUM_PAUSE = 0.05
+ANALYSIS_LIMIT = 1000
+
+# The account property paths, such as 'myapp.admin', for which indexes
+# are created when the database is upgraded; see 'database.py'.
+PROPERTY_INDEXES = []
+
+# Must the email addresses of accounts be unique? They are compared
+# ignoring case. Takes effect for an existing database when upgraded.
+UNIQUE_EMAIL = False
+
+# Should the team memberships of each account, with the admin flags,
+# be kept also in a column of the account table, maintained by triggers?
+# An account and its teams are then read in a single-row lookup.
+# Takes effect for an existing database when upgraded.
+MEMBERSHIP_COLUMN = True
+
 
 #----------------------------------------------------------------------
 # Do not change anything below this.
@@ -49,4 +150,6 @@ SOURCE_DIR = os.path.dirname(__file__)
 STATIC_DIR = os.path.join(SOURCE_DIR, 'static')
 
 README_FILE = os.path.join(SOURCE_DIR, 'README.md')
-MASTER_DB_FILE = os.path.join(DATA_DIR, 'master.sql3')
+MASTER_DB_FILE = MASTER_DB or os.path.join(DATA_DIR, 'master.sql3')
+SNAPSHOT_FILE = os.path.join(DATA_DIR, 'snapshot.bin')
+BACKUP_FILE = os.path.join(DATA_DIR, 'backup.sql3')
@@ -3,50 +3,513 @@
 Interface to the database.
 """
 
+import os
+import re
+import sys
+import logging
 import sqlite3
 import json
 import hashlib
+import copy
+import time
+import shutil
+import atexit
+import tempfile
+import functools
+import threading
+import contextlib
 
-from wrapid.utils import rstr
+try:
+    unichr
+except NameError:                   # Python 3
+    unichr = chr
+
+try:
+    from wrapid.utils import rstr
+except ImportError:
+    # Without 'wrapid', as under Python 3: the decoded strings are kept.
+    def rstr(value):
+        return value
 
 from whoyou import configuration
+from whoyou.cache import LruCache, NegativeCache
+from whoyou.cache import missing_accounts, missing_teams
+from whoyou.writer import Writer
+
+
+# The version of the database schema, recorded as its 'user_version'.
+# Increase it when 'Database.upgrade' changes the schema, so that
+# databases created by earlier versions are upgraded when opened.
+SCHEMA_VERSION = 1
+
+# SQL statements modifying data; a transaction is begun before them.
+MODIFYING = frozenset(['INSERT', 'UPDATE', 'DELETE', 'REPLACE'])
+
+# Approximate memory size of an Account or Team instance, excluding
+# the contents of its string values; used for cache size limits.
+OVERHEAD = 1000
+
+# A key in a property path; see 'Database.find_accounts'.
+PROPERTY_KEY = re.compile(r'^[A-Za-z0-9_\-]+$')
+
+# The items of the account and team data dictionaries, which may be
+# selected by the 'fields' argument of 'get_data'. The effective items
+# are included by default only if the 'effective' argument is true.
+ACCOUNT_FIELDS = ('name', 'teams', 'effective_teams',
+                  'description', 'email', 'properties')
+TEAM_FIELDS = ('name', 'members', 'effective_members', 'admins',
+               'subteams', 'description', 'properties')
+
+# The JSON object of admin flags by team name, for the direct team
+# memberships of the account with the given id; for the denormalized
+# 'account.memberships' column, maintained by triggers.
+MEMBERSHIPS_JSON = ("(SELECT json_group_object(name, json(admin)) FROM"
+                    " (SELECT t.name AS name,"
+                    "  CASE at.admin WHEN 1 THEN 'true' ELSE 'false' END"
+                    "   AS admin"
+                    "  FROM account_team AS at, team AS t"
+                    "  WHERE at.account=%s AND t.id=at.team"
+                    "  ORDER BY t.name))")
+
+
+def get_fields(fields, allowed, effective):
+    """Return the set of field names to include in a data dictionary.
+    If fields is None, then all allowed fields, except the effective
+    one unless effective is true. Raise ValueError if invalid field.
+    """
+    if fields is None:
+        return set([f for f in allowed
+                    if effective or not f.startswith('effective_')])
+    fields = set(fields)
+    for field in fields:
+        if field not in allowed:
+            raise ValueError("invalid field '%s'" % field)
+    return fields
+
+
+def writes(method):
+    """Decorator for a method of Database, Account or Team modifying data.
+    The method is done by 'Database.write', which commits it.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if isinstance(self, Database):
+            db = self
+        else:
+            db = self.db
+        return db.write(method, self, *args, **kwargs)
+    return wrapper
+
+
+def normalize_email(email):
+    """Return the normalized email address, for the indexed column
+    'email_key'. Return None if no address.
+    """
+    return (email or '').strip().lower() or None
+
+def utf8(value):
+    "Return the string as bytes, encoding it in UTF-8 if it is unicode."
+    if isinstance(value, bytes): return value
+    return value.encode('utf-8')
+
+def check_text(value, label):
+    """Raise ValueError if the value is not a string, or not valid
+    as text in UTF-8.
+    """
+    if value is None:
+        raise ValueError("missing %s" % label)
+    if not isinstance(value, (bytes, type(u''))):
+        raise ValueError("%s is not a string" % label)
+    try:
+        if isinstance(value, bytes):
+            value.decode('utf-8')
+        else:
+            value.encode('utf-8')
+    except UnicodeError:
+        raise ValueError("%s is not valid UTF-8 text" % label)
+
+def check_account_row(row):
+    """Raise ValueError if the row of account data for 'create_accounts'
+    is invalid: the name and password must be given as text, the email
+    and description as text or null, and the teams as a list of names.
+    """
+    check_text(row.get('name'), 'name')
+    check_text(row.get('password'), 'password')
+    for key in ('email', 'description'):
+        if row.get(key) is not None:
+            check_text(row[key], key)
+    teams = row.get('teams') or []
+    if not isinstance(teams, list):
+        raise ValueError('teams is not a list')
+    for team in teams:
+        check_text(team, 'team name')
+
+def check_membership_operation(operation):
+    """Raise ValueError if the membership operation for 'edit_memberships'
+    is invalid: the team must be given as text, and the accounts as
+    a list of names.
+    """
+    if not isinstance(operation, dict):
+        raise ValueError('operation is not an object')
+    check_text(operation.get('team'), 'team name')
+    accounts = operation.get('accounts') or []
+    if not isinstance(accounts, list):
+        raise ValueError('accounts is not a list')
+    for name in accounts:
+        check_text(name, 'account name')
+
+def get_upper_bound(prefix):
+    """Return the least string greater than all strings starting with
+    the prefix, or None if there is no such string, as for a prefix of
+    only the maximum character.
+    """
+    if isinstance(prefix, bytes):
+        maximum, character = 0xff, lambda code: bytes(bytearray([code]))
+    else:
+        maximum, character = sys.maxunicode, unichr
+    while prefix:
+        code = ord(prefix[-1:]) + 1
+        if 0xd800 <= code <= 0xdfff:  # Surrogates are not characters.
+            code = 0xe000
+        if code <= maximum:
+            return prefix[:-1] + character(code)
+        prefix = prefix[:-1]
+    return None
+
+MEMORY_PREFIX = 'memory:'
+
+_memory_files = dict()
+_memory_lock = threading.Lock()
+
+def get_database_file(path):
+    """Return the name of the database file for the path. A path
+    'memory:NAME' denotes a temporary file in the directory given by
+    configuration.MEMORY_DIR, the same for the NAME in this process,
+    which is removed when the process ends. Raise ValueError if the
+    directory does not exist.
+    """
+    if not path.startswith(MEMORY_PREFIX): return path
+    with _memory_lock:
+        try:
+            return _memory_files[path]
+        except KeyError:
+            if not os.path.isdir(configuration.MEMORY_DIR):
+                raise ValueError("no directory '%s' for database '%s'"
+                                 % (configuration.MEMORY_DIR, path))
+            dirpath = tempfile.mkdtemp(prefix='whoyou-',
+                                       dir=configuration.MEMORY_DIR)
+            atexit.register(shutil.rmtree, dirpath, True)
+            filename = os.path.join(dirpath, 'master.sql3')
+            _memory_files[path] = filename
+            return filename
+
+def get_names_size(names):
+    "Return the approximate size of the list of names in memory, in bytes."
+    return 100 + sum([50 + len(n) for n in names])
 
 
 class Database(object):
-    "Interface to the WhoYou database."
+    """Interface to the WhoYou database.
+
+    Concurrency model: an open instance may be shared by all threads
+    in a process; see 'get_shared_database'. Each thread has its own
+    sqlite3 connection, opened when first needed, so each thread has
+    its own transactions. The caches of Account and Team instances
+    are shared by the threads, and are thread-safe. The cached
+    instances are also shared, so an instance should be modified only
+    just before it is saved. Changes made by other threads or processes
+    are picked up by 'refresh', which should be called at the start of
+    each request. Data read from a database state older than that of
+    the latest refresh is not put into the caches; see 'cache'.
+
+    The methods modifying data are done by 'write', optionally in
+    a single writer thread; see 'start_writer'.
 
-    def __init__(self, path=configuration.MASTER_DB_FILE):
-        self.path = path
+    The path 'memory:NAME' denotes a temporary database file in a file
+    system in memory; see 'get_database_file'.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or configuration.MASTER_DB_FILE
+        self.file = get_database_file(self.path)
+        self.local = threading.local()
+        self.is_open = False
+        self.writer = None
+        # Serializes the eviction of changes and the insertion into caches.
+        self.lock = threading.RLock()
 
     def open(self):
         assert not self.opened
-        self.cnx = sqlite3.connect(self.path)
-        self.cnx.text_factory = str
-        self.account_cache = dict()
-        self.team_cache = dict()
+        self.account_cache = LruCache(sizeof=Account.get_size)
+        self.team_cache = LruCache(sizeof=Team.get_size)
+        # The names of the teams each account is a direct member of.
+        self.membership_index = LruCache(sizeof=get_names_size)
+        self.last_change = None
+        self.is_open = True
+        if os.path.exists(self.file):
+            self.check_schema()
 
     def close(self):
+        """Close the connection of the current thread, and the database.
+        The writer thread, if started, is stopped.
+        """
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        self.close_connection()
+        self.is_open = False
+
+    def close_connection(self):
+        "Close the connection of the current thread, if opened."
         try:
-            self.cnx.close()
+            cnx = self.local.cnx
         except AttributeError:
             pass
         else:
-            del self.cnx
+            cnx.close()
+            del self.local.cnx
 
     @property
     def opened(self):
-        return hasattr(self, 'cnx')
+        return self.is_open
+
+    @property
+    def cnx(self):
+        "The connection of the current thread; opened when first needed."
+        try:
+            return self.local.cnx
+        except AttributeError:
+            # Transactions are handled explicitly; see 'execute'.
+            cnx = sqlite3.connect(self.file, isolation_level=None)
+            cnx.text_factory = str
+            cnx.execute('PRAGMA journal_mode=WAL')
+            self.local.cnx = cnx
+            self.local.transaction = False
+            self.local.writing = False
+            self.local.version = None
+            return cnx
+
+    def check_schema(self):
+        """Upgrade the database if it was created or upgraded by an earlier
+        version; see SCHEMA_VERSION. A database having no tables yet is
+        to be created, and is left as is.
+        """
+        if self.get_schema_version() >= SCHEMA_VERSION: return
+        self.write(self.upgrade_earlier)
+
+    def upgrade_earlier(self):
+        "Upgrade, unless done already by another process; see 'check_schema'."
+        version = self.get_schema_version()
+        if version >= SCHEMA_VERSION: return
+        if 'account' not in self.get_tables(): return
+        logging.warning("upgrading WhoYou database '%s' from version %s",
+                        self.path, version)
+        self.upgrade()
+
+    def get_schema_version(self):
+        return self.execute('PRAGMA user_version').fetchone()[0]
+
+    def refresh(self):
+        """Evict the cached instances changed since the last refresh,
+        according to the change log, and forget that the names created
+        since then were missing.
+        """
+        assert self.opened
+        last = self.get_last_change()
+        with self.lock:
+            since = self.last_change
+            if since is not None and last <= since: return
+            if since is not None:
+                self.evict_changes(since)
+            self.last_change = last
+
+    def cache(self, cache, key, value, version):
+        """Put the value into the cache, or the key into a cache of
+        missing names, if it was read from the database
+        state of the given change log sequence number, and that is not
+        older than the state of the latest refresh. The changes in between
+        have already been evicted, so an older value would remain stale.
+        Return True if the value was put into the cache.
+        """
+        with self.lock:
+            if not self.is_current(version): return False
+            if isinstance(cache, NegativeCache):
+                cache.add(key)
+            else:
+                cache[key] = value
+            return True
+
+    def is_current(self, version):
+        """Is the database state of the given change log sequence number
+        not older than the state of the latest refresh? A version of None
+        means data read within a transaction that is not a read snapshot,
+        which may contain changes not yet committed.
+        """
+        if version is None: return False
+        return self.last_change is None or version >= self.last_change
+
+    def evict_changes(self, since):
+        """Evict the cached data changed after the given sequence number
+        of the change log.
+        """
+        result = self.get_changes(since)
+        if result['resync'] or result['more']:
+            self.clear_caches()
+            missing_accounts.clear()
+            missing_teams.clear()
+        else:
+            for change in result['changes']:
+                if change['type'] == 'account':
+                    self.account_cache.pop(change['name'])
+                    if change['action'] == 'create':
+                        missing_accounts.discard((self.path, change['name']))
+                elif change['type'] == 'team':
+                    self.team_cache.pop(change['name'])
+                    if change['action'] == 'create':
+                        missing_teams.discard((self.path, change['name']))
+                elif change['type'] == 'membership':
+                    self.evict_memberships(change['name'])
+
+    def evict_memberships(self, name):
+        """Evict the cached memberships of the named account: its entry in
+        the membership index, and the Account instance, which holds the
+        denormalized memberships.
+        """
+        self.membership_index.pop(name)
+        self.account_cache.pop(name)
+
+    def evict(self, item):
+        "Remove the Account or Team instance from its cache."
+        if isinstance(item, Account):
+            self.account_cache.pop(item.name)
+        elif isinstance(item, Team):
+            self.team_cache.pop(item.name)
 
     def execute(self, sql, *values):
+        """Execute the SQL statement with the values.
+        A transaction is begun before a statement modifying data,
+        unless one is already in progress; it ends by 'commit'
+        or 'rollback'.
+        """
         assert self.opened
         cursor = self.cnx.cursor()
+        if sql.lstrip().split(None, 1)[0].upper() in MODIFYING:
+            self.begin('IMMEDIATE')
         cursor.execute(sql, values)
         return cursor
 
+    def executemany(self, sql, rows):
+        assert self.opened
+        cursor = self.cnx.cursor()
+        self.begin('IMMEDIATE')
+        cursor.executemany(sql, rows)
+        return cursor
+
+    def begin(self, mode='DEFERRED'):
+        "Begin a transaction in this thread, unless one is in progress."
+        cnx = self.cnx
+        if self.local.transaction: return
+        cnx.execute("BEGIN %s" % mode)
+        self.local.transaction = True
+
     def commit(self):
+        "Commit the transaction, unless within 'write', which commits."
         assert self.opened
-        self.cnx.commit()
+        cnx = self.cnx
+        if not self.local.transaction or self.local.writing: return
+        self.local.transaction = False
+        self.local.version = None
+        cnx.execute('COMMIT')
 
+    def rollback(self):
+        "Roll back the transaction, unless within 'write', which does it."
+        assert self.opened
+        cnx = self.cnx
+        if not self.local.transaction or self.local.writing: return
+        self.local.transaction = False
+        self.local.version = None
+        try:
+            cnx.execute('ROLLBACK')
+        except sqlite3.OperationalError:  # Already rolled back by SQLite.
+            pass
+
+    def write(self, function, *args, **kwargs):
+        """Call the function modifying data with the arguments,
+        and return its result. It is committed if it succeeds, and
+        rolled back if it raises an exception. A call within another
+        is part of the latter's transaction.
+        If the writer thread has been started, then the function is
+        called in it; this thread waits until it has been committed.
+        """
+        assert self.opened
+        self.cnx
+        if self.local.writing:
+            return function(*args, **kwargs)
+        if self.writer is not None:
+            return self.writer.call(function, args, kwargs)
+        self.begin('IMMEDIATE')
+        self.local.writing = True
+        try:
+            result = function(*args, **kwargs)
+        except:
+            self.local.writing = False
+            self.rollback()
+            raise
+        self.local.writing = False
+        self.commit()
+        return result
+
+    def start_writer(self):
+        """Start the thread doing all writes for this instance, in order,
+        committing the writes pending at the same time together.
+        This avoids contention for the database lock between threads.
+        """
+        assert self.opened
+        if self.writer is not None: return
+        self.writer = Writer(self)
+        self.writer.start()
+
+    def begin_read(self):
+        """Begin a read transaction in this thread, unless a transaction
+        is in progress. In WAL mode, all queries until 'commit' or
+        'rollback' see the database as it was at the first query,
+        without blocking, or being blocked by, writers.
+        Note that Account and Team instances obtained from the caches
+        reflect the state at the time of the latest 'refresh'.
+        The change log sequence number of the snapshot is recorded;
+        see 'get_read_version'.
+        """
+        assert self.opened
+        self.cnx
+        if self.local.transaction: return
+        self.begin('DEFERRED')
+        # The first query of the transaction establishes the snapshot.
+        self.local.version = self.get_last_change()
+
+    def get_read_version(self):
+        """Return the change log sequence number of the read snapshot
+        of this thread, or None if not in one; see 'begin_read'.
+        """
+        self.cnx
+        return self.local.version
+
+    @contextlib.contextmanager
+    def read_snapshot(self):
+        """Context manager for a read transaction; see 'begin_read'.
+        Does nothing if a transaction is already in progress.
+        """
+        assert self.opened
+        self.cnx
+        if self.local.transaction:
+            yield self
+        else:
+            self.begin_read()
+            try:
+                yield self
+            finally:
+                self.rollback()
+
+    @writes
     def create_account(self, name, password=None, description=None):
         try:
             self.get_account(name)
@@ -62,15 +525,108 @@ class Database(object):
         account.save()
         return account
 
+    @writes
+    def create_accounts(self, rows, errors=None):
+        """Create the accounts given as dictionaries (name, password,
+        email, description, teams) in a single transaction.
+        The errors dictionary gives the rows already known to be invalid,
+        by index. A row with invalid data, see 'check_account_row', for
+        an account that already exists, or giving a team that does not
+        exist, is not created.
+        Return a list of dictionaries (name, status, message),
+        one for each row. The status is 'ok' or 'error'.
+        """
+        assert self.opened
+        errors = errors or dict()
+        results = []
+        valid = []
+        for index, row in enumerate(rows):
+            message = errors.get(index)
+            if not message:
+                try:
+                    check_account_row(row)
+                except ValueError as error:
+                    message = str(error)
+                else:
+                    valid.append(row)
+            results.append(dict(name=row.get('name'),
+                                status='error',
+                                message=message))
+        existing = self.get_ids('account', [r['name'] for r in valid])
+        teamids = self.get_ids('team', set([t for r in valid
+                                            for t in r.get('teams') or []]))
+        if configuration.UNIQUE_EMAIL:
+            emails = self.get_email_keys([r.get('email') for r in valid])
+        else:
+            emails = set()
+        created = []
+        seen = set()
+        for row, result in zip(rows, results):
+            if result['message']: continue
+            name = row['name']
+            if name in existing or name in seen:
+                result['message'] = "account '%s' already exists" % name
+                continue
+            missing = [t for t in row.get('teams') or [] if t not in teamids]
+            if missing:
+                result['message'] = "no such Team '%s'" % missing[0]
+                continue
+            email = normalize_email(row.get('email'))
+            if email in emails:
+                result['message'] = "email address '%s' already in use" % \
+                                    row['email']
+                continue
+            if email and configuration.UNIQUE_EMAIL:
+                emails.add(email)
+            seen.add(name)
+            result['status'] = 'ok'
+            created.append(row)
+        # The password hashing is cheap (salted MD5), so it is done here
+        # rather than in a pool of workers.
+        self.executemany('INSERT INTO account'
+                         ' (name,password,description,email,email_key,'
+                         '  properties)'
+                         ' VALUES(?,?,?,?,?,?)',
+                         [(r['name'],
+                           Account.get_password_hexdigest(r['password']),
+                           r.get('description') or None,
+                           r.get('email') or None,
+                           normalize_email(r.get('email')),
+                           json.dumps(dict()))
+                          for r in created])
+        accountids = self.get_ids('account', [r['name'] for r in created])
+        self.executemany('INSERT INTO account_team (account, team, admin)'
+                         ' VALUES(?,?,0)',
+                         [(accountids[r['name']], teamids[t])
+                          for r in created
+                          for t in set(r.get('teams') or [])])
+        self.executemany('INSERT INTO change_log (type, name, action)'
+                         " VALUES ('account',?,'create')",
+                         [(r['name'],) for r in created])
+        self.executemany('INSERT INTO change_log'
+                         ' (type, name, team, action)'
+                         " VALUES ('membership',?,?,'add')",
+                         [(r['name'], t)
+                          for r in created
+                          for t in set(r.get('teams') or [])])
+        for row in created:
+            missing_accounts.discard((self.path, row['name']))
+        return results
+
     def get_accounts(self):
         "Return list of all accounts."
         assert self.opened
         cursor = self.execute('SELECT name FROM account ORDER BY name')
         result = []
         for record in cursor:
-            result.append(self.get_account(record[0]))
+            result.append(self.load_account(record[0]))
         return result
 
+    def get_account_names(self, prefix='', limit=configuration.DEFAULT_LIMIT):
+        "Return the sorted list of account names starting with the prefix."
+        assert self.opened
+        return self.get_names('account', prefix, limit)
+
     def get_account(self, name, password=None):
         """Return the Account instance.
         If the password is given, then authenticate.
@@ -81,12 +637,72 @@ class Database(object):
         try:
             account = self.account_cache[name]
         except KeyError:
-            account = Account(self, name=name)
-            self.account_cache[account.name] = account
+            if (self.path, name) in missing_accounts:
+                raise KeyError("no such Account '%s'" % name)
+            account = self.load_account(name)
         if password:
             account.check_password(password)
         return account
 
+    def get_account_by_email(self, email, password=None):
+        """Return the Account instance having the email address,
+        which is normalized. This is an indexed lookup.
+        If the password is given, then authenticate.
+        Raise KeyError if no such account.
+        Raise ValueError if several accounts have the email address,
+        or incorrect password.
+        """
+        assert self.opened
+        cursor = self.execute('SELECT name FROM account WHERE email_key=?'
+                              ' LIMIT 2',
+                              normalize_email(email))
+        names = [str(r[0]) for r in cursor]
+        if not names:
+            raise KeyError("no Account with email address '%s'" % email)
+        if len(names) > 1:
+            raise ValueError("several Accounts with email address '%s'"
+                             % email)
+        account = self.load_account(names[0])
+        if password:
+            account.check_password(password)
+        return account
+
+    def get_email_keys(self, emails):
+        """Return the set of the given email addresses, normalized,
+        which are in use by accounts.
+        """
+        keys = list(set([normalize_email(e) for e in emails if e]))
+        result = set()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start+500]
+            cursor = self.execute("SELECT email_key FROM account"
+                                  " WHERE email_key IN (%s)" %
+                                  ','.join('?' * len(chunk)),
+                                  *chunk)
+            result.update([str(r[0]) for r in cursor])
+        return result
+
+    def load_account(self, name):
+        """Return the Account instance, from the cache or the database.
+        This does not use the cache of missing names; it is for names
+        just obtained from the database.
+        Raise KeyError if no such account.
+        """
+        try:
+            return self.account_cache[name]
+        except KeyError:
+            with self.read_snapshot():
+                version = self.get_read_version()
+                try:
+                    account = Account(self, name=name)
+                except KeyError:
+                    self.cache(missing_accounts, (self.path, name), None,
+                               version)
+                    raise
+            self.cache(self.account_cache, account.name, account, version)
+            return account
+
+    @writes
     def create_team(self, name, description=None):
         try:
             self.get_team(name)
@@ -106,9 +722,72 @@ class Database(object):
         cursor = self.execute('SELECT name FROM team ORDER BY name')
         result = []
         for record in cursor:
-            result.append(self.get_team(record[0]))
+            result.append(self.load_team(record[0]))
+        return result
+
+    def get_team_summaries(self):
+        """Return a list of dictionaries (name, description, member_count,
+        admin_count) for all teams, without looking up the members.
+        """
+        assert self.opened
+        cursor = self.execute('SELECT name, description,'
+                              ' member_count, admin_count'
+                              ' FROM team ORDER BY name')
+        return [dict(name=str(r[0]),
+                     description=r[1],
+                     member_count=r[2],
+                     admin_count=r[3]) for r in cursor]
+
+    def get_admin_flags(self, team=None):
+        """Return a dictionary of the admin flags of the members of all
+        teams, or of the given team, by team name and account name;
+        looked up by a single query rather than one per member.
+        """
+        assert self.opened
+        sql = ('SELECT t.name, a.name, at.admin'
+               ' FROM account_team AS at'
+               ' JOIN account AS a ON a.id=at.account'
+               ' JOIN team AS t ON t.id=at.team')
+        if team is None:
+            cursor = self.execute(sql)
+        else:
+            cursor = self.execute(sql + ' WHERE at.team=?', team.id)
+        result = dict()
+        for record in cursor:
+            result.setdefault(str(record[0]), dict())[str(record[1])] = \
+                bool(record[2])
         return result
 
+    def get_team_names(self, prefix='', limit=configuration.DEFAULT_LIMIT):
+        "Return the sorted list of team names starting with the prefix."
+        assert self.opened
+        return self.get_names('team', prefix, limit)
+
+    def get_names(self, table, prefix, limit):
+        """Return the sorted list of names in the table (account or team)
+        starting with the prefix. The range condition uses the index
+        of the unique name column.
+        """
+        upper = get_upper_bound(prefix)
+        if upper is not None:
+            cursor = self.execute("SELECT name FROM %s"
+                                  " WHERE name>=? AND name<?"
+                                  " ORDER BY name LIMIT ?" % table,
+                                  prefix,
+                                  upper,
+                                  limit)
+        elif prefix:
+            # All names not less than the prefix start with it.
+            cursor = self.execute("SELECT name FROM %s WHERE name>=?"
+                                  " ORDER BY name LIMIT ?" % table,
+                                  prefix,
+                                  limit)
+        else:
+            cursor = self.execute("SELECT name FROM %s"
+                                  " ORDER BY name LIMIT ?" % table,
+                                  limit)
+        return [str(r[0]) for r in cursor]
+
     def get_team(self, name):
         """Return the Team instance for the name.
         Raise KeyError if no such team.
@@ -117,16 +796,446 @@ class Database(object):
         try:
             return self.team_cache[name]
         except KeyError:
-            team = Team(self, name=name)
-            self.team_cache[team.name] = team
+            if (self.path, name) in missing_teams:
+                raise KeyError("no such Team '%s'" % name)
+            return self.load_team(name)
+
+    def load_team(self, name):
+        """Return the Team instance, from the cache or the database.
+        This does not use the cache of missing names; it is for names
+        just obtained from the database.
+        Raise KeyError if no such team.
+        """
+        try:
+            return self.team_cache[name]
+        except KeyError:
+            with self.read_snapshot():
+                version = self.get_read_version()
+                try:
+                    team = Team(self, name=name)
+                except KeyError:
+                    self.cache(missing_teams, (self.path, name), None,
+                               version)
+                    raise
+            self.cache(self.team_cache, team.name, team, version)
             return team
 
+    def check_membership(self, accountname, teamname, effective=False):
+        """Return a dictionary (member, admin) telling whether the account
+        is a member of the team, and whether it is an admin of it.
+        If effective is true, then membership via nested teams counts.
+        This is a single indexed lookup, or none if the membership index
+        shows that the account is not a direct member.
+        Raise KeyError if no such account or team.
+        """
+        assert self.opened
+        if not effective:
+            try:
+                names = self.membership_index[accountname]
+            except KeyError:
+                pass
+            else:
+                if teamname not in names:
+                    self.get_team(teamname)
+                    return dict(member=False, admin=False)
+        cursor = self.execute('SELECT at.admin, ate.account IS NOT NULL'
+                              ' FROM account AS a CROSS JOIN team AS t'
+                              ' LEFT JOIN account_team AS at'
+                              '  ON at.account=a.id AND at.team=t.id'
+                              ' LEFT JOIN account_team_effective AS ate'
+                              '  ON ate.account=a.id AND ate.team=t.id'
+                              ' WHERE a.name=? AND t.name=?',
+                              accountname,
+                              teamname)
+        record = cursor.fetchone()
+        if not record:
+            self.get_account(accountname)
+            raise KeyError("no such Team '%s'" % teamname)
+        if effective:
+            member = bool(record[1])
+        else:
+            member = record[0] is not None
+        return dict(member=member, admin=record[0] == 1)
+
+    def get_ids(self, table, names):
+        """Return a dictionary of the ids for the given names
+        in the table (account or team). Missing names are not included.
+        """
+        result = dict()
+        names = list(names)
+        for start in range(0, len(names), 500):
+            chunk = names[start:start+500]
+            cursor = self.execute("SELECT name, id FROM %s"
+                                  " WHERE name IN (%s)" %
+                                  (table, ','.join('?' * len(chunk))),
+                                  *chunk)
+            result.update([(str(r[0]), r[1]) for r in cursor])
+        return result
+
+    @writes
+    def edit_memberships(self, operations):
+        """Apply the membership operations in a single transaction.
+        Each operation is a dictionary containing items:
+        - action: 'add', 'remove', 'promote' (make admin) or 'demote'
+        - team: name of the team
+        - accounts: list of account names
+        Return a list of dictionaries (action, team, account, status,
+        message), one for each account in each operation. The status is
+        'ok', 'unchanged' or 'error'. An error for one item does not
+        prevent the others from being applied. An invalid operation,
+        see 'check_membership_operation', gives one error result.
+        """
+        assert self.opened
+        results = []
+        for operation in operations:
+            results.extend(self.edit_membership(operation))
+        return results
+
+    def edit_membership(self, operation):
+        """Apply one membership operation; see 'edit_memberships'.
+        An invalid operation gives a single error result.
+        """
+        try:
+            check_membership_operation(operation)
+        except ValueError as error:
+            if not isinstance(operation, dict):
+                operation = dict()
+            return [dict(action=operation.get('action'),
+                         team=operation.get('team'),
+                         account=None,
+                         status='error',
+                         message=str(error))]
+        action = operation.get('action')
+        teamname = operation.get('team')
+        accountnames = list(operation.get('accounts') or [])
+        results = [dict(action=action, team=teamname, account=name,
+                        status='error', message=None)
+                   for name in accountnames]
+        if action not in ('add', 'remove', 'promote', 'demote'):
+            for result in results:
+                result['message'] = "invalid action '%s'" % action
+            return results
+        cursor = self.execute('SELECT id FROM team WHERE name=?', teamname)
+        record = cursor.fetchone()
+        if not record:
+            for result in results:
+                result['message'] = "no such Team '%s'" % teamname
+            return results
+        teamid = record[0]
+        accountids = self.get_ids('account', accountnames)
+        current = dict()            # Account id -> admin flag
+        ids = list(accountids.values())
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start+500]
+            cursor = self.execute('SELECT account, admin FROM account_team'
+                                  ' WHERE team=? AND account IN (%s)' %
+                                  ','.join('?' * len(chunk)),
+                                  teamid,
+                                  *chunk)
+            current.update([(r[0], bool(r[1])) for r in cursor])
+        changed = []
+        for result in results:
+            try:
+                accountid = accountids[result['account']]
+            except KeyError:
+                result['message'] = "no such Account '%s'" % result['account']
+                continue
+            if action == 'add':
+                status = accountid not in current
+            elif action == 'remove':
+                status = accountid in current
+            elif accountid not in current:
+                result['message'] = 'not a member'
+                continue
+            else:
+                status = current[accountid] != (action == 'promote')
+            if status:
+                result['status'] = 'ok'
+                if action == 'remove':
+                    del current[accountid]
+                else:
+                    current[accountid] = action == 'promote'
+                changed.append((accountid, result['account']))
+            else:
+                result['status'] = 'unchanged'
+        if action == 'add':
+            self.executemany('INSERT INTO account_team (account, team, admin)'
+                             ' VALUES(?,?,0)',
+                             [(c[0], teamid) for c in changed])
+            logaction = 'add'
+        elif action == 'remove':
+            self.executemany('DELETE FROM account_team'
+                             ' WHERE account=? AND team=?',
+                             [(c[0], teamid) for c in changed])
+            logaction = 'remove'
+        else:
+            self.executemany('UPDATE account_team SET admin=?'
+                             ' WHERE account=? AND team=?',
+                             [(int(action == 'promote'), c[0], teamid)
+                              for c in changed])
+            logaction = 'update'
+        self.executemany('INSERT INTO change_log (type, name, team, action)'
+                         " VALUES ('membership',?,?,?)",
+                         [(c[1], teamname, logaction) for c in changed])
+        for accountid, name in changed:
+            self.evict_memberships(name)
+        return results
+
+    def get_cache_stats(self):
+        "Return a dictionary with the statistics for the caches."
+        return dict(accounts=self.account_cache.get_stats(),
+                    teams=self.team_cache.get_stats(),
+                    memberships=self.membership_index.get_stats())
+
+    def preload(self, max_bytes=configuration.PRELOAD_BYTES):
+        """Load teams, accounts and the membership index into the caches,
+        in bulk, until their approximate total size reaches max_bytes.
+        Items already in the caches are not replaced. The changes made
+        while loading are evicted afterwards.
+        Return a dictionary with the numbers of items loaded.
+        """
+        assert self.opened
+        started = time.time()
+        result = dict(teams=0, accounts=0, memberships=0, bytes=0)
+        with self.read_snapshot():
+            since = self.get_last_change()
+            cursor = self.execute('SELECT name,id,description,properties'
+                                  ' FROM team ORDER BY name')
+            for record in cursor:
+                if record[0] in self.team_cache: continue
+                team = Team(self)
+                team.set_record(record[0], record[1:])
+                result['bytes'] += team.size
+                if result['bytes'] > max_bytes: break
+                self.team_cache[team.name] = team
+                result['teams'] += 1
+            cursor = self.execute('SELECT name,id,password,description,email,'
+                                  ' properties,memberships FROM account'
+                                  ' ORDER BY name')
+            for record in cursor:
+                if record[0] in self.account_cache: continue
+                account = Account(self)
+                account.set_record(record[0], record[1:])
+                result['bytes'] += account.size
+                if result['bytes'] > max_bytes: break
+                self.account_cache[account.name] = account
+                result['accounts'] += 1
+            cursor = self.execute('SELECT a.name, t.name'
+                                  ' FROM account AS a, account_team AS at,'
+                                  '  team AS t'
+                                  ' WHERE a.id=at.account AND t.id=at.team'
+                                  ' ORDER BY a.name, t.name')
+            memberships = dict()
+            for record in cursor:
+                memberships.setdefault(str(record[0]), []).append(
+                    str(record[1]))
+            for name, teamnames in memberships.items():
+                if name in self.membership_index: continue
+                result['bytes'] += get_names_size(teamnames)
+                if result['bytes'] > max_bytes: break
+                self.membership_index[name] = teamnames
+                result['memberships'] += 1
+        self.evict_changes(since)
+        result['seconds'] = round(time.time() - started, 3)
+        return result
+
+    def log_change(self, type, name, action, team=None):
+        """Record a change in the change log. Not committed here;
+        it is part of the transaction making the change.
+        - type: 'account', 'team', 'membership' or 'subteam'
+        - name: the account, or the subteam, changed
+        - action: 'create', 'update', 'add' or 'remove'
+        - team: the team, for membership and subteam changes
+        """
+        self.execute('INSERT INTO change_log (type, name, team, action)'
+                     ' VALUES(?,?,?,?)',
+                     type,
+                     name,
+                     team,
+                     action)
+
+    def get_last_change(self):
+        "Return the sequence number of the last change; 0 if none."
+        try:
+            cursor = self.execute("SELECT seq FROM sqlite_sequence"
+                                  " WHERE name='change_log'")
+        except sqlite3.OperationalError:  # Database not yet created.
+            return 0
+        record = cursor.fetchone()
+        return record and record[0] or 0
+
+    def get_changes(self, since=0, limit=configuration.CHANGES_LIMIT):
+        """Return the changes after the given sequence number.
+        The result is a dictionary containing items:
+        - changes: list of dictionaries (seq, type, name, team,
+          action, timestamp), in order
+        - last: the sequence number to give as 'since' the next time
+        - more: True if there are more changes than the limit
+        - resync: True if changes after 'since' have been compacted
+          away; reload all data, then continue from 'last'
+        """
+        assert self.opened
+        last = self.get_last_change()
+        cursor = self.execute('SELECT MIN(seq) FROM change_log')
+        first = cursor.fetchone()[0]
+        if first is None:
+            horizon = last
+        else:
+            horizon = first - 1
+        if since < horizon:
+            return dict(changes=[], last=last, more=False, resync=True)
+        cursor = self.execute('SELECT seq, type, name, team, action,'
+                              ' timestamp FROM change_log WHERE seq>?'
+                              ' ORDER BY seq LIMIT ?',
+                              since,
+                              limit + 1)
+        changes = [dict(seq=r[0], type=r[1], name=r[2], team=r[3],
+                        action=r[4], timestamp=r[5]) for r in cursor]
+        more = len(changes) > limit
+        if more:
+            changes = changes[:limit]
+        if changes:
+            last = changes[-1]['seq']
+        return dict(changes=changes, last=last, more=more, resync=False)
+
+    @writes
+    def compact_changes(self, keep=configuration.CHANGES_KEEP):
+        "Delete all but the given number of most recent changes."
+        assert self.opened
+        self.execute('DELETE FROM change_log WHERE seq<=?',
+                     self.get_last_change() - keep)
+
+    def clear_caches(self):
+        "Clear the caches of Account and Team instances, and memberships."
+        self.account_cache.clear()
+        self.team_cache.clear()
+        self.membership_index.clear()
+
     def save(self, item):
         "Save the instance (Account or Team)."
         item.save(self)
 
+    def search(self, terms, limit=configuration.DEFAULT_LIMIT):
+        """Return a list of dictionaries (type, name) for the accounts
+        and teams matching the search terms, best match first.
+        Each word in the terms is a prefix of a word in the name,
+        email or description of the item.
+        """
+        assert self.opened
+        query = self.get_search_query(terms)
+        if not query: return []
+        cursor = self.execute("SELECT 'account', name,"
+                              " bm25(account_search, 10.0, 5.0, 1.0) AS rank"
+                              " FROM account_search"
+                              " WHERE account_search MATCH ?"
+                              " UNION ALL"
+                              " SELECT 'team', name,"
+                              " bm25(team_search, 10.0, 1.0) AS rank"
+                              " FROM team_search WHERE team_search MATCH ?"
+                              " ORDER BY rank LIMIT ?",
+                              query,
+                              query,
+                              limit)
+        return [dict(type=r[0], name=str(r[1])) for r in cursor]
+
+    @staticmethod
+    def get_search_query(terms):
+        """Convert the search terms to an FTS5 query matching
+        all words as prefixes. Return None if no words in the terms.
+        """
+        if isinstance(terms, bytes):
+            terms = terms.decode('utf-8', 'replace')
+        separators = re.compile(r'[\W_]+', re.UNICODE)
+        words = [w for w in separators.split(terms or '') if w]
+        if not words: return None
+        query = ' '.join(['"%s"*' % w for w in words])
+        if str is bytes:        # Python 2; the connection's text is str.
+            query = query.encode('utf-8')
+        return query
+
+    def find_accounts(self, path, value):
+        """Return the sorted list of names of the accounts having the value
+        at the path in their properties; e.g. the path 'myapp.admin' for
+        the item properties['myapp']['admin']. The value None matches
+        a null or missing item. The accounts are scanned by an index,
+        if one has been created for the path; see 'create_property_index'.
+        Raise ValueError if invalid path, or if the value is a list or
+        dictionary, which cannot be compared.
+        """
+        assert self.opened
+        expression = self.get_property_expression(path)
+        if isinstance(value, (list, tuple, dict)):
+            raise ValueError('the value must be a string, number,'
+                             ' boolean or None')
+        if value is None:
+            cursor = self.execute('SELECT name FROM account'
+                                  ' WHERE %s IS NULL ORDER BY name'
+                                  % expression)
+        else:
+            if isinstance(value, bool):     # JSON true and false.
+                value = int(value)
+            cursor = self.execute('SELECT name FROM account'
+                                  ' WHERE %s=? ORDER BY name' % expression,
+                                  value)
+        return [str(r[0]) for r in cursor]
+
+    @staticmethod
+    def get_property_expression(path):
+        """Return the SQL expression for the item at the property path.
+        The path is part of the expression, rather than a parameter,
+        so that it can match the expression of an index.
+        Raise ValueError if invalid path.
+        """
+        keys = (path or '').split('.')
+        for key in keys:
+            if not PROPERTY_KEY.match(key):
+                raise ValueError("invalid property path '%s'" % path)
+        return "json_extract(properties, '$.%s')" % \
+            '.'.join(['"%s"' % k for k in keys])
+
+    def create_property_index(self, path):
+        """Create the index for finding accounts by the property path,
+        unless done already. Writers are locked out while it is built.
+        Raise ValueError if invalid path.
+        """
+        assert self.opened
+        expression = self.get_property_expression(path)
+        self.execute('CREATE INDEX IF NOT EXISTS %s ON account (%s)' %
+                     (self.get_property_index_name(path), expression))
+
+    def drop_property_index(self, path):
+        """Drop the index for finding accounts by the property path,
+        if it exists. Raise ValueError if invalid path.
+        """
+        assert self.opened
+        self.get_property_expression(path)
+        self.execute('DROP INDEX IF EXISTS %s' %
+                     self.get_property_index_name(path))
+
+    @staticmethod
+    def get_property_index_name(path):
+        "Return the name of the index for the property path."
+        return 'account_property_' + hashlib.md5(utf8(path)).hexdigest()[:16]
+
+    def get_property_indexes(self):
+        "Return the sorted list of the property paths having an index."
+        assert self.opened
+        cursor = self.execute("SELECT sql FROM sqlite_master"
+                              " WHERE type='index' AND tbl_name='account'"
+                              " AND name GLOB 'account_property_*'")
+        result = []
+        for record in cursor:
+            match = re.search(r"'\$\.([^']+)'", record[0])
+            if match:
+                result.append(match.group(1).replace('"', ''))
+        return sorted(result)
+
     def create(self):
         assert self.opened
+        # Allows free pages to be released in small steps while in use;
+        # see 'maintenance.py'. The VACUUM is instantaneous when empty.
+        self.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.execute('VACUUM')
         self.execute('CREATE TABLE account'
                      '(id INTEGER PRIMARY KEY,'
                      ' name TEXT UNIQUE NOT NULL,'
@@ -146,6 +1255,247 @@ class Database(object):
                      '  ON DELETE RESTRICT,'
                      ' admin INTEGER,'
                      ' UNIQUE (account, team))')
+        self.upgrade()
+
+    def upgrade(self):
+        """Create the tables, indexes and triggers missing in the database.
+        Allows an existing database to be updated to the current version.
+        """
+        assert self.opened
+        tables = self.get_tables()
+        self.execute('CREATE VIRTUAL TABLE IF NOT EXISTS account_search'
+                     ' USING fts5(name, email, description,'
+                     "  content='account', content_rowid='id',"
+                     "  prefix='2 3')")
+        self.execute('CREATE TRIGGER IF NOT EXISTS account_search_insert'
+                     ' AFTER INSERT ON account BEGIN'
+                     ' INSERT INTO account_search'
+                     '  (rowid, name, email, description)'
+                     '  VALUES (new.id, new.name, new.email, new.description);'
+                     ' END')
+        self.execute('CREATE TRIGGER IF NOT EXISTS account_search_delete'
+                     ' AFTER DELETE ON account BEGIN'
+                     ' INSERT INTO account_search'
+                     '  (account_search, rowid, name, email, description)'
+                     "  VALUES ('delete', old.id, old.name, old.email,"
+                     '   old.description);'
+                     ' END')
+        self.execute('CREATE TRIGGER IF NOT EXISTS account_search_update'
+                     ' AFTER UPDATE OF name, email, description ON account'
+                     ' BEGIN'
+                     ' INSERT INTO account_search'
+                     '  (account_search, rowid, name, email, description)'
+                     "  VALUES ('delete', old.id, old.name, old.email,"
+                     '   old.description);'
+                     ' INSERT INTO account_search'
+                     '  (rowid, name, email, description)'
+                     '  VALUES (new.id, new.name, new.email, new.description);'
+                     ' END')
+        self.execute('CREATE VIRTUAL TABLE IF NOT EXISTS team_search'
+                     ' USING fts5(name, description,'
+                     "  content='team', content_rowid='id',"
+                     "  prefix='2 3')")
+        self.execute('CREATE TRIGGER IF NOT EXISTS team_search_insert'
+                     ' AFTER INSERT ON team BEGIN'
+                     ' INSERT INTO team_search (rowid, name, description)'
+                     '  VALUES (new.id, new.name, new.description);'
+                     ' END')
+        self.execute('CREATE TRIGGER IF NOT EXISTS team_search_delete'
+                     ' AFTER DELETE ON team BEGIN'
+                     ' INSERT INTO team_search'
+                     '  (team_search, rowid, name, description)'
+                     "  VALUES ('delete', old.id, old.name, old.description);"
+                     ' END')
+        self.execute('CREATE TRIGGER IF NOT EXISTS team_search_update'
+                     ' AFTER UPDATE OF name, description ON team BEGIN'
+                     ' INSERT INTO team_search'
+                     '  (team_search, rowid, name, description)'
+                     "  VALUES ('delete', old.id, old.name, old.description);"
+                     ' INSERT INTO team_search (rowid, name, description)'
+                     '  VALUES (new.id, new.name, new.description);'
+                     ' END')
+        if 'account_search' not in tables:
+            self.execute("INSERT INTO account_search (account_search)"
+                         " VALUES ('rebuild')")
+        if 'team_search' not in tables:
+            self.execute("INSERT INTO team_search (team_search)"
+                         " VALUES ('rebuild')")
+        # Nested teams: direct team-in-team membership, its transitive
+        # closure (including each team itself), and the resulting
+        # effective account memberships. The closure is maintained by
+        # Team.add_subteam and Team.remove_subteam, the effective
+        # memberships by the triggers on account_team.
+        self.execute('CREATE TABLE IF NOT EXISTS team_team'
+                     '(parent INTEGER NOT NULL REFERENCES team(id),'
+                     ' child INTEGER NOT NULL REFERENCES team(id),'
+                     ' PRIMARY KEY (parent, child))')
+        self.execute('CREATE INDEX IF NOT EXISTS team_team_child'
+                     ' ON team_team (child)')
+        self.execute('CREATE TABLE IF NOT EXISTS team_closure'
+                     '(ancestor INTEGER NOT NULL,'
+                     ' descendant INTEGER NOT NULL,'
+                     ' PRIMARY KEY (ancestor, descendant)) WITHOUT ROWID')
+        self.execute('CREATE INDEX IF NOT EXISTS team_closure_descendant'
+                     ' ON team_closure (descendant, ancestor)')
+        self.execute('CREATE TABLE IF NOT EXISTS account_team_effective'
+                     '(account INTEGER NOT NULL,'
+                     ' team INTEGER NOT NULL,'
+                     ' PRIMARY KEY (account, team)) WITHOUT ROWID')
+        self.execute('CREATE INDEX IF NOT EXISTS account_team_effective_team'
+                     ' ON account_team_effective (team, account)')
+        self.execute('CREATE TRIGGER IF NOT EXISTS team_closure_insert'
+                     ' AFTER INSERT ON team BEGIN'
+                     ' INSERT INTO team_closure (ancestor, descendant)'
+                     '  VALUES (new.id, new.id);'
+                     ' END')
+        self.execute('CREATE TRIGGER IF NOT EXISTS'
+                     ' account_team_effective_insert AFTER INSERT ON account_team BEGIN'
+                     ' INSERT OR IGNORE INTO account_team_effective'
+                     '  (account, team)'
+                     '  SELECT new.account, ancestor FROM team_closure'
+                     '  WHERE descendant=new.team;'
+                     ' END')
+        self.execute('CREATE TRIGGER IF NOT EXISTS'
+                     ' account_team_effective_delete AFTER DELETE ON account_team BEGIN'
+                     ' DELETE FROM account_team_effective'
+                     '  WHERE account=old.account'
+                     '  AND team IN (SELECT ancestor FROM team_closure'
+                     '               WHERE descendant=old.team)'
+                     '  AND NOT EXISTS (SELECT 1'
+                     '   FROM account_team AS at, team_closure AS tc'
+                     '   WHERE at.account=old.account'
+                     '   AND tc.descendant=at.team'
+                     '   AND tc.ancestor=account_team_effective.team);'
+                     ' END')
+        # The change log; a row for each change, in the same transaction.
+        self.execute('CREATE TABLE IF NOT EXISTS change_log'
+                     '(seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+                     ' type TEXT NOT NULL,'  # account, team, membership...
+                     ' name TEXT NOT NULL,'  # Name of account or team
+                     ' team TEXT,'           # Team, for membership
+                     ' action TEXT NOT NULL,'
+                     ' timestamp TEXT NOT NULL'
+                     "  DEFAULT (strftime('%Y-%m-%dT%H:%M:%SZ', 'now')))")
+        if 'team_closure' not in tables:
+            self.execute('INSERT INTO team_closure (ancestor, descendant)'
+                         ' SELECT id, id FROM team')
+        if 'account_team_effective' not in tables:
+            self.execute('INSERT INTO account_team_effective (account, team)'
+                         ' SELECT account, team FROM account_team')
+        # The number of members and of admins of each team, maintained
+        # by the triggers on account_team.
+        if 'member_count' not in self.get_columns('team'):
+            self.execute('ALTER TABLE team ADD COLUMN'
+                         ' member_count INTEGER NOT NULL DEFAULT 0')
+            self.execute('ALTER TABLE team ADD COLUMN'
+                         ' admin_count INTEGER NOT NULL DEFAULT 0')
+            self.execute('UPDATE team SET'
+                         ' member_count=(SELECT COUNT(*) FROM account_team'
+                         '               WHERE team=team.id),'
+                         ' admin_count=(SELECT COUNT(*) FROM account_team'
+                         '              WHERE team=team.id AND admin=1)')
+        self.execute('CREATE TRIGGER IF NOT EXISTS'
+                     ' team_count_insert AFTER INSERT ON account_team BEGIN'
+                     ' UPDATE team SET member_count=member_count+1,'
+                     '  admin_count=admin_count+(ifnull(new.admin, 0)=1)'
+                     '  WHERE id=new.team;'
+                     ' END')
+        self.execute('CREATE TRIGGER IF NOT EXISTS'
+                     ' team_count_delete AFTER DELETE ON account_team BEGIN'
+                     ' UPDATE team SET member_count=member_count-1,'
+                     '  admin_count=admin_count-(ifnull(old.admin, 0)=1)'
+                     '  WHERE id=old.team;'
+                     ' END')
+        self.execute('CREATE TRIGGER IF NOT EXISTS'
+                     ' team_count_update AFTER UPDATE OF admin ON account_team'
+                     ' BEGIN'
+                     ' UPDATE team SET admin_count=admin_count'
+                     '  -(ifnull(old.admin, 0)=1)+(ifnull(new.admin, 0)=1)'
+                     '  WHERE id=new.team;'
+                     ' END')
+        for path in configuration.PROPERTY_INDEXES:
+            self.create_property_index(path)
+        # The normalized email address, for lookup by email address.
+        if 'email_key' not in self.get_columns('account'):
+            self.execute('ALTER TABLE account ADD COLUMN email_key TEXT')
+            cursor = self.execute('SELECT id, email FROM account'
+                                  ' WHERE email IS NOT NULL')
+            self.executemany('UPDATE account SET email_key=? WHERE id=?',
+                             [(normalize_email(r[1]), r[0])
+                              for r in cursor.fetchall()])
+        # The denormalized memberships of each account; see MEMBERSHIPS_JSON.
+        # NULL when not maintained, in which case account_team is read.
+        if 'memberships' not in self.get_columns('account'):
+            self.execute('ALTER TABLE account ADD COLUMN memberships TEXT')
+        if configuration.MEMBERSHIP_COLUMN:
+            self.execute('CREATE TRIGGER IF NOT EXISTS'
+                         ' account_memberships_create AFTER INSERT ON account'
+                         ' BEGIN'
+                         " UPDATE account SET memberships='{}'"
+                         '  WHERE id=new.id;'
+                         ' END')
+            self.execute('CREATE TRIGGER IF NOT EXISTS'
+                         ' account_memberships_insert'
+                         ' AFTER INSERT ON account_team BEGIN'
+                         ' UPDATE account SET memberships=%s'
+                         '  WHERE id=new.account;'
+                         ' END' % (MEMBERSHIPS_JSON % 'new.account'))
+            self.execute('CREATE TRIGGER IF NOT EXISTS'
+                         ' account_memberships_delete'
+                         ' AFTER DELETE ON account_team BEGIN'
+                         ' UPDATE account SET memberships=%s'
+                         '  WHERE id=old.account;'
+                         ' END' % (MEMBERSHIPS_JSON % 'old.account'))
+            self.execute('CREATE TRIGGER IF NOT EXISTS'
+                         ' account_memberships_update'
+                         ' AFTER UPDATE OF admin ON account_team BEGIN'
+                         ' UPDATE account SET memberships=%s'
+                         '  WHERE id=new.account;'
+                         ' END' % (MEMBERSHIPS_JSON % 'new.account'))
+            self.execute('CREATE TRIGGER IF NOT EXISTS'
+                         ' account_memberships_rename'
+                         ' AFTER UPDATE OF name ON team BEGIN'
+                         ' UPDATE account SET memberships=%s'
+                         '  WHERE id IN (SELECT account FROM account_team'
+                         '               WHERE team=new.id);'
+                         ' END' % (MEMBERSHIPS_JSON % 'account.id'))
+            self.execute('UPDATE account SET memberships=%s'
+                         ' WHERE memberships IS NULL'
+                         % (MEMBERSHIPS_JSON % 'account.id'))
+        else:
+            for name in ('create', 'insert', 'delete', 'update', 'rename'):
+                self.execute('DROP TRIGGER IF EXISTS account_memberships_%s'
+                             % name)
+            self.execute('UPDATE account SET memberships=NULL'
+                         ' WHERE memberships IS NOT NULL')
+        cursor = self.execute('PRAGMA index_list(account)')
+        indexes = dict([(str(r[1]), bool(r[2])) for r in cursor])
+        unique = configuration.UNIQUE_EMAIL
+        if indexes.get('account_email_key', unique) != unique:
+            self.execute('DROP INDEX account_email_key')
+        try:
+            self.execute('CREATE %s INDEX IF NOT EXISTS account_email_key'
+                         ' ON account (email_key)'
+                         % (unique and 'UNIQUE' or ''))
+        except sqlite3.IntegrityError:
+            self.execute('CREATE INDEX account_email_key'
+                         ' ON account (email_key)')
+            self.commit()
+            raise ValueError('email addresses are not unique;'
+                             ' cannot create unique index')
+        self.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+        self.commit()
+
+    def get_tables(self):
+        "Return the set of names of the tables in the database."
+        cursor = self.execute("SELECT name FROM sqlite_master"
+                              " WHERE type='table'")
+        return set([str(r[0]) for r in cursor])
+
+    def get_columns(self, table):
+        "Return the set of names of the columns in the table."
+        cursor = self.execute("PRAGMA table_info(%s)" % table)
+        return set([str(r[1]) for r in cursor])
 
 
 class Account(object):
@@ -162,6 +1512,8 @@ class Account(object):
             self.description = None
             self.email = None
             self.properties = dict()
+            self.clear_memberships()
+            self.size = OVERHEAD
 
     def __str__(self):
         return self.name
@@ -169,21 +1521,37 @@ class Account(object):
     def __repr__(self):
         return "Account '%s'" % self.name
 
+    def get_size(self):
+        "Return the approximate size of the instance in memory, in bytes."
+        return self.size
+
     def fetch(self, name):
         "Raise KeyError if no such account."
         cursor = self.db.execute('SELECT id,password,description,email,'
-                                 ' properties FROM account WHERE name=?',
+                                 ' properties,memberships FROM account'
+                                 ' WHERE name=?',
                                   name)
         record = cursor.fetchone()
         if not record:
             raise KeyError("no such Account '%s'" % name)
+        self.set_record(name, record)
+
+    def set_record(self, name, record):
+        """Set the data from the record
+        (id, password, description, email, properties, memberships).
+        """
         self.id = record[0]
         self.name = str(name)
         self._hexdigest = record[1]
         self.description = record[2]
         self.email = record[3]
-        self.properties = rstr(json.loads(record[4]))
+        self._properties = None
+        self._properties_json = record[4]
+        self._memberships = None
+        self._memberships_json = record[5]
+        self.size = OVERHEAD + sum([len(r or '') for r in record[1:]])
 
+    @writes
     def save(self):
         assert self.name
         assert len(self.name.split()) == 1
@@ -193,47 +1561,150 @@ class Account(object):
         if record:
             if record[0] != self.id:
                 raise ValueError("id mismatch for Account '%s'" % self.name)
+            self.check_email()
             self.db.execute('UPDATE account SET password=?,description=?,'
-                            ' email=?,properties=? WHERE id=?',
+                            ' email=?,email_key=?,properties=? WHERE id=?',
                             self.password,
                             self.description,
                             self.email,
+                            normalize_email(self.email),
                             json.dumps(self.properties),
                             self.id)
+            self.db.log_change('account', self.name, 'update')
         else:
+            self.check_email()
             cursor = self.db.execute('INSERT INTO account'
                                      ' (name,password,description,'
-                                     '  email,properties)'
-                                     ' VALUES(?,?,?,?,?)',
+                                     '  email,email_key,properties)'
+                                     ' VALUES(?,?,?,?,?,?)',
                                      self.name,
                                      self.password,
                                      self.description,
                                      self.email,
+                                     normalize_email(self.email),
                                      json.dumps(self.properties))
             self.id = cursor.lastrowid
-        self.db.commit()
+            self.db.log_change('account', self.name, 'create')
+        missing_accounts.discard((self.db.path, self.name))
 
-    def get_data(self):
-        "Return the account data in a dictionary."
-        return dict(name=str(self.name),
-                    teams=[str(t) for t in self.get_teams()],
-                    description=self.description,
-                    email=self.email,
-                    properties=self.properties)
+    def check_email(self):
+        """Raise ValueError if email addresses must be unique, and the
+        email address is used by another account.
+        """
+        if not configuration.UNIQUE_EMAIL: return
+        key = normalize_email(self.email)
+        if not key: return
+        cursor = self.db.execute('SELECT COUNT(*) FROM account'
+                                 ' WHERE email_key=? AND id IS NOT ?',
+                                 key,
+                                 self.id)
+        if cursor.fetchone()[0]:
+            raise ValueError("email address '%s' already in use" % self.email)
 
-    def get_teams(self):
-        "Return all teams this account is a member of."
+    def get_properties(self):
+        "Return the properties; decoded when first needed."
+        if self._properties is None:
+            self._properties = rstr(json.loads(self._properties_json))
+        return self._properties
+
+    def set_properties(self, properties):
+        self._properties = properties
+
+    properties = property(get_properties, set_properties)
+
+    def get_memberships(self):
+        """Return the sorted list of (team name, admin flag) for the teams
+        the account is a direct member of, from the denormalized column;
+        decoded when first needed. Return None if the column is not
+        maintained; see configuration.MEMBERSHIP_COLUMN.
+        """
+        if self._memberships is None and self._memberships_json is not None:
+            self._memberships = sorted([(str(n), bool(a)) for n, a in
+                                        json.loads(self._memberships_json)
+                                        .items()])
+        return self._memberships
+
+    def clear_memberships(self):
+        "Discard the denormalized memberships, which are out of date."
+        self._memberships = None
+        self._memberships_json = None
+
+    def get_admin_flags(self):
+        """Return a dictionary of the admin flag by team name, for the
+        teams the account is a direct member of.
+        """
         assert self.id
-        cursor = self.db.execute('SELECT t.name'
+        memberships = self.get_memberships()
+        if memberships is not None:
+            return dict(memberships)
+        cursor = self.db.execute('SELECT t.name, at.admin'
                                  ' FROM team AS t, account_team AS at'
-                                 ' WHERE t.id=at.team AND at.account=?'
-                                 ' ORDER BY t.name',
+                                 ' WHERE t.id=at.team AND at.account=?',
                                  self.id)
-        result = []
-        for record in cursor.fetchall():
-            result.append(self.db.get_team(record[0]))
+        return dict([(str(r[0]), r[1] == 1) for r in cursor])
+
+    def get_data(self, effective=False, fields=None):
+        """Return the account data in a dictionary.
+        If effective is true, then also include the list of teams
+        the account is a member of directly or via nested teams.
+        If fields is given, then include only those items; see
+        ACCOUNT_FIELDS. The teams are looked up only if included.
+        Raise ValueError if invalid field.
+        """
+        fields = get_fields(fields, ACCOUNT_FIELDS, effective)
+        result = dict()
+        if 'name' in fields:
+            result['name'] = str(self.name)
+        if 'teams' in fields:
+            result['teams'] = self.get_team_names()
+        if 'effective_teams' in fields:
+            result['effective_teams'] = self.get_team_names(effective=True)
+        if 'description' in fields:
+            result['description'] = self.description
+        if 'email' in fields:
+            result['email'] = self.email
+        if 'properties' in fields:
+            result['properties'] = copy.deepcopy(self.properties)
         return result
 
+    def get_teams(self, effective=False):
+        """Return all teams this account is a member of.
+        If effective is true, then include the teams the account
+        is a member of via nested teams.
+        """
+        return [self.db.load_team(name)
+                for name in self.get_team_names(effective=effective)]
+
+    def get_team_names(self, effective=False):
+        """Return the sorted names of all teams this account is a member of.
+        If effective is true, then include the teams the account
+        is a member of via nested teams.
+        """
+        assert self.id
+        if effective:
+            table = 'account_team_effective'
+        else:
+            memberships = self.get_memberships()
+            if memberships is not None:
+                return [m[0] for m in memberships]
+            try:
+                return list(self.db.membership_index[self.name])
+            except KeyError:
+                pass
+            table = 'account_team'
+        with self.db.read_snapshot():
+            version = self.db.get_read_version()
+            cursor = self.db.execute('SELECT t.name'
+                                     ' FROM team AS t, %s AS at'
+                                     ' WHERE t.id=at.team AND at.account=?'
+                                     ' ORDER BY t.name' % table,
+                                     self.id)
+            names = [str(r[0]) for r in cursor]
+        if not effective:
+            self.db.cache(self.db.membership_index, self.name, names, version)
+        return list(names)
+
+    @writes
     def set_teams(self, teamnames):
         """Set the account's teams to the ones named in the given list.
         Remove from those teams not mentioned.
@@ -255,13 +1726,12 @@ class Account(object):
                 pass
             else:
                 team.add_member(self)
-        self.db.commit()
 
     @staticmethod
     def get_password_hexdigest(password):
-        "Convert the password to its hexdigest."
-        md5 = hashlib.md5(configuration.SALT)
-        md5.update(password)
+        "Convert the password to its hexdigest; unicode is UTF-8 encoded."
+        md5 = hashlib.md5(utf8(configuration.SALT))
+        md5.update(utf8(password))
         return md5.hexdigest()
 
     def get_password(self):
@@ -295,6 +1765,7 @@ class Team(object):
             self.name = None
             self.description = None
             self.properties = dict()
+            self.size = OVERHEAD
 
     def __str__(self):
         return self.name
@@ -302,6 +1773,10 @@ class Team(object):
     def __repr__(self):
         return "Team '%s'" % self.name
 
+    def get_size(self):
+        "Return the approximate size of the instance in memory, in bytes."
+        return self.size
+
     def fetch(self, name):
         "Raise KeyError if no such team."
         cursor = self.db.execute('SELECT id,description,properties'
@@ -310,11 +1785,18 @@ class Team(object):
         record = cursor.fetchone()
         if not record:
             raise KeyError("no such Team '%s'" % name)
+        self.set_record(name, record)
+
+    def set_record(self, name, record):
+        "Set the data from the record (id, description, properties)."
         self.id = record[0]
         self.name = str(name)
         self.description = record[1]
-        self.properties = rstr(json.loads(record[2]))
+        self._properties = None
+        self._properties_json = record[2]
+        self.size = OVERHEAD + sum([len(r or '') for r in record[1:]])
 
+    @writes
     def save(self):
         assert self.name
         assert len(self.name.split()) == 1
@@ -328,6 +1810,7 @@ class Team(object):
                             self.description,
                             json.dumps(self.properties),
                             self.id)
+            self.db.log_change('team', self.name, 'update')
         else:
             cursor = self.db.execute('INSERT INTO team'
                                      ' (name,description,properties)'
@@ -336,24 +1819,64 @@ class Team(object):
                                      self.description,
                                      json.dumps(self.properties))
             self.id = cursor.lastrowid
-        self.db.commit()
-
-    def get_data(self):
-        "Return the team data in a dictionary."
-        return dict(name=self.name,
-                    members=[str(m) for m in self.get_members()],
-                    admins=[str(m) for m in self.get_admins()],
-                    description=self.description,
-                    properties=self.properties)
-
-    def get_members(self):
-        "Return all accounts being members of this team."
+            self.db.log_change('team', self.name, 'create')
+        missing_teams.discard((self.db.path, self.name))
+
+    def get_properties(self):
+        "Return the properties; decoded when first needed."
+        if self._properties is None:
+            self._properties = rstr(json.loads(self._properties_json))
+        return self._properties
+
+    def set_properties(self, properties):
+        self._properties = properties
+
+    properties = property(get_properties, set_properties)
+
+    def get_data(self, effective=False, fields=None):
+        """Return the team data in a dictionary.
+        If effective is true, then also include the list of accounts
+        being members directly or via nested teams.
+        If fields is given, then include only those items; see
+        TEAM_FIELDS. The members, admins and subteams are looked up
+        only if included.
+        Raise ValueError if invalid field.
+        """
+        fields = get_fields(fields, TEAM_FIELDS, effective)
+        result = dict()
+        if 'name' in fields:
+            result['name'] = self.name
+        if 'members' in fields:
+            result['members'] = [str(m) for m in self.get_members()]
+        if 'effective_members' in fields:
+            result['effective_members'] = [str(m) for m
+                                           in self.get_members(effective=True)]
+        if 'admins' in fields:
+            result['admins'] = [str(m) for m in self.get_admins()]
+        if 'subteams' in fields:
+            result['subteams'] = [str(t) for t in self.get_subteams()]
+        if 'description' in fields:
+            result['description'] = self.description
+        if 'properties' in fields:
+            result['properties'] = copy.deepcopy(self.properties)
+        return result
+
+    def get_members(self, effective=False):
+        """Return all accounts being members of this team.
+        If effective is true, then include the accounts being members
+        via nested teams.
+        """
         assert self.id
+        if effective:
+            table = 'account_team_effective'
+        else:
+            table = 'account_team'
         cursor = self.db.execute('SELECT a.name'
-                                 ' FROM account AS a, account_team AS at'
-                                 ' WHERE a.id=at.account AND at.team=?',
+                                 ' FROM account AS a, %s AS at'
+                                 ' WHERE a.id=at.account'
+                                 ' AND at.team=?' % table,
                                  self.id)
-        return [self.db.get_account(record[0]) for record in cursor]
+        return [self.db.load_account(record[0]) for record in cursor]
 
     def get_admins(self):
         "Return all accounts being admin members of this team."
@@ -363,8 +1886,9 @@ class Team(object):
                                  ' WHERE a.id=at.account AND at.team=?'
                                  ' AND at.admin=1',
                                  self.id)
-        return [self.db.get_account(record[0]) for record in cursor]
+        return [self.db.load_account(record[0]) for record in cursor]
 
+    @writes
     def add_member(self, account, admin=False):
         assert self.id
         assert isinstance(account, Account)
@@ -375,7 +1899,11 @@ class Team(object):
                         account.id,
                         self.id,
                         int(bool(admin)))
+        self.db.evict_memberships(account.name)
+        account.clear_memberships()
+        self.db.log_change('membership', account.name, 'add', team=self.name)
 
+    @writes
     def remove_member(self, account):
         assert self.id
         assert isinstance(account, Account)
@@ -384,7 +1912,12 @@ class Team(object):
         self.db.execute('DELETE FROM account_team WHERE account=? AND team=?',
                         account.id,
                         self.id)
+        self.db.evict_memberships(account.name)
+        account.clear_memberships()
+        self.db.log_change('membership', account.name, 'remove',
+                           team=self.name)
 
+    @writes
     def set_admin(self, account, admin=True):
         assert self.id
         assert isinstance(account, Account)
@@ -395,7 +1928,12 @@ class Team(object):
                         int(bool(admin)),
                         account.id,
                         self.id)
+        self.db.evict_memberships(account.name)
+        account.clear_memberships()
+        self.db.log_change('membership', account.name, 'update',
+                           team=self.name)
 
+    @writes
     def set_admins(self, accountnames):
         """Set the team's administrators to the ones named in the given list.
         Remove administrators not mentioned.
@@ -417,20 +1955,141 @@ class Team(object):
                 pass
             else:
                 self.set_admin(account, admin=True)
-        self.db.commit()
 
-    def is_member(self, account):
-        "Is the given account a member of this team?"
+    def is_member(self, account, effective=False):
+        """Is the given account a member of this team?
+        If effective is true, then membership via nested teams counts.
+        """
         assert self.id
         assert isinstance(account, Account)
         assert account.id
-        cursor = self.db.execute('SELECT COUNT(*) FROM account_team'
-                                 ' WHERE account_team.account=?'
-                                 '   AND account_team.team=?',
+        if effective:
+            table = 'account_team_effective'
+        else:
+            table = 'account_team'
+        cursor = self.db.execute('SELECT COUNT(*) FROM %s'
+                                 ' WHERE account=? AND team=?' % table,
                                  account.id,
                                  self.id)
         return bool(cursor.fetchone()[0])
 
+    def get_subteams(self):
+        "Return the teams being direct members of this team."
+        assert self.id
+        cursor = self.db.execute('SELECT t.name'
+                                 ' FROM team AS t, team_team AS tt'
+                                 ' WHERE t.id=tt.child AND tt.parent=?'
+                                 ' ORDER BY t.name',
+                                 self.id)
+        return [self.db.load_team(record[0]) for record in cursor]
+
+    @writes
+    def add_subteam(self, team):
+        """Make the given team a member of this team.
+        Raise ValueError if this would create a cycle.
+        """
+        assert self.id
+        assert isinstance(team, Team)
+        assert team.id
+        cursor = self.db.execute('SELECT COUNT(*) FROM team_closure'
+                                 ' WHERE ancestor=? AND descendant=?',
+                                 team.id,
+                                 self.id)
+        if cursor.fetchone()[0]:
+            raise ValueError("Team '%s' contains Team '%s'" % (team, self))
+        cursor = self.db.execute('SELECT COUNT(*) FROM team_team'
+                                 ' WHERE parent=? AND child=?',
+                                 self.id,
+                                 team.id)
+        if cursor.fetchone()[0]: return
+        self.db.execute('INSERT INTO team_team (parent, child) VALUES(?,?)',
+                        self.id,
+                        team.id)
+        self.db.execute('INSERT OR IGNORE INTO team_closure'
+                        ' (ancestor, descendant)'
+                        ' SELECT a.ancestor, d.descendant'
+                        ' FROM team_closure AS a, team_closure AS d'
+                        ' WHERE a.descendant=? AND d.ancestor=?',
+                        self.id,
+                        team.id)
+        self.db.execute('INSERT OR IGNORE INTO account_team_effective'
+                        ' (account, team)'
+                        ' SELECT at.account, a.ancestor'
+                        ' FROM account_team AS at,'
+                        '  team_closure AS d, team_closure AS a'
+                        ' WHERE d.ancestor=? AND at.team=d.descendant'
+                        ' AND a.descendant=?',
+                        team.id,
+                        self.id)
+        self.db.log_change('subteam', team.name, 'add', team=self.name)
+
+    @writes
+    def remove_subteam(self, team):
+        "Remove the given team from being a member of this team."
+        assert self.id
+        assert isinstance(team, Team)
+        assert team.id
+        cursor = self.db.execute('DELETE FROM team_team'
+                                 ' WHERE parent=? AND child=?',
+                                 self.id,
+                                 team.id)
+        if not cursor.rowcount: return
+        # Remove the closure pairs that may have depended on the edge,
+        # then recompute the descendants of this team's ancestors.
+        self.db.execute('DELETE FROM team_closure'
+                        ' WHERE ancestor IN (SELECT ancestor FROM team_closure'
+                        '                    WHERE descendant=?)'
+                        ' AND descendant IN (SELECT descendant'
+                        '                    FROM team_closure'
+                        '                    WHERE ancestor=?)'
+                        ' AND ancestor!=descendant',
+                        self.id,
+                        team.id)
+        self.db.execute('INSERT OR IGNORE INTO team_closure'
+                        ' (ancestor, descendant)'
+                        ' WITH RECURSIVE reach(ancestor, descendant) AS'
+                        ' (SELECT ancestor, ancestor FROM team_closure'
+                        '  WHERE descendant=?'
+                        '  UNION SELECT reach.ancestor, tt.child'
+                        '  FROM reach, team_team AS tt'
+                        '  WHERE tt.parent=reach.descendant)'
+                        ' SELECT ancestor, descendant FROM reach',
+                        self.id)
+        self.db.execute('DELETE FROM account_team_effective'
+                        ' WHERE team IN (SELECT ancestor FROM team_closure'
+                        '                WHERE descendant=?)'
+                        ' AND NOT EXISTS (SELECT 1'
+                        '  FROM account_team AS at, team_closure AS tc'
+                        '  WHERE at.account=account_team_effective.account'
+                        '  AND tc.descendant=at.team'
+                        '  AND tc.ancestor=account_team_effective.team)',
+                        self.id)
+        self.db.log_change('subteam', team.name, 'remove', team=self.name)
+
+    @writes
+    def set_subteams(self, teamnames):
+        """Set the team's subteams to the ones named in the given list.
+        Remove subteams not mentioned.
+        Add subteams mentioned, and not already set.
+        Raise ValueError if this would create a cycle.
+        """
+        current = set([str(t) for t in self.get_subteams()])
+        new = set(teamnames or [])
+        for name in current.difference(new):
+            try:
+                team = self.db.get_team(name)
+            except KeyError:
+                pass
+            else:
+                self.remove_subteam(team)
+        for name in new.difference(current):
+            try:
+                team = self.db.get_team(name)
+            except KeyError:
+                pass
+            else:
+                self.add_subteam(team)
+
     def is_admin(self, account):
         "Is the given account an admin member of this team?"
         assert self.id
@@ -445,18 +2104,49 @@ class Team(object):
         return bool(cursor.fetchone()[0])
 
 
+_shared_databases = dict()
+_shared_lock = threading.Lock()
+
+def get_shared_database(path=None):
+    """Return the open Database instance for the path shared by all
+    threads in the process. Create and open it if not done already.
+    """
+    path = path or configuration.MASTER_DB_FILE
+    with _shared_lock:
+        try:
+            return _shared_databases[path]
+        except KeyError:
+            db = Database(path)
+            db.open()
+            if configuration.WRITER:
+                db.start_writer()
+            _shared_databases[path] = db
+            return db
+
+def close_shared_database(path=None):
+    """Close and discard the shared Database instance for the path, if any.
+    Only the connection of the current thread is closed.
+    """
+    path = path or configuration.MASTER_DB_FILE
+    with _shared_lock:
+        db = _shared_databases.pop(path, None)
+    if db is not None:
+        db.close()
+
+
 if __name__ == '__main__':
-    import os.path
     import getpass
 
     db = Database()
-    if os.path.exists(configuration.MASTER_DB_FILE):
+    if os.path.exists(db.file):
         db.open()
-        print 'WhoYou database exists.'
+        db.upgrade()
+        db.compact_changes()
+        print('WhoYou database exists; upgraded.')
     else:
         db.open()
         db.create()
-        print 'Created WhoYou database.'
+        print('Created WhoYou database.')
         password = getpass.getpass("Give password for 'admin' account > ")
         admin = db.create_account('admin',
                                   password=password,
@@ -474,10 +2164,10 @@ if __name__ == '__main__':
             db.create_account(tests.ACCOUNT,
                               password=tests.PASSWORD,
                               description='Test account.')
-    print 'Accounts:'
+    print('Accounts:')
     for a in db.get_accounts():
-        print a.get_data()
-    print 'Teams:'
+        print(a.get_data())
+    print('Teams:')
     for t in db.get_teams():
-        print t.get_data()
+        print(t.get_data())
     db.close()
@@ -3,41 +3,126 @@
 Fallback interface when there is no WhoYou service.
 """
 
-def get_account(name, password=None):
+def get_account(name, password=None, effective=False, fields=None):
     """Get the account data dictionary containing items:
     - name: str
     - description: str or None
     - email: str or None
     - teams: list of str
+    - effective_teams: list of str, if effective is true
     - properties: dict
+    If fields is given, then only those items are included.
     If the password is given, then authenticate.
     Raise KeyError if no such account.
     Raise ValueError if incorrect password.
     """
-    return dict(name=name,
-                description='Dummy account',
-                email=None,
-                teams=[],
-                properties=dict())
+    result = dict(name=name,
+                  description='Dummy account',
+                  email=None,
+                  teams=[],
+                  effective_teams=[],
+                  properties=dict())
+    if not (effective or 'effective_teams' in (fields or [])):
+        result.pop('effective_teams')
+    return select_fields(result, fields)
 
-def get_accounts():
+def get_account_by_email(email, password=None, effective=False,
+                         fields=None):
+    """Get the data dictionary for the account having the email address;
+    see 'get_account'.
+    Raise KeyError if no such account.
+    """
+    return get_account('dummy', password=password, effective=effective,
+                       fields=fields)
+
+def get_accounts(fields=None):
     "Return a list of all accounts as dictionaries."
-    return [get_account('dummy')]
+    return [get_account('dummy', fields=fields)]
 
-def get_team(name):
+def get_team(name, effective=False, fields=None):
     """Get the team data dictionary containing items:
     - name: str
     - description: str or None
     - members: list of str
+    - effective_members: list of str, if effective is true
     - admins: list of str
+    - subteams: list of str
     - properties: dict
+    If fields is given, then only those items are included.
     Raise KeyError if no such team.
     """
-    return dict(name=name,
-                description='Dummy team',
-                members=[],
-                admins=[],
-                properties=dict())
+    result = dict(name=name,
+                  description='Dummy team',
+                  members=[],
+                  effective_members=[],
+                  admins=[],
+                  subteams=[],
+                  properties=dict())
+    if not (effective or 'effective_members' in (fields or [])):
+        result.pop('effective_members')
+    return select_fields(result, fields)
+
+def select_fields(data, fields):
+    "Return a dictionary with only the given fields of the data."
+    if fields is None: return data
+    return dict([(k, v) for k, v in data.items() if k in fields])
+
+def get_team_summaries():
+    """Return a list of dictionaries for all teams, without the lists
+    of members, containing items:
+    - name: str
+    - description: str or None
+    - member_count: int
+    - admin_count: int
+    """
+    return [dict(name='dummy',
+                 description='Dummy team',
+                 member_count=0,
+                 admin_count=0)]
+
+def is_member(accountname, teamname, effective=False):
+    """Is the account a member of the team?
+    If effective is true, then membership via nested teams counts.
+    Raise KeyError if no such account or team.
+    """
+    return False
+
+def check_membership(accountname, teamname, effective=False):
+    """Return a dictionary containing items:
+    - member: bool, is the account a member of the team?
+    - admin: bool, is the account an admin of the team?
+    If effective is true, then membership via nested teams counts.
+    Raise KeyError if no such account or team.
+    """
+    return dict(member=False, admin=False)
+
+def find_accounts(path, value):
+    """Return the sorted list of names of the accounts having the value
+    at the path in their properties; e.g. the path 'myapp.admin' for
+    the item properties['myapp']['admin'].
+    Raise ValueError if invalid path.
+    """
+    return []
+
+def search(terms, limit=20):
+    """Return a list of dictionaries (type, name) for the accounts
+    and teams matching the search terms, best match first.
+    - type: 'account' or 'team'
+    - name: str
+    """
+    return []
+
+def get_changes(since=0):
+    """Return the changes after the given sequence number
+    as a dictionary containing items:
+    - changes: list of dictionaries (seq, type, name, team,
+      action, timestamp), in order
+    - last: the sequence number to give as 'since' the next time
+    - more: True if there are more changes than returned
+    - resync: True if changes after 'since' are no longer available;
+      reload all data, then continue from 'last'
+    """
+    return dict(changes=[], last=0, more=False, resync=False)
 
 def update_account_properties(name, applicationname, properties):
     "Update the properties of the given account for the given application."
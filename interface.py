@@ -3,46 +3,223 @@
 The functions defined here are to be used by other web applications.
 """
 
-from .database import Database
+from . import configuration
+from .database import get_shared_database, get_fields, Account
+from .database import ACCOUNT_FIELDS, TEAM_FIELDS
 
 
+_snapshot = None
+
 def get_db():
-    db = Database()
-    db.open()
+    """Return the database instance shared by all threads in the process,
+    with its caches brought up to date.
+    """
+    db = get_shared_database()
+    db.refresh()
     return db
 
-def get_account(name, password=None):
+def get_snapshot():
+    """Return the snapshot reader, if configured, and the file exists,
+    is valid and is current with the database.
+    Otherwise return None; the database is to be used.
+    """
+    global _snapshot
+    if not configuration.SNAPSHOT: return None
+    from .snapshot import Snapshot
+    try:
+        if _snapshot is None or \
+           _snapshot.path != configuration.SNAPSHOT_FILE:
+            _snapshot = Snapshot(configuration.SNAPSHOT_FILE)
+        version = _snapshot.get_version()
+    except (IOError, OSError):
+        _snapshot = None
+        return None
+    if version < get_shared_database().get_last_change():
+        return None
+    return _snapshot
+
+def from_snapshot(function):
+    """Return the result of calling the function with the snapshot reader.
+    Return None if the snapshot is not to be used, or is found corrupt;
+    the database is then to be used.
+    """
+    snapshot = get_snapshot()
+    if snapshot is None: return None
+    try:
+        return function(snapshot)
+    except (IOError, OSError):
+        return None
+
+def snapshot_membership(snapshot, accountname, teamname, effective):
+    "Return the membership dictionary as for 'check_membership'."
+    snapshot.get_account(accountname)
+    team = snapshot.get_team(teamname, effective=effective)
+    if effective:
+        member = accountname in team['effective_members']
+    else:
+        member = accountname in team['members']
+    return dict(member=member, admin=accountname in team['admins'])
+
+def select_fields(data, fields, allowed):
+    """Return a dictionary with only the given fields of the data.
+    Raise ValueError if invalid field.
+    """
+    if fields is None: return data
+    fields = get_fields(fields, allowed, False)
+    return dict([(k, v) for k, v in data.items() if k in fields])
+
+def get_account(name, password=None, effective=False, fields=None):
     """Get the account data dictionary containing items:
-    Raise KeyError if no such account.
-    Raise ValueError if incorrect password.
     - name: str
     - teams: list of str
+    - effective_teams: list of str, if effective is true
     - description: str or None
     - email: str or None
     - properties: dict
+    If fields is given, then only those items are included, and only
+    the data for them is looked up.
+    If the password is given, then authenticate.
+    Raise KeyError if no such account.
+    Raise ValueError if incorrect password, or invalid field.
+    """
+    result = from_snapshot(lambda s: s.get_account(
+            name,
+            password=password,
+            effective=effective or 'effective_teams' in (fields or [])))
+    if result is not None:
+        return select_fields(result, fields, ACCOUNT_FIELDS)
+    db = get_db()
+    with db.read_snapshot():
+        account = db.get_account(name, password=password)
+        return account.get_data(effective=effective, fields=fields)
+
+def get_account_by_email(email, password=None, effective=False,
+                         fields=None):
+    """Get the data dictionary for the account having the email address,
+    which is compared ignoring case; see 'get_account'.
     If the password is given, then authenticate.
     Raise KeyError if no such account.
-    Raise ValueError if incorrect password.
+    Raise ValueError if several accounts have the email address,
+    incorrect password, or invalid field.
     """
-    return get_db().get_account(name, password=password).get_data()
+    db = get_db()
+    with db.read_snapshot():
+        account = db.get_account_by_email(email, password=password)
+        return account.get_data(effective=effective, fields=fields)
 
-def get_accounts():
-    "Return a list of all accounts as dictionaries."
-    return [a.get_data() for a in get_db().get_accounts()]
+def get_accounts(fields=None):
+    """Return a list of all accounts as dictionaries.
+    If fields is given, then only those items are included.
+    Raise ValueError if invalid field.
+    """
+    result = from_snapshot(lambda s: s.get_accounts())
+    if result is not None:
+        return [select_fields(a, fields, ACCOUNT_FIELDS) for a in result]
+    db = get_db()
+    with db.read_snapshot():
+        return [a.get_data(fields=fields) for a in db.get_accounts()]
 
-def get_team(name):
+def get_team(name, effective=False, fields=None):
     """Get the team data dictionary containing items:
-    Raise KeyError if no such team.
     - name: str
     - members: list of str
+    - effective_members: list of str, if effective is true
     - admins: list of str
+    - subteams: list of str
     - description: str or None
     - properties: dict
+    If fields is given, then only those items are included, and only
+    the data for them is looked up.
+    Raise KeyError if no such team.
+    Raise ValueError if invalid field.
+    """
+    result = from_snapshot(lambda s: s.get_team(
+            name,
+            effective=effective or 'effective_members' in (fields or [])))
+    if result is not None:
+        return select_fields(result, fields, TEAM_FIELDS)
+    db = get_db()
+    with db.read_snapshot():
+        return db.get_team(name).get_data(effective=effective, fields=fields)
+
+def get_team_summaries():
+    """Return a list of dictionaries for all teams, without the lists
+    of members, containing items:
+    - name: str
+    - description: str or None
+    - member_count: int
+    - admin_count: int
+    """
+    db = get_db()
+    with db.read_snapshot():
+        return db.get_team_summaries()
+
+def is_member(accountname, teamname, effective=False):
+    """Is the account a member of the team?
+    If effective is true, then membership via nested teams counts.
+    Raise KeyError if no such account or team.
+    """
+    result = from_snapshot(lambda s: snapshot_membership(
+            s, accountname, teamname, effective))
+    if result is not None:
+        return result['member']
+    db = get_db()
+    return db.get_team(teamname).is_member(db.get_account(accountname),
+                                           effective=effective)
+
+def check_membership(accountname, teamname, effective=False):
+    """Return a dictionary containing items:
+    - member: bool, is the account a member of the team?
+    - admin: bool, is the account an admin of the team?
+    If effective is true, then membership via nested teams counts.
+    This is cheap enough to call for every request of an application.
+    Raise KeyError if no such account or team.
+    """
+    result = from_snapshot(lambda s: snapshot_membership(
+            s, accountname, teamname, effective))
+    if result is not None:
+        return result
+    return get_db().check_membership(accountname, teamname,
+                                     effective=effective)
+
+def find_accounts(path, value):
+    """Return the sorted list of names of the accounts having the value
+    at the path in their properties; e.g. the path 'myapp.admin' for
+    the item properties['myapp']['admin']. The value None matches a null
+    or missing item. This is an indexed lookup if the path is listed in
+    the configuration variable PROPERTY_INDEXES.
+    Raise ValueError if invalid path, or if the value is a list or
+    dictionary.
+    """
+    db = get_db()
+    return db.find_accounts(path, value)
+
+def search(terms, limit=configuration.DEFAULT_LIMIT):
+    """Return a list of dictionaries (type, name) for the accounts
+    and teams matching the search terms, best match first.
+    - type: 'account' or 'team'
+    - name: str
+    """
+    return get_db().search(terms, limit=limit)
+
+def get_changes(since=0):
+    """Return the changes after the given sequence number
+    as a dictionary containing items:
+    - changes: list of dictionaries (seq, type, name, team,
+      action, timestamp), in order
+    - last: the sequence number to give as 'since' the next time
+    - more: True if there are more changes than returned
+    - resync: True if changes after 'since' are no longer available;
+      reload all data, then continue from 'last'
     """
-    return get_db().get_team(name).get_data()
+    return get_db().get_changes(since)
 
 def update_account_properties(name, applicationname, properties):
     "Update the properties of the given account for the given application."
-    account = get_db().get_account(name)
+    db = get_db()
+    account = db.get_account(name)
+    # Other threads may be reading the cached instance; update a copy.
+    account = Account(db, name=account.name)
     account.properties.setdefault(applicationname, dict()).update(properties)
     account.save()
+    db.evict(account)
@@ -0,0 +1,155 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Maintenance of the database while the service is running: online
+backup, compaction of the change log, incremental vacuum, integrity
+check, updating the statistics of the query planner, and WAL
+checkpoint. Each task is done in small steps, or within a single read
+transaction, so that requests are not stalled; in WAL mode, readers
+and writers do not block each other.
+
+Run as a script, once or at regular intervals; the timings of the
+tasks are reported.
+"""
+
+import os
+import sys
+import time
+import logging
+import sqlite3
+import optparse
+
+from whoyou import configuration
+from whoyou.database import Database
+
+
+def backup(db, path=configuration.BACKUP_FILE,
+           pages=configuration.BACKUP_PAGES,
+           pause=configuration.BACKUP_PAUSE):
+    """Write a consistent copy of the database to the file at the path.
+    The file is replaced atomically when the copy is complete.
+    Return the size of the copy, in bytes.
+    """
+    tmppath = path + '.tmp'
+    if os.path.exists(tmppath):
+        os.remove(tmppath)
+    cnx = db.cnx
+    if hasattr(cnx, 'backup'):
+        # The backup API copies the given number of pages at a time,
+        # pausing in between; other connections may read and write.
+        target = sqlite3.connect(tmppath)
+        try:
+            cnx.backup(target, pages=pages, sleep=pause)
+        finally:
+            target.close()
+    else:
+        # The backup API is not available in the sqlite3 module of
+        # this Python version. The copy is then made within a single
+        # read transaction, which in WAL mode blocks neither readers
+        # nor writers.
+        cnx.execute('VACUUM INTO ?', (tmppath,))
+    os.rename(tmppath, path)
+    return os.path.getsize(path)
+
+def is_incremental(db):
+    "Is the database in incremental auto-vacuum mode?"
+    return db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+def enable_incremental(db):
+    """Set the database in incremental auto-vacuum mode. This requires
+    a full VACUUM, which blocks writers while it runs; do it when the
+    service is not busy. Databases created by 'Database.create' are
+    already in this mode.
+    """
+    db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    db.execute('VACUUM')
+
+def incremental_vacuum(db, pages=configuration.VACUUM_PAGES,
+                       pause=configuration.VACUUM_PAUSE):
+    """Return free pages to the file system, the given number of pages
+    at a time, pausing in between, so each write transaction is short.
+    Return the number of pages freed.
+    """
+    if not is_incremental(db): return 0
+    freed = 0
+    while True:
+        count = db.execute('PRAGMA freelist_count').fetchone()[0]
+        if not count: break
+        # Each step of the statement frees a page; all must be fetched.
+        db.execute('PRAGMA incremental_vacuum(%d)' % pages).fetchall()
+        freed += min(count, pages)
+        time.sleep(pause)
+    return freed
+
+def integrity_check(db):
+    """Check the integrity of the database, within a read transaction.
+    Return the list of problems found; empty if none.
+    """
+    with db.read_snapshot():
+        messages = [r[0] for r in db.execute('PRAGMA integrity_check')]
+    return [m for m in messages if m != 'ok']
+
+def analyze(db, limit=configuration.ANALYSIS_LIMIT):
+    """Update the statistics used by the query planner, examining
+    approximately the given number of rows of each index.
+    """
+    db.execute('PRAGMA analysis_limit=%d' % limit).fetchall()
+    db.execute('ANALYZE')
+
+def checkpoint(db):
+    """Copy the contents of the write-ahead log into the database file,
+    as far as possible without waiting for readers or writers.
+    Return the number of pages in the log, and of those checkpointed.
+    """
+    record = db.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    return record[1], record[2]
+
+def run(db, backup_path=configuration.BACKUP_FILE):
+    """Perform all maintenance tasks, in order. Return a list of tuples
+    (task, seconds, result) giving the timing and result of each task.
+    """
+    tasks = [('integrity_check', lambda: integrity_check(db)),
+             ('backup', lambda: backup(db, path=backup_path)),
+             ('compact_changes', lambda: db.compact_changes()),
+             ('incremental_vacuum', lambda: incremental_vacuum(db)),
+             ('analyze', lambda: analyze(db)),
+             ('checkpoint', lambda: checkpoint(db))]
+    report = []
+    for name, task in tasks:
+        started = time.time()
+        try:
+            result = task()
+        except (sqlite3.Error, IOError, OSError) as msg:
+            db.rollback()
+            result = "failed: %s" % msg
+        report.append((name, round(time.time() - started, 3), result))
+    return report
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('-i', '--interval', type='float', default=0,
+                      help='run the tasks every INTERVAL seconds;'
+                      ' default: once')
+    parser.add_option('-b', '--backup', default=configuration.BACKUP_FILE,
+                      help="backup file; default '%default'")
+    parser.add_option('--enable-incremental', action='store_true',
+                      help='set the database in incremental auto-vacuum'
+                      ' mode (full VACUUM; blocks writers) and exit')
+    options, args = parser.parse_args()
+    db = Database()
+    db.open()
+    if options.enable_incremental:
+        enable_incremental(db)
+        print('Database set in incremental auto-vacuum mode.')
+        sys.exit(0)
+    if not is_incremental(db):
+        logging.warning('not in incremental auto-vacuum mode;'
+                        ' see --enable-incremental')
+    while True:
+        for name, seconds, result in run(db, backup_path=options.backup):
+            print("%s %-20s %8.3f s  %s" %
+                  (time.strftime('%Y-%m-%dT%H:%M:%S'), name, seconds, result))
+        sys.stdout.flush()
+        if not options.interval: break
+        time.sleep(options.interval)
+    db.close()
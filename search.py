@@ -0,0 +1,48 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Search resource.
+"""
+
+from .base import *
+
+
+class SearchHtmlRepresentation(HtmlRepresentation):
+    "HTML representation of the search result."
+
+    def get_content(self):
+        rows = [TR(TH('Name'),
+                   TH('Type'))]
+        for item in self.data['items']:
+            rows.append(TR(TD(A(item['name'], href=item['href'])),
+                           TD(item['type'])))
+        return TABLE(klass='list', *rows)
+
+
+class GET_Search(MethodMixin, GET):
+    """Search for accounts and teams. Each word in the terms must be
+    the prefix of a word in the name, email or description of an item.
+    The best matches are returned first."""
+
+    outreprs = [JsonRepresentation,
+                TextRepresentation,
+                SearchHtmlRepresentation]
+
+    fields = (StringField('terms', title='Terms',
+                          descr='Words, or prefixes of words, to search for.'),
+              StringField('limit', title='Limit',
+                          descr='Maximum number of items to return.'))
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        values = self.parse_fields(request)
+        terms = values.get('terms') or ''
+        data = dict(title="Search '%s'" % terms, terms=terms)
+        get_url = request.application.get_url
+        items = self.db.search(terms, limit=self.get_limit(values))
+        for item in items:
+            item['href'] = get_url(item['type'], item['name'])
+        data['items'] = items
+        return data
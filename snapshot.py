@@ -0,0 +1,228 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Compiled read-only snapshot of the accounts and teams, for lookups
+by other web applications without opening the database.
+
+The snapshot file is immutable; the exporter writes a new file and
+renames it over the old one. The reader memory-maps the file, so the
+pages are shared between all processes reading it, and it reopens the
+file when it has been replaced.
+
+The sequence number of the last change in the database when the
+snapshot was exported is recorded; the reader of the snapshot compares
+it with that of the database, and uses the database instead when the
+snapshot is stale.
+
+File layout; all integers are unsigned 32-bit little-endian, except
+the sequence number which is 64-bit:
+- header: magic, number of accounts, offset of account index,
+  number of teams, offset of team index, sequence number of last change
+- index: one entry per item, sorted by name: offset and length of
+  the name, offset and length of the JSON-encoded item data
+- the names and the data
+"""
+
+import os
+import json
+import mmap
+import struct
+import threading
+
+from whoyou import configuration
+from whoyou.database import Database, Account, rstr, utf8
+
+
+MAGIC = b'WHOYOU02'
+HEADER = struct.Struct('<8sIIIIQ')
+ENTRY = struct.Struct('<IIII')
+
+
+class SnapshotError(IOError):
+    "The snapshot file is invalid or corrupt."
+    pass
+
+
+def export(db, path=configuration.SNAPSHOT_FILE):
+    """Write the snapshot of the accounts and teams in the open database.
+    The file is replaced atomically.
+    """
+    # The names are sorted as encoded, since the reader compares bytes.
+    accounts = []
+    teams = []
+    with db.read_snapshot():
+        version = db.get_read_version()
+        for account in db.get_accounts():
+            data = account.get_data(effective=True)
+            data['password'] = account.password
+            accounts.append((utf8(account.name), utf8(json.dumps(data))))
+        for team in db.get_teams():
+            data = team.get_data(effective=True)
+            teams.append((utf8(team.name), utf8(json.dumps(data))))
+    accounts.sort()
+    teams.sort()
+    chunks = []
+    position = HEADER.size + ENTRY.size * (len(accounts) + len(teams))
+    entries = []
+    for name, data in accounts + teams:
+        entries.append(ENTRY.pack(position, len(name),
+                                  position + len(name), len(data)))
+        chunks.append(name)
+        chunks.append(data)
+        position += len(name) + len(data)
+    header = HEADER.pack(MAGIC,
+                         len(accounts), HEADER.size,
+                         len(teams), HEADER.size + ENTRY.size * len(accounts),
+                         version)
+    tmppath = path + '.tmp'
+    outfile = open(tmppath, 'wb')
+    try:
+        outfile.write(header)
+        outfile.write(b''.join(entries))
+        outfile.write(b''.join(chunks))
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    finally:
+        outfile.close()
+    os.rename(tmppath, path)
+
+
+class Snapshot(object):
+    "Reader of the snapshot file."
+
+    def __init__(self, path=None):
+        self.path = path or configuration.SNAPSHOT_FILE
+        self.lock = threading.Lock()
+        self.current = None
+        self.reload()
+
+    def reload(self):
+        """Open the snapshot file again, if it has been replaced.
+        Raise IOError or OSError if there is no snapshot file,
+        and SnapshotError if it is invalid.
+        """
+        stat = os.stat(self.path)
+        key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        current = self.current
+        if current and current[0] == key: return
+        with self.lock:
+            current = self.current
+            if current and current[0] == key: return
+            infile = open(self.path, 'rb')
+            try:
+                content = mmap.mmap(infile.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+            finally:
+                infile.close()
+            self.check(content)
+            header = HEADER.unpack_from(content, 0)
+            # A single assignment; lookups in progress keep the old mapping.
+            self.current = (key, content, header)
+
+    def check(self, content):
+        """Check that the header and the index entries lie within the file.
+        Raise SnapshotError otherwise.
+        """
+        size = len(content)
+        if size < HEADER.size or content[:len(MAGIC)] != MAGIC:
+            raise SnapshotError("invalid snapshot file '%s'" % self.path)
+        header = HEADER.unpack_from(content, 0)
+        for count, offset in [(header[1], header[2]), (header[3], header[4])]:
+            if offset + count * ENTRY.size > size:
+                raise SnapshotError("truncated snapshot file '%s'" % self.path)
+        if header[1] + header[3]:
+            # The data of the last entry ends at the end of the file.
+            entry = ENTRY.unpack_from(content, HEADER.size +
+                                      ENTRY.size * (header[1]+header[3]-1))
+            if entry[2] + entry[3] != size:
+                raise SnapshotError("truncated snapshot file '%s'" % self.path)
+
+    def get_version(self):
+        """Return the sequence number of the last change in the database
+        when the snapshot was exported.
+        """
+        self.reload()
+        return self.current[2][5]
+
+    def load(self, content, entry):
+        "Return the data of the index entry. Raise SnapshotError if corrupt."
+        try:
+            return rstr(json.loads(content[entry[2]:entry[2]+entry[3]]
+                                   .decode('utf-8')))
+        except ValueError:
+            raise SnapshotError("corrupt snapshot file '%s'" % self.path)
+
+    def find(self, content, count, offset, name):
+        "Return the data for the name using binary search of the index."
+        name = utf8(name)
+        low = 0
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            entry = ENTRY.unpack_from(content, offset + middle * ENTRY.size)
+            key = content[entry[0]:entry[0]+entry[1]]
+            if key < name:
+                low = middle + 1
+            elif key > name:
+                high = middle
+            else:
+                return self.load(content, entry)
+        return None
+
+    def all(self, content, count, offset):
+        "Return the data for all items in the index."
+        result = []
+        for position in range(offset, offset + count * ENTRY.size,
+                              ENTRY.size):
+            entry = ENTRY.unpack_from(content, position)
+            result.append(self.load(content, entry))
+        return result
+
+    def get_account(self, name, password=None, effective=False):
+        """Return the account data dictionary.
+        If the password is given, then authenticate.
+        Raise KeyError if no such account.
+        Raise ValueError if incorrect password.
+        """
+        self.reload()
+        key, content, header = self.current
+        data = self.find(content, header[1], header[2], name)
+        if data is None:
+            raise KeyError("no such Account '%s'" % name)
+        hexdigest = data.pop('password')
+        if password and hexdigest:
+            if Account.get_password_hexdigest(password) != hexdigest:
+                raise ValueError('incorrect password')
+        if not effective:
+            data.pop('effective_teams')
+        return data
+
+    def get_accounts(self):
+        "Return a list of all accounts as dictionaries."
+        self.reload()
+        key, content, header = self.current
+        result = self.all(content, header[1], header[2])
+        for data in result:
+            data.pop('password')
+            data.pop('effective_teams')
+        return result
+
+    def get_team(self, name, effective=False):
+        """Return the team data dictionary.
+        Raise KeyError if no such team.
+        """
+        self.reload()
+        key, content, header = self.current
+        data = self.find(content, header[3], header[4], name)
+        if data is None:
+            raise KeyError("no such Team '%s'" % name)
+        if not effective:
+            data.pop('effective_members')
+        return data
+
+
+if __name__ == '__main__':
+    db = Database()
+    db.open()
+    export(db)
+    db.close()
+    print("Exported snapshot to '%s'." % configuration.SNAPSHOT_FILE)
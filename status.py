@@ -0,0 +1,50 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Status resource, for monitoring.
+"""
+
+import pprint
+
+from .base import *
+from .cache import missing_accounts, missing_teams
+from .compression import response_cache
+
+
+class StatusHtmlRepresentation(HtmlRepresentation):
+    "HTML representation of the status data."
+
+    def get_content(self):
+        table = TABLE()
+        for key in self.data['status_items']:
+            table.append(TR(TH(key),
+                            TD(PRE(pprint.pformat(self.data[key])))))
+        return table
+
+
+class GET_Status(MethodMixin, GET):
+    "Counters and statistics of this server process, for monitoring."
+
+    outreprs = [JsonRepresentation,
+                TextRepresentation,
+                StatusHtmlRepresentation]
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        data = dict(title='Status')
+        data['login_throttle'] = login_throttle.get_stats()
+        data['missing_accounts'] = missing_accounts.get_stats()
+        data['missing_teams'] = missing_teams.get_stats()
+        data['database_caches'] = self.db.get_cache_stats()
+        data['response_cache'] = response_cache.get_stats()
+        data['status_items'] = ['login_throttle',
+                                'missing_accounts',
+                                'missing_teams',
+                                'database_caches',
+                                'response_cache']
+        if self.db.writer is not None:
+            data['writer'] = self.db.writer.get_stats()
+            data['status_items'].append('writer')
+        return data
@@ -4,6 +4,7 @@ Team resources.
 """
 
 import string
+import json
 
 from .base import *
 from .database import Account
@@ -13,19 +14,30 @@ class TeamsHtmlRepresentation(HtmlRepresentation):
     "HTML representation of the teams list."
 
     def get_content(self):
+        if self.data.get('summary'):
+            rows = [TR(TH('Name'),
+                       TH('Administrators'),
+                       TH('Members'))]
+            for team in self.data['teams']:
+                rows.append(TR(TD(A(team['name'], href=team['href'])),
+                               TD(str(team['admin_count'])),
+                               TD(str(team['member_count']))))
+            return TABLE(klass='list', *rows)
         rows = [TR(TH('Name'),
                    TH('Administrators'),
                    TH('Members'))]
         for team in self.data['teams']:
             administrators = []
             members = []
-            for account in team['members']:
+            for account in team.get('members', []):
                 name = "%(name)s" % account
                 if account['is_admin']:
                     administrators.append(str(A(name, href=account['href'])))
                 else:
                     members.append(str(A(name, href=account['href'])))
-            rows.append(TR(TD(A(team['name'], href=team['href'])),
+            # The 'fields' value may have excluded the name.
+            name = team.get('name') or team['href']
+            rows.append(TR(TD(A(name, href=team['href'])),
                            TD(', '.join(administrators)),
                            TD(', '.join(members))))
         return TABLE(klass='list', *rows)
@@ -38,6 +50,14 @@ class GET_Teams(MethodMixin, GET):
                 TextRepresentation,
                 TeamsHtmlRepresentation]
 
+    fields = (StringField('fields', title='Fields',
+                          descr='Names of the items to include,'
+                          ' comma-separated. Default: all.'),
+              StringField('summary', title='Summary',
+                          descr="If 'true', then only the name, description,"
+                          ' number of members and number of administrators'
+                          ' of each team.'))
+
     def is_accessible(self):
         return self.is_login_admin()
 
@@ -48,22 +68,43 @@ class GET_Teams(MethodMixin, GET):
 
     def get_data_resource(self, request):
         "Return the dictionary with the resource-specific response data."
+        values = self.parse_fields(request)
         data = dict(title='Teams')
-        data['teams'] = []
         get_url = request.application.get_url
+        if values.get('summary') == 'true':
+            data['summary'] = True
+            data['teams'] = self.db.get_team_summaries()
+            for teamdata in data['teams']:
+                teamdata['href'] = get_url('team', teamdata['name'])
+            return data
+        fields = self.get_selected_fields(values, TEAM_FIELDS)
+        if fields is None or 'members' in fields:
+            admin_flags = self.db.get_admin_flags()
+        data['teams'] = []
         for team in self.db.get_teams():
-            teamdata = team.get_data()
+            teamdata = team.get_data(fields=fields)
             teamdata['href'] = get_url('team', team)
-            teamdata['members'] = []
-            for account in team.get_members():
-                accountdata = dict(name=str(account),
-                                   href=get_url('account', account),
-                                   is_admin=team.is_admin(account))
-                teamdata['members'].append(accountdata)
+            if 'members' in teamdata:
+                flags = admin_flags.get(team.name, dict())
+                teamdata['members'] = [dict(name=name,
+                                            href=get_url('account', name),
+                                            is_admin=flags.get(name, False))
+                                       for name in teamdata['members']]
             data['teams'].append(teamdata)
         return data
 
 
+class GET_TeamOptions(OptionsMixin, MethodMixin, GET):
+    "The names of the teams starting with a prefix, for typeahead input."
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_options(self, prefix, limit):
+        "Return the sorted list of team names starting with the prefix."
+        return self.db.get_team_names(prefix, limit)
+
+
 class TeamHtmlRepresentation(HtmlRepresentation):
     "HTML representation of the team data."
 
@@ -71,17 +112,21 @@ class TeamHtmlRepresentation(HtmlRepresentation):
         team = self.data['team']
         administrators = []
         members = []
-        for account in team['members']:
+        for account in team.get('members', []):
             name = account['name']
             if account['is_admin']:
                 administrators.append(str(A(name, href=account['href'])))
             else:
                 members.append(str(A(name, href=account['href'])))
+        subteams = [str(A(t['name'], href=t['href']))
+                    for t in team.get('subteams', [])]
         table = TABLE(klass='input')
         table.append(TR(TH('Administrators'),
                         TD(' '.join(administrators))))
         table.append(TR(TH('Members'),
                         TD(' '.join(members))))
+        table.append(TR(TH('Subteams'),
+                        TD(' '.join(subteams))))
         table.append(TR(TH('Description'),
                         TD(self.to_html(team.get('description')))))
         return table
@@ -97,13 +142,13 @@ class TeamMixin(object):
         be confused for a FORMAT specification.
         """
         try:
-            self.team = Team(self.db, request.variables['team'])
+            self.team = self.db.get_team(request.variables['team'])
         except KeyError:
             if not request.variables.get('FORMAT'):
                 raise HTTP_NOT_FOUND
             name = request.variables['team'] + request.variables['FORMAT']
             try:
-                self.team = Team(self.db, name)
+                self.team = self.db.get_team(name)
             except KeyError:
                 raise HTTP_NOT_FOUND
             request.undo_format_specifier('team')
@@ -120,6 +165,10 @@ class GET_Team(TeamMixin, MethodMixin, GET):
                 TextRepresentation,
                 TeamHtmlRepresentation]
 
+    fields = (StringField('fields', title='Fields',
+                          descr='Names of the items to include,'
+                          ' comma-separated. Default: all.'),)
+
     def is_accessible(self):
         return self.is_login_admin() or self.is_login_member()
 
@@ -131,15 +180,26 @@ class GET_Team(TeamMixin, MethodMixin, GET):
     def get_data_resource(self, request):
         "Return the dictionary with the resource-specific response data."
         data = dict(title="Team %s" % self.team)
-        data['team'] = self.team.get_data()
-        members = []
-        for name in data['team'].pop('members'):
-            url = request.application.get_url('account', name)
-            is_admin = self.team.is_admin(self.db.get_account(name))
-            members.append(dict(name=name,
-                                href=url,
-                                is_admin=is_admin))
-        data['team']['members'] = members
+        values = self.parse_fields(request)
+        fields = self.get_selected_fields(values, TEAM_FIELDS)
+        data['team'] = self.team.get_data(fields=fields)
+        if 'members' in data['team']:
+            flags = self.db.get_admin_flags(self.team).get(self.team.name,
+                                                           dict())
+            members = []
+            for name in data['team'].pop('members'):
+                url = request.application.get_url('account', name)
+                members.append(dict(name=name,
+                                    href=url,
+                                    is_admin=flags.get(name, False)))
+            data['team']['members'] = members
+        if 'subteams' in data['team']:
+            subteams = []
+            for name in data['team'].pop('subteams'):
+                subteams.append(dict(name=name,
+                                     href=request.application.get_url('team',
+                                                                      name)))
+            data['team']['subteams'] = subteams
         return data
 
 
@@ -156,7 +216,18 @@ class GET_TeamEdit(TeamMixin, MethodMixin, GET):
               MultiSelectField('administrators', title='Administrators',
                                check=False,
                                descr='Check the members to be'
-                               ' administrators of this group.'))
+                               ' administrators of this group.'),
+              StringField('add_administrators',
+                          title='Add administrators', length=30,
+                          descr='Names of further members to be'
+                          ' administrators, separated by blanks or commas.'),
+              MultiSelectField('subteams', title='Subteams',
+                               check=False,
+                               descr='Teams whose members are also'
+                               ' members of this team.'),
+              StringField('add_subteams', title='Add subteams', length=30,
+                          descr='Names of further subteams,'
+                          ' separated by blanks or commas.'))
 
     def is_accessible(self):
         return self.is_login_admin() or self.is_login_member()
@@ -164,12 +235,22 @@ class GET_TeamEdit(TeamMixin, MethodMixin, GET):
     def get_data_resource(self, request):
         "Return the dictionary with the resource-specific response data."
         data = dict(title="Edit team %s" % self.team)
-        override = dict(administrators=dict(options=[str(m) for m in
-                                                     self.team.get_members()],
-                                            default=[str(a) for a in
-                                                     self.team.get_admins()]))
-        cancel = request.application.get_url('team', self.team)
-        data['form'] = dict(fields=self.get_data_fields(override=override),
+        get_url = request.application.get_url
+        admins = [str(a) for a in self.team.get_admins()]
+        override = dict(administrators=dict(options=admins, default=admins),
+                        add_administrators=dict(
+                            options_href=get_url('accounts', 'options')))
+        if self.is_login_admin():
+            skip = set()
+            subteams = [str(t) for t in self.team.get_subteams()]
+            override['subteams'] = dict(options=subteams, default=subteams)
+            override['add_subteams'] = dict(
+                options_href=get_url('teams', 'options'))
+        else:
+            skip = set(['subteams', 'add_subteams'])
+        cancel = get_url('team', self.team)
+        data['form'] = dict(fields=self.get_data_fields(skip=skip,
+                                                        override=override),
                             values=dict(description=self.team.description),
                             label='Save',
                             title='Modify team data',
@@ -189,9 +270,27 @@ class POST_TeamEdit(TeamMixin, MethodMixin, RedirectMixin, POST):
     def process(self, request):
         "Handle the request; perform actions according to the request."
         values = self.parse_fields(request)
+        # The cached instance is shared by other requests; edit a new one.
+        self.team = Team(self.db, name=self.team.name)
         self.team.description = values.get('description', None)
+        admins = values.get('administrators') or []
+        for name in self.split_names(values.get('add_administrators')):
+            try:
+                account = self.db.get_account(name)
+            except KeyError:
+                raise HTTP_BAD_REQUEST("no such account '%s'" % name)
+            if not self.team.is_member(account):
+                raise HTTP_BAD_REQUEST("account '%s' is not a member" % name)
+            admins.append(name)
         self.team.save()
-        self.team.set_admins(values.get('administrators', []))
+        self.team.set_admins(admins)
+        if self.is_login_admin():
+            subteams = values.get('subteams') or []
+            subteams.extend(self.split_names(values.get('add_subteams')))
+            try:
+                self.team.set_subteams(subteams)
+            except ValueError, msg:
+                raise HTTP_BAD_REQUEST(str(msg))
         self.set_redirect(request.application.get_url('team', self.team))
 
 
@@ -252,3 +351,61 @@ class POST_TeamCreate(MethodMixin, RedirectMixin, POST):
         self.team.description = values.get('description', None)
         self.team.save()
         self.set_redirect(request.application.get_url('team', self.team))
+
+
+class GET_Memberships(MethodMixin, GET):
+    "The form to edit memberships of many accounts in many teams."
+
+    outreprs = [JsonRepresentation,
+                TextRepresentation,
+                FormHtmlRepresentation]
+
+    fields = (TextField('operations', title='Operations',
+                        required=True,
+                        descr='JSON list of operations, each an object'
+                        ' with items: action ("add", "remove", "promote"'
+                        ' or "demote"), team (name) and accounts'
+                        ' (list of names).'),)
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        data = dict(title='Edit memberships')
+        data['form'] = dict(fields=self.get_data_fields(),
+                            title='Enter membership operations',
+                            label='Apply',
+                            href=request.get_url(),
+                            cancel=request.application.get_url('teams'))
+        return data
+
+
+class POST_Memberships(MethodMixin, POST):
+    """Edit memberships of many accounts in many teams in one transaction.
+    Return the result for each account in each operation."""
+
+    outreprs = [JsonRepresentation,
+                TextRepresentation]
+
+    fields = GET_Memberships.fields
+
+    def is_accessible(self):
+        return self.is_login_admin()
+
+    def process(self, request):
+        "Handle the request; perform actions according to the request."
+        values = self.parse_fields(request)
+        try:
+            operations = json.loads(values['operations'])
+            if not isinstance(operations, list): raise ValueError
+            if not all([isinstance(o, dict) for o in operations]):
+                raise ValueError
+        except ValueError:
+            raise HTTP_BAD_REQUEST('operations must be a JSON list of objects')
+        self.results = self.db.edit_memberships(operations)
+
+    def get_data_resource(self, request):
+        "Return the dictionary with the resource-specific response data."
+        return dict(title='Membership edit results',
+                    results=self.results)
@@ -1,16 +1,221 @@
 """ WhoYou: Simple accounts database for web applications.
 
-Unit tests for the web resource API.
+Unit tests for the web resource API, and for the database and
+interface modules.
+
+The requests are made in-process on the WSGI application, using a new
+temporary database for each test; no web server is required. The web
+resource tests require 'wrapid' 12.5 or 12.7, and are skipped if it is
+unavailable, as under Python 3. The tests of 'async_interface' require
+Python 3.
+
+Run from the directory containing the package:
+    python -m unittest whoyou.tests
 """
 
-import httplib
+import os
+import io
+import zlib
+import json
+import time
+import base64
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import threading
+import wsgiref.util
+try:
+    import httplib
+    from urllib import urlencode
+except ImportError:                 # Python 3
+    import http.client as httplib
+    from urllib.parse import urlencode
 
-from wrapid.testbase import *
+from whoyou import configuration
+from whoyou import interface
+from whoyou import compression
+from whoyou import maintenance
+from whoyou import snapshot
+from whoyou.cache import LruCache, NegativeCache
+from whoyou.cache import missing_accounts, missing_teams
+from whoyou.writer import Writer, Write
+from whoyou.throttle import LoginThrottle, login_throttle
+from whoyou.database import Database, Account, SCHEMA_VERSION
+from whoyou.database import get_shared_database, close_shared_database
+# The versions of 'wrapid' supported by 'wsgi_application'.
+WRAPID_VERSIONS = ('12.5', '12.7')
+try:
+    import wrapid
+except ImportError:
+    application = None
+else:
+    if wrapid.__version__ in WRAPID_VERSIONS:
+        from whoyou.wsgi_application import application
+    else:
+        application = None
+try:
+    from whoyou import async_interface
+    import asyncio
+except ImportError:
+    async_interface = None
 
 
-URL = 'http://localhost/whoyou'
 ACCOUNT = 'test'
 PASSWORD = 'abc123'
+EMAIL = 'test@example.com'
+ADMIN_PASSWORD = 'admin123'
+
+# The directory for the temporary databases; see 'setUpModule'.
+DIRPATH = None
+
+
+def setUpModule():
+    global DIRPATH
+    DIRPATH = tempfile.mkdtemp(prefix='whoyou-tests-')
+
+def tearDownModule():
+    shutil.rmtree(DIRPATH, ignore_errors=True)
+
+def create_database(path):
+    """Create the database at the path, containing the 'admin' account
+    and team, the 'anonymous' account and the test account.
+    """
+    db = Database(path)
+    db.open()
+    db.create()
+    admin = db.create_account('admin',
+                              password=ADMIN_PASSWORD,
+                              description='Site administrator.')
+    team = db.create_team('admin',
+                          description='Accounts with admin privileges.')
+    team.add_member(admin, admin=True)
+    db.create_account('anonymous',
+                      description='Anonymous user without password.')
+    account = db.create_account(ACCOUNT,
+                                password=PASSWORD,
+                                description='Test account.')
+    account.email = EMAIL
+    account.save()
+    db.close()
+
+
+class Response(object):
+    "The outcome of a request: HTTP status code, headers and body."
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class Client(object):
+    "Make requests to the WSGI application, logged in as an account."
+
+    def __init__(self, account, password, accept='application/json'):
+        self.account = account
+        self.password = password
+        self.accept = accept
+
+    def __str__(self):
+        return "%s as %s" % (self.__class__.__name__, self.account)
+
+    def GET(self, path):
+        return self.request('GET', path)
+
+    def POST(self, path, data=None):
+        return self.request('POST', path, data=data)
+
+    def request(self, method, path, data=None):
+        """Call the application with the environ for the request,
+        and return the Response.
+        """
+        path, query = (path.split('?', 1) + [''])[:2]
+        environ = dict(REQUEST_METHOD=method,
+                       PATH_INFO=path,
+                       QUERY_STRING=query,
+                       REMOTE_ADDR='127.0.0.1',
+                       HTTP_ACCEPT=self.accept)
+        credentials = "%s:%s" % (self.account, self.password)
+        credentials = base64.b64encode(credentials.encode('utf-8'))
+        environ['HTTP_AUTHORIZATION'] = "Basic %s" % credentials.decode()
+        body = urlencode(data or dict(), doseq=True).encode('utf-8')
+        environ['wsgi.input'] = io.BytesIO(body)
+        if method == 'POST':
+            environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+            environ['CONTENT_LENGTH'] = str(len(body))
+        wsgiref.util.setup_testing_defaults(environ)
+        captured = []
+        chunks = []
+        def start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+            return chunks.append
+        result = application(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers = captured
+        return Response(int(status.split()[0]),
+                        dict([(n.lower(), v) for n, v in headers]),
+                        b''.join(chunks))
+
+
+class DatabaseTestBase(unittest.TestCase):
+    """Base class creating a new database for each test, which is made
+    the master database. It is a database file, or if 'memory' is true,
+    a temporary database file in memory; see 'add_memory_variants'.
+    """
+
+    memory = False
+
+    def setUp(self):
+        if self.memory:
+            if not os.path.isdir(configuration.MEMORY_DIR):
+                raise unittest.SkipTest("requires directory '%s'" %
+                                        configuration.MEMORY_DIR)
+            self.path = "memory:%s" % self.id()
+        else:
+            self.path = os.path.join(DIRPATH, "%s.sql3" % self.id())
+        create_database(self.path)
+        self.saved_path = configuration.MASTER_DB_FILE
+        configuration.MASTER_DB_FILE = self.path
+
+    def tearDown(self):
+        close_shared_database(self.path)
+        configuration.MASTER_DB_FILE = self.saved_path
+
+
+class TestBase(DatabaseTestBase):
+    """Base class for the web resource tests, with the clients
+    for the test account and the 'admin' account.
+    """
+
+    def setUp(self):
+        if application is None:
+            raise unittest.SkipTest("requires 'wrapid' version %s" %
+                                    ' or '.join(WRAPID_VERSIONS))
+        DatabaseTestBase.setUp(self)
+        self.wr = Client(ACCOUNT, PASSWORD)
+        self.admin = Client('admin', ADMIN_PASSWORD)
+
+    def get_wr(self, accept):
+        "Return a client for the test account accepting the content type."
+        return Client(ACCOUNT, PASSWORD, accept=accept)
+
+    def get_headers(self, response):
+        "Return the headers of the response, keyed by lowercase name."
+        return response.headers
+
+    def get_json_data(self, response):
+        "Return the body of the response decoded from JSON."
+        return json.loads(response.body.decode('utf-8'))
+
+    def assertRedirect(self, response):
+        "Check that the response is a redirect, as after a successful POST."
+        self.assertTrue(response.status in (httplib.FOUND, httplib.SEE_OTHER),
+                     msg="HTTP status %s" % response.status)
 
 
 class TestAccess(TestBase):
@@ -23,7 +228,7 @@ class TestAccess(TestBase):
         self.assertEqual(response.status, httplib.OK,
                          msg="HTTP status %s" % response.status)
         headers = self.get_headers(response)
-        self.assert_(headers.get('content-type').startswith('text/html'))
+        self.assertTrue(headers.get('content-type').startswith('text/html'))
 
     def test_GET_home_JSON(self):
         "Fetch the home page, in JSON format."
@@ -31,7 +236,7 @@ class TestAccess(TestBase):
         self.assertEqual(response.status, httplib.OK,
                          msg="HTTP status %s" % response.status)
         headers = self.get_headers(response)
-        self.assert_(headers['content-type'].startswith('application/json'),
+        self.assertTrue(headers['content-type'].startswith('application/json'),
                      msg=headers['content-type'])
         self.get_json_data(response)
 
@@ -48,6 +253,30 @@ class TestAccess(TestBase):
         self.assertEqual(response.status, httplib.NOT_FOUND,
                          msg="HTTP status %s" % response.status)
 
+    def test_GET_home_wrong_password(self):
+        "Try fetching the home page with an invalid password."
+        wr = Client(ACCOUNT, 'wrong')
+        response = wr.GET('/')
+        self.assertEqual(response.status, httplib.UNAUTHORIZED,
+                         msg="HTTP status %s" % response.status)
+
+    def test_GET_home_throttled_email(self):
+        "Failed logins by variants of the email address count together."
+        login_throttle.entries.clear()
+        try:
+            variants = [EMAIL, EMAIL.upper(), EMAIL.title()]
+            for i in range(configuration.LOGIN_ACCOUNT_BURST):
+                wr = Client(variants[i % len(variants)], 'wrong')
+                response = wr.GET('/')
+                self.assertEqual(response.status, httplib.UNAUTHORIZED,
+                                 msg="HTTP status %s" % response.status)
+            # Rejected, although the password is correct.
+            response = Client(EMAIL.lower(), PASSWORD).GET('/')
+            self.assertEqual(response.status, httplib.UNAUTHORIZED,
+                             msg="HTTP status %s" % response.status)
+        finally:
+            login_throttle.entries.clear()
+
 
 class TestAccount(TestBase):
     "Test account handling."
@@ -58,15 +287,62 @@ class TestAccount(TestBase):
         self.assertEqual(response.status, httplib.FORBIDDEN,
                          msg="HTTP status %s" % response.status)
 
+    def test_GET_accounts_admin(self):
+        "Fetch the names of all accounts, as admin."
+        response = self.admin.GET('/accounts?fields=name')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        data = self.get_json_data(response)
+        names = set([a['name'] for a in data['accounts']])
+        self.assertEqual(names, set(['admin', 'anonymous', ACCOUNT]))
+
+    def test_GET_accounts_admin_HTML_fields(self):
+        "Fetch the accounts list without names, in HTML format, as admin."
+        admin = Client('admin', ADMIN_PASSWORD, accept='text/html')
+        response = admin.GET('/accounts?fields=email')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+
     def test_GET_account(self):
         "Fetch the data for this account, in JSON format."
         response = self.wr.GET("/account/%s" % self.wr.account)
         self.assertEqual(response.status, httplib.OK,
                          msg="HTTP status %s" % response.status)
         headers = self.get_headers(response)
-        self.assert_(headers['content-type'].startswith('application/json'),
+        self.assertTrue(headers['content-type'].startswith('application/json'),
                      msg=headers['content-type'])
-        self.get_json_data(response)
+        data = self.get_json_data(response)
+        self.assertEqual(data['account']['name'], ACCOUNT)
+        self.assertEqual(data['account']['email'], EMAIL)
+
+    def test_GET_account_email_login(self):
+        "Fetch the data for this account, logged in by email address."
+        wr = Client(EMAIL, PASSWORD)
+        response = wr.GET("/account/%s" % ACCOUNT)
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+
+    def test_GET_account_fields(self):
+        "Fetch only the name and email of this account, in JSON format."
+        response = self.wr.GET("/account/%s?fields=name,email"
+                               % self.wr.account)
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        data = self.get_json_data(response)
+        self.assertEqual(set(data['account'].keys()), set(['name', 'email']))
+
+    def test_GET_account_fields_invalid(self):
+        "Try fetching a nonexistent item of this account."
+        response = self.wr.GET("/account/%s?fields=name,xyz"
+                               % self.wr.account)
+        self.assertEqual(response.status, httplib.BAD_REQUEST,
+                         msg="HTTP status %s" % response.status)
+
+    def test_GET_account_options(self):
+        "Try fetching account name options for non-admin test user."
+        response = self.wr.GET('/accounts/options?prefix=ad')
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
 
     def test_GET_account_admin(self):
         "Try fetching 'admin' account data."
@@ -75,8 +351,1332 @@ class TestAccount(TestBase):
                          msg="HTTP status %s" % response.status)
 
 
+class TestAccountEdit(TestBase):
+    "Test editing an account."
+
+    def test_GET_account_edit(self):
+        "Fetch the edit form for this account."
+        response = self.wr.GET("/account/%s/edit" % self.wr.account)
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        data = self.get_json_data(response)
+        self.assertTrue('form' in data)
+
+    def test_POST_account_edit(self):
+        "Change the email and description of this account."
+        response = self.wr.POST("/account/%s/edit" % self.wr.account,
+                                dict(password=PASSWORD,
+                                     email='other@example.com',
+                                     description='Changed.'))
+        self.assertRedirect(response)
+        response = self.wr.GET("/account/%s" % self.wr.account)
+        data = self.get_json_data(response)
+        self.assertEqual(data['account']['email'], 'other@example.com')
+        self.assertEqual(data['account']['description'], 'Changed.')
+
+    def test_POST_account_edit_password(self):
+        "Change the password of this account, and log in with it."
+        response = self.wr.POST("/account/%s/edit" % self.wr.account,
+                                dict(password=PASSWORD,
+                                     new_password='xyz789',
+                                     confirm_new_password='xyz789'))
+        self.assertRedirect(response)
+        response = Client(ACCOUNT, 'xyz789').GET('/')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+
+    def test_POST_account_edit_confirm(self):
+        "Try changing the password with a mismatched confirmation."
+        response = self.wr.POST("/account/%s/edit" % self.wr.account,
+                                dict(password=PASSWORD,
+                                     new_password='xyz789',
+                                     confirm_new_password='xyz788'))
+        self.assertEqual(response.status, httplib.BAD_REQUEST,
+                         msg="HTTP status %s" % response.status)
+
+    def test_POST_account_edit_current(self):
+        "Try editing this account with an invalid current password."
+        response = self.wr.POST("/account/%s/edit" % self.wr.account,
+                                dict(password='wrong',
+                                     description='Changed.'))
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+    def test_POST_account_edit_admin(self):
+        "Try editing the 'admin' account."
+        response = self.wr.POST('/account/admin/edit',
+                                dict(password=PASSWORD,
+                                     description='Changed.'))
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+
+class TestTeam(TestBase):
+    "Test team handling."
+
+    def test_GET_teams(self):
+        "Try fetching teams list for non-admin test user."
+        response = self.wr.GET('/teams')
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+    def test_GET_teams_admin(self):
+        "Fetch the teams list, as admin."
+        response = self.admin.GET('/teams')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        data = self.get_json_data(response)
+        self.assertEqual([t['name'] for t in data['teams']], ['admin'])
+
+    def test_GET_teams_admin_HTML_fields(self):
+        "Fetch the teams list without names, in HTML format, as admin."
+        admin = Client('admin', ADMIN_PASSWORD, accept='text/html')
+        response = admin.GET('/teams?fields=members')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+
+    def test_GET_teams_summary(self):
+        "Fetch the teams summary list, as admin."
+        response = self.admin.GET('/teams?summary=true')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        data = self.get_json_data(response)
+        self.assertEqual(data['teams'][0]['member_count'], 1)
+        self.assertEqual(data['teams'][0]['admin_count'], 1)
+
+    def test_GET_team(self):
+        "Try fetching the 'admin' team for non-member test user."
+        response = self.wr.GET('/team/admin')
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+    def test_GET_team_admin(self):
+        "Fetch the 'admin' team, as admin."
+        response = self.admin.GET('/team/admin')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        data = self.get_json_data(response)
+        members = data['team']['members']
+        self.assertEqual([m['name'] for m in members], ['admin'])
+        self.assertTrue(members[0]['is_admin'])
+
+    def test_GET_team_nonexistent(self):
+        "Try fetching a non-existent team."
+        response = self.admin.GET('/team/doesnotexist')
+        self.assertEqual(response.status, httplib.NOT_FOUND,
+                         msg="HTTP status %s" % response.status)
+
+
+class TestTeamEdit(TestBase):
+    "Test creating and editing teams, and editing memberships."
+
+    def test_POST_team_create(self):
+        "Create a team, as admin."
+        response = self.admin.POST('/team',
+                                   dict(name='testers',
+                                        description='Test team.'))
+        self.assertRedirect(response)
+        response = self.admin.GET('/team/testers')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        data = self.get_json_data(response)
+        self.assertEqual(data['team']['description'], 'Test team.')
+
+    def test_POST_team_create_existing(self):
+        "Try creating a team with the name of an existing team."
+        response = self.admin.POST('/team', dict(name='admin'))
+        self.assertEqual(response.status, httplib.BAD_REQUEST,
+                         msg="HTTP status %s" % response.status)
+
+    def test_POST_team_create_forbidden(self):
+        "Try creating a team for non-admin test user."
+        response = self.wr.POST('/team', dict(name='testers'))
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+    def test_POST_team_edit(self):
+        "Change the description of the 'admin' team, as admin."
+        response = self.admin.POST('/team/admin/edit',
+                                   dict(description='Changed.',
+                                        administrators='admin'))
+        self.assertRedirect(response)
+        response = self.admin.GET('/team/admin')
+        data = self.get_json_data(response)
+        self.assertEqual(data['team']['description'], 'Changed.')
+        self.assertTrue(data['team']['members'][0]['is_admin'])
+
+    def test_POST_team_edit_forbidden(self):
+        "Try editing the 'admin' team for non-member test user."
+        response = self.wr.POST('/team/admin/edit',
+                                dict(description='Changed.'))
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+    def test_POST_memberships(self):
+        "Add the test account to the 'admin' team, as admin."
+        operations = [dict(action='add', team='admin', accounts=[ACCOUNT])]
+        response = self.admin.POST('/memberships',
+                                   dict(operations=json.dumps(operations)))
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        data = self.get_json_data(response)
+        self.assertEqual(data['results'][0]['status'], 'ok')
+        response = self.wr.GET("/check?account=%s&team=admin" % ACCOUNT)
+        data = self.get_json_data(response)
+        self.assertEqual(data['member'], True)
+        self.assertEqual(data['admin'], False)
+        # The test account is now an admin, by membership.
+        response = self.wr.GET('/teams')
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+
+
+class TestSearch(TestBase):
+    "Test search."
+
+    def test_GET_search(self):
+        "Try searching for non-admin test user."
+        response = self.wr.GET('/search?terms=adm')
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+
+class TestChanges(TestBase):
+    "Test the change log."
+
+    def test_GET_changes(self):
+        "Try fetching the change log for non-admin test user."
+        response = self.wr.GET('/changes?since=0')
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+
+class TestCheck(TestBase):
+    "Test the membership check."
+
+    def test_GET_check(self):
+        "Check the membership of this account in the 'admin' team."
+        response = self.wr.GET("/check?account=%s&team=admin"
+                               % self.wr.account)
+        self.assertEqual(response.status, httplib.OK,
+                         msg="HTTP status %s" % response.status)
+        headers = self.get_headers(response)
+        self.assertTrue('max-age' in headers['cache-control'],
+                     msg=headers['cache-control'])
+        data = self.get_json_data(response)
+        self.assertEqual(data['member'], False)
+        self.assertEqual(data['admin'], False)
+
+    def test_GET_check_other(self):
+        "Try checking the membership of another account."
+        response = self.wr.GET('/check?account=admin&team=admin')
+        self.assertEqual(response.status, httplib.FORBIDDEN,
+                         msg="HTTP status %s" % response.status)
+
+
+class TestDatabase(DatabaseTestBase):
+    "Test the database module directly."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = get_shared_database(self.path)
+        self.db.refresh()
+
+    def run_in_thread(self, function):
+        "Call the function in another thread, and wait for it to finish."
+        thread = threading.Thread(target=function)
+        thread.start()
+        thread.join()
+
+    def test_stale_snapshot_not_cached(self):
+        "Data read from a snapshot older than the last refresh is not cached."
+        self.db.begin_read()
+        def change():
+            account = Account(self.db, name=ACCOUNT)
+            account.description = 'Changed'
+            account.save()
+            self.db.refresh()
+        self.run_in_thread(change)
+        self.assertTrue(self.db.get_read_version() < self.db.last_change)
+        account = self.db.get_account(ACCOUNT)
+        self.assertNotEqual(account.description, 'Changed')
+        self.assertFalse(ACCOUNT in self.db.account_cache)
+        self.db.rollback()
+        self.db.refresh()
+        self.assertEqual(self.db.get_account(ACCOUNT).description, 'Changed')
+        self.assertTrue(ACCOUNT in self.db.account_cache)
+
+    def test_close_stops_writer(self):
+        "The writer thread is stopped when the database is closed."
+        db = Database(self.path)
+        db.open()
+        db.start_writer()
+        writer = db.writer
+        db.create_team('writers')
+        db.close()
+        self.assertFalse(writer.is_alive())
+        self.assertTrue(self.db.get_team('writers'))
+
+    def test_get_names(self):
+        "Names by prefix, also ending with the maximum character."
+        self.assertEqual(self.db.get_account_names('te'), [ACCOUNT])
+        self.assertEqual(self.db.get_account_names('an'), ['anonymous'])
+        self.assertEqual(self.db.get_account_names(ACCOUNT), [ACCOUNT])
+        self.assertEqual(self.db.get_account_names('te\xff'), [])
+        self.assertEqual(self.db.get_account_names(u'te\U0010ffff'), [])
+        self.assertEqual(self.db.get_team_names('\xff'), [])
+
+    def test_edit_memberships(self):
+        "Each invalid operation or account is reported as an error."
+        self.db.create_team('team1')
+        results = self.db.edit_memberships([
+                dict(action='add', team='team1',
+                     accounts=[ACCOUNT, 'anonymous', u'\xe5sa']),
+                dict(action='add', team=['team1'], accounts=[ACCOUNT]),
+                dict(action='add', team=dict(name='team1'),
+                     accounts=[ACCOUNT]),
+                dict(action='add', team='team1', accounts=ACCOUNT),
+                dict(action='add', team='team1', accounts=[ACCOUNT, 1]),
+                dict(action='promote', team='nosuchteam', accounts=[ACCOUNT]),
+                dict(action='xyz', team='team1', accounts=[ACCOUNT]),
+                dict(action='add', team='team1', accounts=[ACCOUNT])])
+        self.assertEqual([(r['account'], r['status']) for r in results],
+                         [(ACCOUNT, 'ok'), ('anonymous', 'ok'),
+                          (u'\xe5sa', 'error'),
+                          (None, 'error'), (None, 'error'), (None, 'error'),
+                          (None, 'error'),
+                          (ACCOUNT, 'error'), (ACCOUNT, 'error'),
+                          (ACCOUNT, 'unchanged')])
+        self.assertTrue(all([r['message'] for r in results
+                             if r['status'] == 'error']))
+        self.assertEqual(
+            sorted(self.db.get_team('team1').get_data()['members']),
+            ['anonymous', ACCOUNT])
+
+    def test_upgrade_earlier(self):
+        "A database created by an earlier version is upgraded when opened."
+        path = os.path.join(DIRPATH, "%s.earlier.sql3" % self.id())
+        cnx = sqlite3.connect(path)
+        cnx.executescript('CREATE TABLE account'
+                          '(id INTEGER PRIMARY KEY,'
+                          ' name TEXT UNIQUE NOT NULL, password TEXT,'
+                          ' email TEXT, description TEXT, properties TEXT);'
+                          'CREATE TABLE team'
+                          '(id INTEGER PRIMARY KEY,'
+                          ' name TEXT UNIQUE NOT NULL,'
+                          ' description TEXT, properties TEXT);'
+                          'CREATE TABLE account_team'
+                          '(account INTEGER NOT NULL, team INTEGER NOT NULL,'
+                          ' admin INTEGER, UNIQUE (account, team));'
+                          "INSERT INTO team VALUES (1, 'team1', NULL, '{}');"
+                          'INSERT INTO account_team VALUES (1, 1, 0);')
+        cnx.execute("INSERT INTO account VALUES (1, 'earlier', ?,"
+                    " 'Earlier@example.com', NULL, '{}')",
+                    (Account.get_password_hexdigest(PASSWORD),))
+        cnx.commit()
+        cnx.close()
+        db = Database(path)
+        db.open()
+        try:
+            self.assertEqual(db.get_schema_version(), SCHEMA_VERSION)
+            account = db.get_account('earlier', password=PASSWORD)
+            self.assertEqual(account.get_team_names(), ['team1'])
+            self.assertEqual(account.get_memberships(), [('team1', False)])
+            self.assertEqual(db.get_account_by_email('earlier@example.com'),
+                             account)
+        finally:
+            db.close()
+
+    def test_database_file(self):
+        "A 'memory:' path denotes a file in the memory directory."
+        if self.memory:
+            self.assertEqual(os.path.dirname(os.path.dirname(self.db.file)),
+                             configuration.MEMORY_DIR)
+        else:
+            self.assertEqual(self.db.file, self.path)
+
+    def test_get_account_copy(self):
+        "The data obtained does not share the properties of cached instances."
+        data = interface.get_account(ACCOUNT)
+        data['properties']['myapp'] = dict(level=1)
+        self.assertEqual(interface.get_account(ACCOUNT)['properties'], dict())
+
+    def test_update_account_properties(self):
+        "The cached instance is not modified by the update."
+        cached = self.db.get_account(ACCOUNT)
+        interface.update_account_properties(ACCOUNT, 'myapp', dict(level=1))
+        self.assertEqual(cached.properties, dict())
+        self.assertEqual(interface.get_account(ACCOUNT)['properties'],
+                         dict(myapp=dict(level=1)))
+
+    def test_get_admin_flags(self):
+        "The admin flags of the members of all teams, or of one team."
+        team = self.db.create_team('team1')
+        team.add_member(self.db.get_account(ACCOUNT))
+        team.add_member(self.db.get_account('admin'), admin=True)
+        self.assertEqual(self.db.get_admin_flags(),
+                         dict(admin=dict(admin=True),
+                              team1={ACCOUNT: False, 'admin': True}))
+        self.assertEqual(self.db.get_admin_flags(team),
+                         dict(team1={ACCOUNT: False, 'admin': True}))
+
+    def test_create_accounts_invalid_rows(self):
+        "Rows with invalid data are reported, and the others are created."
+        rows = [dict(name='good1', password=u'p\xe5ssw\xf6rd'),
+                dict(name='bad1', password=123456),
+                dict(name='bad2', password='abc123', email=42),
+                dict(name='bad3', password='abc123', teams='admin'),
+                dict(password='abc123'),
+                dict(name='good2', password='abc123', teams=['admin'])]
+        results = self.db.create_accounts(rows)
+        self.assertEqual([r['status'] for r in results],
+                         ['ok', 'error', 'error', 'error', 'error', 'ok'])
+        self.assertTrue(all([r['message'] for r in results[1:5]]))
+        self.db.get_account('good1', password=u'p\xe5ssw\xf6rd')
+        self.assertTrue(self.db.get_team('admin').is_member(
+                self.db.get_account('good2')))
+
+
+class TestDatabaseSearch(DatabaseTestBase):
+    "Test the full-text search of accounts and teams in the database."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = get_shared_database(self.path)
+        self.db.refresh()
+        self.db.create_account('alpha',
+                               description='Works on the beta project.')
+        self.db.create_account('beta', description='Another account.')
+        self.db.create_team('betamax', description='The tape team.')
+
+    def search(self, terms, limit=configuration.DEFAULT_LIMIT):
+        "Return the list of (type, name) of the search results, in order."
+        return [(r['type'], r['name'])
+                for r in self.db.search(terms, limit=limit)]
+
+    def test_ranking(self):
+        "A match in the name ranks above a match in the description."
+        result = self.search('beta')
+        self.assertEqual(sorted(result), [('account', 'alpha'),
+                                          ('account', 'beta'),
+                                          ('team', 'betamax')])
+        # The ranks of accounts and teams are from different indexes.
+        self.assertEqual([r for r in result if r[0] == 'account'],
+                         [('account', 'beta'), ('account', 'alpha')])
+
+    def test_prefix(self):
+        "Each word is a prefix; all words must match."
+        self.assertEqual(sorted(self.search('bet')),
+                         [('account', 'alpha'),
+                          ('account', 'beta'),
+                          ('team', 'betamax')])
+        self.assertEqual(self.search('betam'), [('team', 'betamax')])
+        self.assertEqual(self.search('beta proj'), [('account', 'alpha')])
+        self.assertEqual(self.search('exam'), [('account', ACCOUNT)])
+        self.assertEqual(self.search('eta'), [])
+        for terms in ['', '  ', '"*-', None]:
+            self.assertEqual(self.search(terms), [])
+
+    def test_limit(self):
+        "At most the given number of results, best match first."
+        self.assertEqual(len(self.search('bet', limit=2)), 2)
+        self.assertEqual(self.search('bet', limit=2),
+                         self.search('bet')[:2])
+        self.assertEqual(interface.search('bet', limit=1),
+                         [dict(type=t, name=n)
+                          for t, n in self.search('bet', limit=1)])
+
+    def test_update(self):
+        "The search index follows changes of the description."
+        account = self.db.get_account('beta')
+        account.description = 'Renamed to gamma.'
+        account.save()
+        self.assertEqual(self.search('gamma'), [('account', 'beta')])
+        self.assertEqual(self.search('another'), [])
+
+
+class TestChangeLog(DatabaseTestBase):
+    "Test the change log of the database, its paging and compaction."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = get_shared_database(self.path)
+        self.db.refresh()
+        self.since = self.db.get_last_change()
+        self.names = ["team%s" % i for i in range(5)]
+        for name in self.names:
+            self.db.create_team(name)
+
+    def test_order(self):
+        "The changes are in sequence order, after the given one."
+        result = self.db.get_changes(self.since)
+        self.assertFalse(result['more'])
+        self.assertFalse(result['resync'])
+        changes = result['changes']
+        self.assertEqual([c['name'] for c in changes], self.names)
+        self.assertEqual([c['type'] for c in changes], ['team'] * 5)
+        self.assertEqual([c['action'] for c in changes], ['create'] * 5)
+        seqs = [c['seq'] for c in changes]
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertTrue(seqs[0] > self.since)
+        self.assertEqual(result['last'], seqs[-1])
+        self.assertEqual(result['last'], self.db.get_last_change())
+        # Nothing after the last change.
+        result = self.db.get_changes(result['last'])
+        self.assertEqual(result['changes'], [])
+        self.assertEqual(result['last'], self.db.get_last_change())
+        self.assertFalse(result['more'])
+
+    def test_paging(self):
+        "Page through the changes by the limit, 'more' and 'last'."
+        names = []
+        since = self.since
+        pages = 0
+        while True:
+            result = self.db.get_changes(since, limit=2)
+            self.assertTrue(len(result['changes']) <= 2)
+            names.extend([c['name'] for c in result['changes']])
+            since = result['last']
+            pages += 1
+            if not result['more']: break
+        self.assertEqual(names, self.names)
+        self.assertEqual(pages, 3)
+        self.assertEqual(since, self.db.get_last_change())
+
+    def test_compaction(self):
+        "After compaction, a client too far behind must resync."
+        last = self.db.get_last_change()
+        self.db.compact_changes(keep=2)
+        result = self.db.get_changes(self.since)
+        self.assertTrue(result['resync'])
+        self.assertEqual(result['changes'], [])
+        self.assertEqual(result['last'], last)
+        # The changes kept are still available.
+        result = self.db.get_changes(last - 2)
+        self.assertFalse(result['resync'])
+        self.assertEqual([c['name'] for c in result['changes']],
+                         self.names[-2:])
+        # Continuing from the 'last' of the resync, without a gap.
+        self.db.create_team('team5')
+        result = self.db.get_changes(last)
+        self.assertFalse(result['resync'])
+        self.assertEqual([c['name'] for c in result['changes']], ['team5'])
+        self.assertEqual(interface.get_changes(last), result)
+
+
+class TestClosure(DatabaseTestBase):
+    """Test the closure of nested teams, and the effective memberships
+    maintained from it. The teams form a diamond: 'top' contains 'left'
+    and 'right', which both contain 'bottom'.
+    """
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = get_shared_database(self.path)
+        self.db.refresh()
+        self.teams = dict()
+        for name in ['top', 'left', 'right', 'bottom']:
+            self.teams[name] = self.db.create_team(name)
+        self.teams['top'].add_subteam(self.teams['left'])
+        self.teams['top'].add_subteam(self.teams['right'])
+        self.teams['left'].add_subteam(self.teams['bottom'])
+        self.teams['right'].add_subteam(self.teams['bottom'])
+        self.account = self.db.get_account(ACCOUNT)
+
+    def get_closure(self):
+        "Return the set of pairs (ancestor, descendant) of distinct teams."
+        cursor = self.db.execute('SELECT a.name, d.name'
+                                 ' FROM team_closure AS tc,'
+                                 '  team AS a, team AS d'
+                                 ' WHERE a.id=tc.ancestor'
+                                 ' AND d.id=tc.descendant AND a.id!=d.id')
+        return set([(str(r[0]), str(r[1])) for r in cursor])
+
+    def get_effective_teams(self):
+        return set(self.account.get_team_names(effective=True))
+
+    def test_diamond(self):
+        "The team at the bottom is contained by all others."
+        self.assertEqual(self.get_closure(),
+                         set([('top', 'left'), ('top', 'right'),
+                              ('top', 'bottom'), ('left', 'bottom'),
+                              ('right', 'bottom')]))
+        self.teams['bottom'].add_member(self.account)
+        self.assertEqual(self.get_effective_teams(),
+                         set(['top', 'left', 'right', 'bottom']))
+        self.assertEqual(self.account.get_team_names(), ['bottom'])
+
+    def test_cycle(self):
+        "A subteam containing the team, or the team itself, is rejected."
+        self.assertRaises(ValueError,
+                          self.teams['bottom'].add_subteam, self.teams['top'])
+        self.assertRaises(ValueError,
+                          self.teams['left'].add_subteam, self.teams['left'])
+        self.assertFalse(('bottom', 'top') in self.get_closure())
+
+    def test_remove_subteam(self):
+        "The closure is repaired when an edge of the diamond is removed."
+        self.teams['bottom'].add_member(self.account)
+        self.teams['left'].remove_subteam(self.teams['bottom'])
+        # Still contained by 'top' via 'right'.
+        self.assertEqual(self.get_closure(),
+                         set([('top', 'left'), ('top', 'right'),
+                              ('top', 'bottom'), ('right', 'bottom')]))
+        self.assertEqual(self.get_effective_teams(),
+                         set(['top', 'right', 'bottom']))
+        self.teams['right'].remove_subteam(self.teams['bottom'])
+        self.assertEqual(self.get_closure(),
+                         set([('top', 'left'), ('top', 'right')]))
+        self.assertEqual(self.get_effective_teams(), set(['bottom']))
+
+    def test_effective_triggers(self):
+        "Adding and removing members updates the effective memberships."
+        self.teams['bottom'].add_member(self.account)
+        self.teams['left'].add_member(self.account)
+        self.teams['bottom'].remove_member(self.account)
+        # Still a member of 'left', and so of 'top'.
+        self.assertEqual(self.get_effective_teams(), set(['top', 'left']))
+        self.teams['left'].remove_member(self.account)
+        self.assertEqual(self.get_effective_teams(), set())
+        self.assertFalse(self.teams['top'].is_member(self.account,
+                                                     effective=True))
+
+
+class TestMembershipColumn(DatabaseTestBase):
+    "Test the denormalized memberships of accounts, maintained by triggers."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = get_shared_database(self.path)
+        self.db.refresh()
+        self.account = self.db.get_account(ACCOUNT)
+        self.team1 = self.db.create_team('team1')
+        self.team2 = self.db.create_team('team2')
+
+    def get_memberships(self):
+        "Return the memberships of the test account, as read anew."
+        return Account(self.db, name=ACCOUNT).get_memberships()
+
+    def rename_team(self, team, name):
+        self.db.execute('UPDATE team SET name=? WHERE id=?', name, team.id)
+
+    def test_memberships(self):
+        "The column follows add, promote, rename and remove."
+        if not configuration.MEMBERSHIP_COLUMN:
+            raise unittest.SkipTest('membership column not maintained')
+        self.assertEqual(self.get_memberships(), [])
+        self.team1.add_member(self.account)
+        self.team2.add_member(self.account)
+        self.assertEqual(self.get_memberships(),
+                         [('team1', False), ('team2', False)])
+        self.team1.set_admin(self.account)
+        self.assertEqual(self.get_memberships(),
+                         [('team1', True), ('team2', False)])
+        self.db.write(self.rename_team, self.team1, 'renamed')
+        self.assertEqual(self.get_memberships(),
+                         [('renamed', True), ('team2', False)])
+        self.team2.remove_member(self.account)
+        self.assertEqual(self.get_memberships(), [('renamed', True)])
+        self.assertEqual(self.account.get_team_names(), ['renamed'])
+
+
+class TestPropertyIndex(DatabaseTestBase):
+    "Test finding accounts by property, and the property indexes."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = get_shared_database(self.path)
+        self.db.refresh()
+        for name, properties in [('a1', dict(myapp=dict(admin=True))),
+                                 ('a2', dict(myapp=dict(admin=False))),
+                                 ('a3', dict(myapp=dict(admin=True,
+                                                        level=2))),
+                                 ('a4', dict(other=dict(admin=True)))]:
+            account = self.db.create_account(name)
+            account.properties = properties
+            account.save()
+        self.saved_indexes = configuration.PROPERTY_INDEXES
+        configuration.PROPERTY_INDEXES = ['myapp.admin']
+
+    def tearDown(self):
+        configuration.PROPERTY_INDEXES = self.saved_indexes
+        DatabaseTestBase.tearDown(self)
+
+    def get_plan(self, path):
+        """Return the query plan for finding accounts by the property path.
+        A new connection is used, since the plan of a cached EXPLAIN
+        statement is not updated when the schema changes.
+        """
+        cnx = sqlite3.connect(self.db.file)
+        try:
+            cursor = cnx.execute('EXPLAIN QUERY PLAN'
+                                 ' SELECT name FROM account WHERE %s=?'
+                                 ' ORDER BY name' %
+                                 self.db.get_property_expression(path), (1,))
+            return ' '.join([str(r[-1]) for r in cursor])
+        finally:
+            cnx.close()
+
+    def test_find_accounts(self):
+        "Find accounts by the value of a property."
+        self.assertEqual(self.db.find_accounts('myapp.admin', True),
+                         ['a1', 'a3'])
+        self.assertEqual(self.db.find_accounts('myapp.admin', False), ['a2'])
+        self.assertEqual(self.db.find_accounts('myapp.level', 2), ['a3'])
+        self.assertEqual(self.db.find_accounts('myapp.level', 3), [])
+        self.assertEqual(self.db.find_accounts('myapp.admin', None),
+                         ['a4', 'admin', 'anonymous', ACCOUNT])
+        self.assertEqual(interface.find_accounts('other.admin', True),
+                         ['a4'])
+        for path in ['', 'myapp.', 'my app', "myapp.admin')"]:
+            self.assertRaises(ValueError, self.db.find_accounts, path, True)
+        self.assertRaises(ValueError,
+                          self.db.find_accounts, 'myapp', dict(admin=True))
+
+    def test_index(self):
+        "The index created when upgrading is used for the property path."
+        self.assertEqual(self.db.get_property_indexes(), [])
+        self.assertFalse('account_property_' in self.get_plan('myapp.admin'))
+        self.db.write(self.db.upgrade)
+        self.assertEqual(self.db.get_property_indexes(), ['myapp.admin'])
+        self.assertTrue(Database.get_property_index_name('myapp.admin')
+                        in self.get_plan('myapp.admin'))
+        self.assertFalse('account_property_' in self.get_plan('myapp.level'))
+        self.assertEqual(self.db.find_accounts('myapp.admin', True),
+                         ['a1', 'a3'])
+        self.db.write(self.db.drop_property_index, 'myapp.admin')
+        self.assertEqual(self.db.get_property_indexes(), [])
+        self.assertFalse('account_property_' in self.get_plan('myapp.admin'))
+
+
+class TestWriter(DatabaseTestBase):
+    "Test the writer thread."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = Database(self.path)
+        self.db.open()
+
+    def tearDown(self):
+        self.db.close()
+        DatabaseTestBase.tearDown(self)
+
+    def create_team(self, name, fail=False):
+        self.db.create_team(name)
+        if fail:
+            raise ValueError("failed to create team '%s'" % name)
+
+    def test_group_commit(self):
+        """The pending writes are committed together; a failed write
+        is rolled back, without affecting the others.
+        """
+        writer = Writer(self.db)
+        writes = [Write(self.create_team, (name,), dict(fail=fail))
+                  for name, fail in [('team1', False),
+                                     ('team2', True),
+                                     ('team3', False)]]
+        for write in writes:
+            writer.queue.put(write)
+        writer.start()
+        writes[0].wait()
+        self.assertRaises(ValueError, writes[1].wait)
+        writes[2].wait()
+        writer.stop()
+        stats = writer.get_stats()
+        self.assertEqual((stats['writes'], stats['errors'], stats['commits']),
+                         (3, 1, 1))
+        self.assertEqual(self.db.get_team_names('team'), ['team1', 'team3'])
+
+    def test_threads(self):
+        "The writes of several threads are all done by the writer."
+        self.db.start_writer()
+        threads = [threading.Thread(target=self.db.write,
+                                    args=(self.create_team, "team%s" % i))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.db.writer.get_stats()
+        self.assertEqual(stats['writes'], 10)
+        self.assertTrue(1 <= stats['commits'] <= 10)
+        self.assertEqual(len(self.db.get_team_names('team')), 10)
+
+
+class TestNegativeCache(DatabaseTestBase):
+    "Test the cache of missing names, and its invalidation."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = get_shared_database(self.path)
+        self.db.refresh()
+
+    def test_expiry(self):
+        "An entry expires after its time-to-live; the oldest is evicted."
+        now = [1000.0]
+        cache = NegativeCache(max_entries=2, ttl=10, clock=lambda: now[0])
+        cache.add('a')
+        self.assertTrue('a' in cache)
+        now[0] += 11
+        self.assertFalse('a' in cache)
+        for key in 'abc':
+            cache.add(key)
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        cache.discard('b')
+        self.assertFalse('b' in cache)
+
+    def test_create_account(self):
+        "A cached missing account is found when created."
+        key = (self.path, 'newaccount')
+        self.assertRaises(KeyError, self.db.get_account, 'newaccount')
+        self.assertTrue(key in missing_accounts)
+        self.db.create_account('newaccount')
+        self.assertFalse(key in missing_accounts)
+        self.assertEqual(self.db.get_account('newaccount').name,
+                         'newaccount')
+
+    def test_create_team(self):
+        "A cached missing team is found when created."
+        key = (self.path, 'newteam')
+        self.assertRaises(KeyError, self.db.get_team, 'newteam')
+        self.assertTrue(key in missing_teams)
+        self.db.create_team('newteam')
+        self.assertFalse(key in missing_teams)
+        self.assertEqual(self.db.get_team('newteam').name, 'newteam')
+
+    def test_create_elsewhere(self):
+        """A cached missing account created by another process is found
+        after the refresh reading the change log.
+        """
+        key = (self.path, 'newaccount')
+        self.assertRaises(KeyError, self.db.get_account, 'newaccount')
+        self.assertTrue(key in missing_accounts)
+        cnx = sqlite3.connect(self.db.file)
+        try:
+            cnx.execute("INSERT INTO account (name) VALUES ('newaccount')")
+            cnx.execute('INSERT INTO change_log (type, name, action)'
+                        " VALUES ('account', 'newaccount', 'create')")
+            cnx.commit()
+        finally:
+            cnx.close()
+        self.assertTrue(key in missing_accounts)
+        self.db.refresh()
+        self.assertFalse(key in missing_accounts)
+        self.assertEqual(self.db.get_account('newaccount').name,
+                         'newaccount')
+
+
+class TestPreload(DatabaseTestBase):
+    "Test the preloading of the caches."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = Database(self.path)
+        self.db.open()
+
+    def tearDown(self):
+        self.db.close()
+        DatabaseTestBase.tearDown(self)
+
+    def get_cached_bytes(self):
+        "Return the total size of the cached items."
+        return self.db.account_cache.bytes + self.db.team_cache.bytes + \
+            self.db.membership_index.bytes
+
+    def test_preload(self):
+        "All items are loaded into the caches, except those already there."
+        account = self.db.get_account(ACCOUNT)
+        result = self.db.preload()
+        self.assertEqual((result['teams'], result['accounts'],
+                          result['memberships']),
+                         (1, 2, 1))
+        self.assertEqual(sorted(self.db.account_cache.entries),
+                         ['admin', 'anonymous', ACCOUNT])
+        self.assertEqual(list(self.db.team_cache.entries), ['admin'])
+        self.assertEqual(self.db.membership_index['admin'], ['admin'])
+        self.assertTrue(self.db.get_account(ACCOUNT) is account)
+        self.assertEqual(result['bytes'], self.get_cached_bytes() -
+                         self.db.account_cache.sizeof(account))
+        # Served from the cache, without a query.
+        hits = self.db.account_cache.get_stats()['hits']
+        self.db.get_account('admin')
+        self.assertEqual(self.db.account_cache.get_stats()['hits'], hits + 1)
+
+    def test_max_bytes(self):
+        "Loading stops before the total size exceeds the maximum."
+        result = self.db.preload(max_bytes=0)
+        self.assertEqual((result['teams'], result['accounts'],
+                          result['memberships']),
+                         (0, 0, 0))
+        self.assertEqual(self.get_cached_bytes(), 0)
+        total = Database(self.path)
+        total.open()
+        try:
+            full = total.preload()['bytes']
+        finally:
+            total.close()
+        max_bytes = full // 2
+        result = self.db.preload(max_bytes=max_bytes)
+        self.assertTrue(0 < self.get_cached_bytes() <= max_bytes)
+        self.assertTrue(result['teams'] + result['accounts'] +
+                        result['memberships'] < 5)
+
+
+class TestLruCache(unittest.TestCase):
+    "Test the LRU cache, with the size of a string value as its length."
+
+    def setUp(self):
+        self.cache = LruCache(max_entries=3, max_bytes=10, sizeof=len)
+
+    def test_entries(self):
+        "The least recently used entry is evicted beyond the maximum."
+        for key in 'abc':
+            self.cache[key] = 'x'
+        self.cache['a']                 # Now 'b' is the least recently used.
+        self.cache['d'] = 'x'
+        self.assertEqual(sorted(self.cache.entries), ['a', 'c', 'd'])
+        self.assertEqual(self.cache.get_stats()['evictions'], 1)
+
+    def test_bytes(self):
+        "Entries are evicted until the total size is within the maximum."
+        self.cache['a'] = 'xxxx'
+        self.cache['b'] = 'xxxx'
+        self.assertEqual(self.cache.bytes, 8)
+        self.cache['c'] = 'xxxx'
+        self.assertEqual(sorted(self.cache.entries), ['b', 'c'])
+        self.assertEqual(self.cache.bytes, 8)
+        # A value larger than the maximum is not kept.
+        self.cache['d'] = 'x' * 11
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.bytes, 0)
+
+    def test_accounting(self):
+        "The total size follows replacement, pop and clear."
+        self.cache['a'] = 'xxx'
+        self.cache['a'] = 'xxxxx'
+        self.assertEqual(self.cache.bytes, 5)
+        self.cache['b'] = 'xx'
+        self.assertEqual(self.cache.pop('a'), 'xxxxx')
+        self.assertEqual(self.cache.pop('a'), None)
+        self.assertEqual(self.cache.bytes, 2)
+        self.cache.clear()
+        self.assertEqual(self.cache.bytes, 0)
+        self.assertRaises(KeyError, self.cache.__getitem__, 'b')
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['entries'], stats['misses']), (0, 1))
+
+
+class TestLoginThrottle(unittest.TestCase):
+    "Test the login throttle, with a clock set by the test."
+
+    def setUp(self):
+        self.now = 1000.0
+        self.throttle = LoginThrottle(account_burst=3,
+                                      address_burst=5,
+                                      rate=0.5,
+                                      max_backoff=4,
+                                      max_entries=4,
+                                      clock=lambda: self.now)
+
+    def fail_logins(self, name, address=None, count=1):
+        "Make the given number of admitted, failed login attempts."
+        for i in range(count):
+            self.throttle.admit(name, address)
+            self.throttle.failure(name, address)
+
+    def test_account_burst(self):
+        "The account is rejected after a burst of failures, not others."
+        self.fail_logins('user1', count=3)
+        self.assertRaises(ValueError, self.throttle.admit, 'user1')
+        self.throttle.admit('user2')
+
+    def test_refill(self):
+        "Attempts become allowed again at the given rate."
+        self.fail_logins('user1', count=3)
+        self.now += 1.5
+        self.assertRaises(ValueError, self.throttle.admit, 'user1')
+        self.now += 0.5
+        self.throttle.admit('user1')
+
+    def test_backoff(self):
+        "Failures beyond the burst give an increasing, capped backoff."
+        self.fail_logins('user1', count=3)
+        self.now += 0.5
+        self.assertRaises(ValueError, self.throttle.admit, 'user1')
+        self.now += 1.5
+        self.fail_logins('user1')       # Backoff 2 seconds.
+        self.now += 1.5
+        self.assertRaises(ValueError, self.throttle.admit, 'user1')
+        self.now += 0.5
+        self.fail_logins('user1')       # Backoff 4 seconds.
+        self.now += 2.0
+        # A token has been refilled, but the backoff is not over.
+        self.assertRaises(ValueError, self.throttle.admit, 'user1')
+        self.now += 2.0
+        self.fail_logins('user1')       # Backoff 8, capped to 4 seconds.
+        self.now += 2.0
+        self.assertRaises(ValueError, self.throttle.admit, 'user1')
+        self.now += 2.0
+        self.throttle.admit('user1')
+
+    def test_success(self):
+        "A successful login clears the state of the account."
+        self.fail_logins('user1', count=3)
+        self.throttle.success('user1')
+        self.throttle.admit('user1')
+
+    def test_spaced_failures(self):
+        "Failures spaced out more than the refill time never block."
+        self.throttle.max_backoff = 300
+        for i in range(60):
+            self.fail_logins("user%s" % (i % 3), address='10.0.0.1')
+            self.now += 60.0
+        self.throttle.admit('user1', '10.0.0.1')
+        self.assertEqual(self.throttle.get_stats()['rejected'], 0)
+
+    def test_success_address(self):
+        "A successful login forgives one failure for the address."
+        for i in range(5):
+            self.fail_logins("user%s" % i, address='10.0.0.1')
+        self.assertRaises(ValueError, self.throttle.admit, 'other',
+                          '10.0.0.1')
+        self.now += 1.0                 # Past the backoff; half a token.
+        self.assertRaises(ValueError, self.throttle.admit, 'other',
+                          '10.0.0.1')
+        self.throttle.success('other', '10.0.0.1')
+        self.throttle.admit('other', '10.0.0.1')
+
+    def test_address(self):
+        "Failures for different accounts from an address count together."
+        for i in range(5):
+            self.fail_logins("user%s" % i, address='10.0.0.1')
+        self.assertRaises(ValueError, self.throttle.admit, 'other',
+                          '10.0.0.1')
+        self.throttle.admit('other', '10.0.0.2')
+
+    def test_eviction(self):
+        "The least recently used entries are evicted beyond the maximum."
+        self.fail_logins('user1', count=3)
+        for i in range(2, 6):
+            self.fail_logins("user%s" % i)
+        self.assertEqual(self.throttle.get_stats()['entries'], 4)
+        self.assertTrue(self.throttle.get_stats()['evictions'] >= 1)
+        self.throttle.admit('user1')
+
+
+class TestMaintenance(DatabaseTestBase):
+    "Test the maintenance tasks."
+
+    def test_run(self):
+        "Run all tasks; the backup is a copy of the database."
+        db = Database(self.path)
+        db.open()
+        try:
+            backup_path = self.path + '.backup'
+            report = maintenance.run(db, backup_path=backup_path)
+        finally:
+            db.close()
+        self.assertEqual([r[0] for r in report],
+                         ['integrity_check', 'backup', 'compact_changes',
+                          'incremental_vacuum', 'analyze', 'checkpoint'])
+        for name, seconds, result in report:
+            self.assertFalse(str(result).startswith('failed'),
+                             msg="%s %s" % (name, result))
+        db = Database(backup_path)
+        db.open()
+        try:
+            self.assertEqual(db.get_account(ACCOUNT).email, EMAIL)
+        finally:
+            db.close()
+
+
+class TestSnapshot(DatabaseTestBase):
+    "Test the snapshot file, and its use by the interface module."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.db = get_shared_database(self.path)
+        self.snapshot_path = self.path.replace(':', '_') + '.snapshot'
+        if not os.path.isabs(self.snapshot_path):
+            self.snapshot_path = os.path.join(DIRPATH, self.snapshot_path)
+        self.saved = (configuration.SNAPSHOT, configuration.SNAPSHOT_FILE)
+        configuration.SNAPSHOT = True
+        configuration.SNAPSHOT_FILE = self.snapshot_path
+        interface._snapshot = None
+
+    def tearDown(self):
+        configuration.SNAPSHOT, configuration.SNAPSHOT_FILE = self.saved
+        interface._snapshot = None
+        DatabaseTestBase.tearDown(self)
+
+    def set_description(self, description):
+        account = self.db.get_account(ACCOUNT)
+        account.description = description
+        account.save()
+        self.db.refresh()
+
+    def test_export(self):
+        "Look up accounts and teams in the exported snapshot."
+        self.set_description(u'Test account \u00e5\u00e4\u00f6.')
+        snapshot.export(self.db, self.snapshot_path)
+        reader = snapshot.Snapshot(self.snapshot_path)
+        self.assertEqual(reader.get_version(), self.db.get_last_change())
+        data = reader.get_account(ACCOUNT, password=PASSWORD)
+        self.assertEqual(data['email'], EMAIL)
+        self.assertEqual(data['description'],
+                         u'Test account \u00e5\u00e4\u00f6.')
+        self.assertFalse('password' in data)
+        self.assertRaises(ValueError,
+                          reader.get_account, ACCOUNT, password='wrong')
+        self.assertRaises(KeyError, reader.get_account, 'doesnotexist')
+        self.assertEqual(sorted(a['name'] for a in reader.get_accounts()),
+                         ['admin', 'anonymous', ACCOUNT])
+        team = reader.get_team('admin', effective=True)
+        self.assertEqual(team['members'], ['admin'])
+        self.assertEqual(team['effective_members'], ['admin'])
+        self.assertRaises(KeyError, reader.get_team, 'doesnotexist')
+
+    def test_stale(self):
+        "The database is read instead of a stale snapshot."
+        self.set_description('Before.')
+        snapshot.export(self.db, self.snapshot_path)
+        self.assertTrue(interface.get_snapshot() is not None)
+        self.assertEqual(interface.get_account(ACCOUNT)['description'],
+                         'Before.')
+        self.set_description('After.')
+        self.assertTrue(interface.get_snapshot() is None)
+        self.assertEqual(interface.get_account(ACCOUNT)['description'],
+                         'After.')
+        # Exporting again makes the snapshot current.
+        snapshot.export(self.db, self.snapshot_path)
+        self.assertTrue(interface.get_snapshot() is not None)
+        self.assertEqual(interface.get_account(ACCOUNT)['description'],
+                         'After.')
+
+    def test_corrupt(self):
+        "The database is read instead of a truncated or corrupt snapshot."
+        snapshot.export(self.db, self.snapshot_path)
+        with open(self.snapshot_path, 'rb') as infile:
+            content = infile.read()
+        for corrupt in [content[:10],
+                        content[:-10],
+                        b'x' * len(content),
+                        content[:-20] + b'}' * 20]:
+            with open(self.snapshot_path, 'wb') as outfile:
+                outfile.write(corrupt)
+            interface._snapshot = None
+            self.assertEqual(interface.get_account(ACCOUNT)['email'], EMAIL)
+            self.assertEqual(interface.check_membership('admin', 'admin'),
+                             dict(member=True, admin=True))
+        reader = snapshot.Snapshot(self.snapshot_path)
+        self.assertRaises(snapshot.SnapshotError, reader.get_team, 'admin')
+        with open(self.snapshot_path, 'wb') as outfile:
+            outfile.write(content[:-10])
+        self.assertRaises(snapshot.SnapshotError, reader.get_account, ACCOUNT)
+
+
+class TestCompression(DatabaseTestBase):
+    "Test the compression and caching of responses by the middleware."
+
+    def setUp(self):
+        DatabaseTestBase.setUp(self)
+        self.calls = []
+        self.body = b'{"accounts": []}'
+        self.content_type = 'application/json'
+        self.middleware = compression.CompressionMiddleware(self.application,
+                                                            min_size=100)
+        self.middleware.cache = LruCache(max_entries=10)
+
+    def application(self, environ, start_response):
+        "Dummy WSGI application returning the set body."
+        self.calls.append(environ['PATH_INFO'])
+        start_response('200 OK', [('Content-Type', self.content_type),
+                                  ('Content-Length', str(len(self.body)))])
+        return [self.body]
+
+    def request(self, path='/accounts', **headers):
+        "Return the status, headers and body of the response."
+        environ = dict(REQUEST_METHOD='GET', PATH_INFO=path)
+        wsgiref.util.setup_testing_defaults(environ)
+        environ.update(headers)
+        response = []
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, dict(headers)]
+        body = b''.join(self.middleware(environ, start_response))
+        return response[0], response[1], body
+
+    def test_accepts_gzip(self):
+        "Negotiate the gzip encoding."
+        for value, accepted in [('', False),
+                                ('gzip', True),
+                                ('deflate, GZIP', True),
+                                ('*', True),
+                                ('gzip;q=0', False),
+                                ('gzip; q=0.5', True),
+                                ('identity', False)]:
+            environ = dict(HTTP_ACCEPT_ENCODING=value)
+            self.assertEqual(compression.accepts_gzip(environ), accepted,
+                             msg=value)
+
+    def test_compress(self):
+        "A large response is compressed only if the client accepts it."
+        self.body = json.dumps(dict(accounts=['test'] * 100)).encode('ascii')
+        status, headers, body = self.request(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                         self.body)
+        status, headers, body = self.request(path='/account/test')
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(body, self.body)
+
+    def test_min_size(self):
+        "A small response, or one of another type, is not compressed."
+        status, headers, body = self.request(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(body, self.body)
+        self.body = b'x' * 1000
+        self.content_type = 'image/png'
+        status, headers, body = self.request(path='/image',
+                                             HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(body, self.body)
+
+    def test_cache(self):
+        """An anonymous response is cached until the directory changes.
+        A request with credentials is always passed to the application.
+        """
+        for i in range(2):
+            self.assertEqual(self.request()[2], self.body)
+        self.assertEqual(len(self.calls), 1)
+        # The encoding is part of the key.
+        self.request(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(len(self.calls), 2)
+        db = get_shared_database(self.path)
+        db.create_account('another')
+        db.refresh()
+        self.request()
+        self.assertEqual(len(self.calls), 3)
+        for i in range(2):
+            self.request(HTTP_AUTHORIZATION='Basic dGVzdDphYmMxMjM=')
+            self.request(HTTP_COOKIE='session=abc')
+        self.assertEqual(len(self.calls), 7)
+        self.request(path='/teams', REQUEST_METHOD='POST')
+        self.request(path='/teams', REQUEST_METHOD='POST')
+        self.assertEqual(len(self.calls), 9)
+
+
+class TestAsyncInterface(DatabaseTestBase):
+    "Test the asyncio interface."
+
+    def setUp(self):
+        if async_interface is None:
+            raise unittest.SkipTest('requires Python 3')
+        DatabaseTestBase.setUp(self)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        DatabaseTestBase.tearDown(self)
+
+    def test_get_account(self):
+        "Await the data for the test account."
+        data = self.loop.run_until_complete(
+            async_interface.get_account(ACCOUNT, password=PASSWORD))
+        self.assertEqual(data['name'], ACCOUNT)
+        self.assertEqual(data['email'], EMAIL)
+
+    def test_get_account_missing(self):
+        "Try awaiting the data for a nonexistent account."
+        self.assertRaises(KeyError,
+                          self.loop.run_until_complete,
+                          async_interface.get_account('doesnotexist'))
+
+    def test_get_account_coalesced(self):
+        "Concurrent identical lookups are done by a single query."
+        calls = []
+        original = async_interface._get_account
+        def lookup(*args):
+            calls.append(args)
+            time.sleep(0.1)         # Keep the lookup pending meanwhile.
+            return original(*args)
+        async_interface._get_account = lookup
+        try:
+            results = self.loop.run_until_complete(asyncio.gather(
+                *[async_interface.get_account(ACCOUNT) for i in range(5)]))
+        finally:
+            async_interface._get_account = original
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [results[0]] * 5)
+        # Each caller gets its own copy of the result.
+        self.assertTrue(results[0] is not results[1])
+
+    def test_find_accounts(self):
+        """Find accounts by property. A lookup by an unhashable value
+        is rejected by the database, not when coalescing it.
+        """
+        interface.update_account_properties(ACCOUNT, 'myapp', dict(level=2))
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[async_interface.find_accounts('myapp.level', 2)
+              for i in range(2)]))
+        self.assertEqual(results, [[ACCOUNT], [ACCOUNT]])
+        for value in [['a', 'b'], dict(level=2)]:
+            self.assertRaises(ValueError,
+                              self.loop.run_until_complete,
+                              async_interface.find_accounts('myapp', value))
+
+    def test_search_and_changes(self):
+        "Await the search results and the changes."
+        self.assertEqual(self.loop.run_until_complete(
+                async_interface.search(ACCOUNT)),
+                         [dict(type='account', name=ACCOUNT)])
+        changes = self.loop.run_until_complete(async_interface.get_changes())
+        self.assertEqual(changes, interface.get_changes())
+        self.assertTrue(changes['changes'])
+
+    def test_snapshot(self):
+        "The snapshot file is read when configured, as by 'interface'."
+        path = os.path.join(DIRPATH, self.id() + '.snapshot')
+        snapshot.export(get_shared_database(self.path), path)
+        saved = (configuration.SNAPSHOT, configuration.SNAPSHOT_FILE)
+        configuration.SNAPSHOT = True
+        configuration.SNAPSHOT_FILE = path
+        reader = snapshot.Snapshot(path)
+        calls = []
+        original = reader.get_account
+        def get_account(*args, **kwargs):
+            calls.append(args)
+            return original(*args, **kwargs)
+        reader.get_account = get_account
+        interface._snapshot = reader
+        try:
+            data = self.loop.run_until_complete(
+                async_interface.get_account(ACCOUNT, password=PASSWORD))
+        finally:
+            configuration.SNAPSHOT, configuration.SNAPSHOT_FILE = saved
+            interface._snapshot = None
+        self.assertEqual(data['email'], EMAIL)
+        self.assertEqual(calls, [(ACCOUNT,)])
+
+
+def add_memory_variants(*classes):
+    "Add a variant of each test class using a database in memory."
+    for cls in classes:
+        name = cls.__name__ + 'Memory'
+        globals()[name] = type(name, (cls,),
+                               dict(memory=True,
+                                    __doc__="%s In memory." % cls.__doc__))
+
+# The web resource tests are not repeated; the database tests cover
+# the database in memory.
+add_memory_variants(TestDatabase, TestClosure, TestMembershipColumn,
+                    TestPropertyIndex, TestWriter, TestSnapshot,
+                    TestAsyncInterface)
+
+
 if __name__ == '__main__':
-    ex = TestExecutor(url=URL, account=ACCOUNT, password=PASSWORD)
-    print 'Testing', ex.wr
-    ex.test(TestAccess,
-            TestAccount)
+    unittest.main()
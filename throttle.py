@@ -0,0 +1,117 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Admission control for login attempts, protecting against bursts of
+failed logins such as credential stuffing.
+
+Failed logins are counted in token buckets per account name and per
+client address. A login by email address is counted for the email
+address, normalized, without looking up the account. When a bucket
+is empty, attempts are rejected before the database is read or the
+password is hashed. Repeated failures beyond the burst size give an
+exponentially increasing backoff, until the bucket has refilled.
+The state table is bounded; the least recently used entries are evicted.
+The state is process-wide, shared by all threads.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from whoyou import configuration
+
+
+class LoginThrottle(object):
+    "Token buckets for failed logins, per account name and client address."
+
+    def __init__(self,
+                 account_burst=configuration.LOGIN_ACCOUNT_BURST,
+                 address_burst=configuration.LOGIN_ADDRESS_BURST,
+                 rate=configuration.LOGIN_FAILURE_RATE,
+                 max_backoff=configuration.LOGIN_MAX_BACKOFF,
+                 max_entries=configuration.LOGIN_THROTTLE_ENTRIES,
+                 clock=time.time):
+        self.bursts = dict(account=account_burst, address=address_burst)
+        self.rate = rate
+        self.max_backoff = max_backoff
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Key (kind, value) -> [tokens, time of update, failures, blocked until]
+        self.entries = OrderedDict()
+        self.counters = dict(admitted=0, rejected=0, failures=0,
+                             successes=0, evictions=0)
+
+    def get_entry(self, kind, value, now):
+        "Return the entry with its tokens refilled. Lock must be held."
+        key = (kind, value)
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            entry = [float(self.bursts[kind]), now, 0, 0.0]
+        else:
+            entry[0] = min(float(self.bursts[kind]),
+                           entry[0] + (now - entry[1]) * self.rate)
+            entry[1] = now
+            # Fully refilled: the earlier failures no longer count
+            # for the backoff.
+            if entry[0] >= self.bursts[kind]:
+                entry[2] = 0
+        self.entries[key] = entry       # Now the most recently used.
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+        return entry
+
+    def get_keys(self, name, address):
+        keys = [('account', name)]
+        if address:
+            keys.append(('address', address))
+        return keys
+
+    def admit(self, name, address=None):
+        "Raise ValueError if a login attempt is not allowed now."
+        now = self.clock()
+        with self.lock:
+            for kind, value in self.get_keys(name, address):
+                entry = self.get_entry(kind, value, now)
+                if entry[0] < 1.0 or now < entry[3]:
+                    self.counters['rejected'] += 1
+                    raise ValueError('too many failed logins; try later')
+            self.counters['admitted'] += 1
+
+    def failure(self, name, address=None):
+        "Record a failed login attempt."
+        now = self.clock()
+        with self.lock:
+            self.counters['failures'] += 1
+            for kind, value in self.get_keys(name, address):
+                entry = self.get_entry(kind, value, now)
+                entry[0] = max(0.0, entry[0] - 1.0)
+                entry[2] += 1
+                excess = entry[2] - self.bursts[kind]
+                if excess >= 0:
+                    entry[3] = now + min(self.max_backoff, 2.0 ** excess)
+
+    def success(self, name, address=None):
+        """Record a successful login; clear the state for the account.
+        For the address, which may be shared by many clients, one
+        failure is forgiven.
+        """
+        now = self.clock()
+        with self.lock:
+            self.counters['successes'] += 1
+            self.entries.pop(('account', name), None)
+            if address and ('address', address) in self.entries:
+                entry = self.get_entry('address', address, now)
+                entry[0] = min(float(self.bursts['address']), entry[0] + 1.0)
+                entry[2] = max(0, entry[2] - 1)
+
+    def get_stats(self):
+        "Return a dictionary of the counters and current number of entries."
+        with self.lock:
+            result = self.counters.copy()
+            result['entries'] = len(self.entries)
+        return result
+
+
+login_throttle = LoginThrottle()
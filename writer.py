@@ -0,0 +1,121 @@
+""" WhoYou: Simple accounts database for web applications.
+
+Single writer thread for a Database instance, serializing the writes
+of all threads in the process.
+"""
+
+import threading
+try:
+    import queue
+except ImportError:                 # Python 2
+    import Queue as queue
+
+from whoyou import configuration
+
+
+class Write(object):
+    "A pending write: the function to call, and its outcome."
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        "Wait until committed or failed; return the result or raise."
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Writer(threading.Thread):
+    """Thread performing the writes of all threads, in order of submission,
+    using its own connection. The writes pending when the thread becomes
+    free are done in one transaction (group commit); each write is done
+    within a savepoint, so that a failed write is rolled back without
+    affecting the others. The callers wait until the transaction has
+    been committed.
+    """
+
+    def __init__(self, db, max_group=configuration.WRITER_GROUP):
+        super(Writer, self).__init__(name='whoyou-writer')
+        self.daemon = True
+        self.db = db
+        self.max_group = max_group
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = dict(writes=0, errors=0, commits=0, failed_commits=0)
+
+    def call(self, function, args, kwargs):
+        "Submit the write, wait for it to be committed, and return its result."
+        write = Write(function, args, kwargs)
+        self.queue.put(write)
+        return write.wait()
+
+    def stop(self):
+        """Stop the thread, after the writes submitted before this,
+        and wait for it to end.
+        """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            group = []
+            write = self.queue.get()
+            while write is not None:
+                group.append(write)
+                if len(group) >= self.max_group: break
+                try:
+                    write = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stopped = write is None
+            if group:
+                self.process(group)
+        self.db.close_connection()
+
+    def process(self, group):
+        "Perform the writes in one transaction, and notify the callers."
+        db = self.db
+        try:
+            db.begin('IMMEDIATE')
+            db.local.writing = True
+            for write in group:
+                db.cnx.execute('SAVEPOINT write')
+                try:
+                    write.result = write.function(*write.args, **write.kwargs)
+                except Exception as error:
+                    write.error = error
+                    db.cnx.execute('ROLLBACK TO write')
+                db.cnx.execute('RELEASE write')
+            db.local.writing = False
+            db.commit()
+        except Exception as error:
+            db.local.writing = False
+            db.rollback()
+            for write in group:
+                if write.error is None:
+                    write.error = error
+            with self.lock:
+                self.counters['failed_commits'] += 1
+        else:
+            with self.lock:
+                self.counters['commits'] += 1
+        with self.lock:
+            self.counters['writes'] += len(group)
+            self.counters['errors'] += len([w for w in group if w.error])
+        for write in group:
+            write.done.set()
+
+    def get_stats(self):
+        "Return a dictionary of the counters, and the current queue length."
+        with self.lock:
+            result = dict(self.counters)
+        result['queued'] = self.queue.qsize()
+        return result
@@ -3,6 +3,9 @@
 Apache WSGI interface using the 'wrapid' package.
 """
 
+import logging
+import threading
+
 import wrapid
 assert wrapid.__version__ in ('12.5', '12.7')
 from wrapid.application import Application
@@ -10,9 +13,15 @@ from wrapid.file import File
 
 import whoyou
 from whoyou import configuration
+from whoyou.database import get_shared_database
+from whoyou.compression import CompressionMiddleware
 from whoyou.home import *
 from whoyou.account import *
 from whoyou.team import *
+from whoyou.search import *
+from whoyou.check import *
+from whoyou.changes import *
+from whoyou.status import *
 from whoyou.documentation import *
 
 
@@ -41,6 +50,13 @@ application.add_resource('/static/{filepath:path}',
 application.add_resource('/accounts',
                          name='Account list',
                          GET=GET_Accounts)
+application.add_resource('/accounts/create',
+                         name='Accounts create',
+                         GET=GET_AccountsCreate,
+                         POST=POST_AccountsCreate)
+application.add_resource('/accounts/options',
+                         name='Account options',
+                         GET=GET_AccountOptions)
 application.add_resource('/account/{account}',
                          name='Account',
                          GET=GET_Account)
@@ -57,6 +73,9 @@ application.add_resource('/account',
 application.add_resource('/teams',
                          name='Team list',
                          GET=GET_Teams)
+application.add_resource('/teams/options',
+                         name='Team options',
+                         GET=GET_TeamOptions)
 application.add_resource('/team/{team}',
                          name='Team',
                          GET=GET_Team)
@@ -68,8 +87,52 @@ application.add_resource('/team',
                          name='Team create',
                          GET=GET_TeamCreate,
                          POST=POST_TeamCreate)
+application.add_resource('/memberships',
+                         name='Memberships',
+                         GET=GET_Memberships,
+                         POST=POST_Memberships)
+
+# Search resources
+application.add_resource('/search',
+                         name='Search',
+                         GET=GET_Search)
+
+# Membership check resources
+application.add_resource('/check',
+                         name='Check',
+                         GET=GET_Check)
+
+# Change log resources
+application.add_resource('/changes',
+                         name='Changes',
+                         GET=GET_Changes)
+
+# Status resources
+application.add_resource('/status',
+                         name='Status',
+                         GET=GET_Status)
 
 # Documentation resources
 application.add_resource('/doc/api',
                          name='Documentation API',
                          GET=GET_WhoYouApiDocumentation)
+
+# Compression and caching of responses; must wrap the complete application.
+if configuration.COMPRESSION:
+    application = CompressionMiddleware(application)
+
+
+def preload():
+    "Load the caches of the shared database instance; see Database.preload."
+    try:
+        db = get_shared_database()
+        db.refresh()
+        logging.info("WhoYou preload: %s", db.preload())
+    except Exception, msg:
+        logging.warning("WhoYou preload failed: %s", msg)
+
+# Warm up the caches in the background; requests are served meanwhile.
+if configuration.PRELOAD:
+    thread = threading.Thread(target=preload, name='whoyou-preload')
+    thread.daemon = True
+    thread.start()